@@ -39,12 +39,15 @@ from magneton.instance_segmentation.stages.segmentation_stage import (
     segmentation_blocks,
     segmentation_blocks_parallel,
 )
+from magneton.instance_segmentation.stages.segmentation_stage import warmup_waterz
 from magneton.instance_segmentation.stages.segmentation_stage_hpc import segmentation_blocks_hpc
 from magneton.instance_segmentation.stages.merge_pools import build_id_pools_parallel
 from magneton.instance_segmentation.stages.merge_pools_hpc import build_id_pools_parallel_hpc
 from magneton.instance_segmentation.stages.merge_apply import apply_pools_to_global
 from magneton.instance_segmentation.stages.merge_apply_hpc import apply_pools_to_global_hpc
+from magneton.instance_segmentation.stages.rethreshold_stage import rethreshold_blocks
 from magneton.instance_segmentation.state.checkpoint import load_merge_state
+from magneton.instance_segmentation.tools.status import print_status
 
 
 from magneton.instance_segmentation.utils.interrupts import InterruptController
@@ -253,7 +256,7 @@ def run(args, global_cfg):
             cfg = load_config(cfg_path)
             stage_cfg = get_stage_config(cfg, "merge")
             with InterruptController():
-                apply_pools_to_global(cfg, stage_cfg)
+                apply_pools_to_global(cfg, stage_cfg, restart=args.restart)
             print("Press Enter to return menu.")
             input("> ").strip().lower()
             # safe_run(apply_pools_to_global, cfg, stage_cfg)
@@ -268,6 +271,25 @@ def run(args, global_cfg):
             print("Press Enter to return menu.")
             input("> ").strip().lower()
 
+        elif args.stage == "rethreshold":
+            if not confirm_stage("Rethreshold"):
+                return
+            cfg_path = edit_stage_config(seg_cfg_path, "Rethreshold Stage")
+            cfg = load_config(cfg_path)
+            stage_cfg = get_stage_config(cfg, "segmentation")
+            with InterruptController():
+                rethreshold_blocks(cfg, stage_cfg, threshold=getattr(args, "threshold", None))
+            print("Press Enter to return menu.")
+            input("> ").strip().lower()
+
+        elif args.stage == "warmup-waterz":
+            cfg = load_config(seg_cfg_path)
+            stage_cfg = get_stage_config(cfg, "segmentation")
+            with InterruptController():
+                warmup_waterz(stage_cfg)
+            print("Press Enter to return menu.")
+            input("> ").strip().lower()
+
         elif args.stage == "status":
             cfg = load_config(seg_cfg_path)
             folder_done = cfg["checkpoint"]["segmentation_dir"]
@@ -282,6 +304,7 @@ def run(args, global_cfg):
                     print("Segmentation state:")
                     for f in files:
                         print(f"[Done] {f}")
+            print_status(cfg)
             print("Press Enter to return menu.")
             input("> ").strip().lower()
                         
@@ -541,6 +564,8 @@ def main():
             "segmentation-hpc",
             "merge-pools",
             "merge-apply",
+            "rethreshold",
+            "warmup-waterz",
             "tools",
             "status",
             "clean",
@@ -566,6 +591,8 @@ def main():
         required=False,
     )
     parser.add_argument("--restart", action="store_true")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="rethreshold stage: threshold to replay (default: segmentation_stage.rethreshold.threshold)")
     parser.add_argument("--force-overlap", action="store_true")
     parser.add_argument("--debug", action="store_true")
     args = parser.parse_args()
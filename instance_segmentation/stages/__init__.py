@@ -10,6 +10,7 @@ except Exception:
     segmentation_blocks_hpc = None
 
 from .merge_stage import merge_local_blocks
+from .rethreshold_stage import rethreshold_blocks
 
 try:
     from .merge_pools import build_id_pools_parallel
@@ -23,6 +24,7 @@ __all__ = [
     "segmentation_blocks_parallel",
     "segmentation_blocks_hpc",
     "merge_local_blocks",
+    "rethreshold_blocks",
     "build_id_pools_parallel",
     "apply_pools_to_global",
 ]
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive resources for HPC segmentation submissions (segmentation_stage.hpc.sizing):
+estimate the work of every block, group the pending blocks into size classes and size
+one job array per class (memory, time, blocks per task) from telemetry of previous runs,
+falling back to the configured resources scaled by the estimated work.
+"""
+import math
+
+import numpy as np
+from cloudvolume import CloudVolume
+
+from magneton.instance_segmentation.utils.block_utils import block_low_res_means, box_voxels, read_mask_summary
+from magneton.instance_segmentation.utils.telemetry import load_telemetry
+
+
+def parse_mem_mb(mem) -> float:
+    """Slurm memory ("4G", "500M", 2048) -> MB"""
+    s = str(mem).strip().upper()
+    units = {"K": 1.0 / 1024, "M": 1.0, "G": 1024.0, "T": 1024.0 ** 2}
+    if s and s[-1] in units:
+        return float(s[:-1]) * units[s[-1]]
+    return float(s)
+
+
+def parse_time_s(t) -> float:
+    """Slurm time ("[D-]HH:MM:SS", "MM:SS", minutes) -> seconds"""
+    s = str(t).strip()
+    days = 0
+    if "-" in s:
+        d, s = s.split("-", 1)
+        days = int(d)
+    parts = [float(p) for p in s.split(":")]
+    if len(parts) == 1:
+        return days * 86400 + parts[0] * 60
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    return days * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def format_time(seconds: float) -> str:
+    seconds = int(math.ceil(seconds))
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _boundary_density(global_cfg, stage_cfg, blocks, sz_cfg):
+    """
+    Pre-pass: fraction of boundary voxels (mean affinity below boundary_thr) under every block,
+    from the affinities at a low mip (sizing.mip, coarsest by default).
+    Returns: array per block, or None when the pre-pass is off or that mip is too large
+    """
+    if not sz_cfg.get("density", True):
+        return None
+    input_path = global_cfg["paths"]["input"]
+    mip = stage_cfg.get("mip", 0)
+    scales = CloudVolume(input_path, mip=mip, bounded=False, progress=False).info["scales"]
+    low_mip = sz_cfg.get("mip", None)
+    low_mip = len(scales) - 1 if low_mip is None else int(low_mip)
+    size_xyz = scales[low_mip]["size"]
+    mvox = float(np.prod(size_xyz)) / 1e6
+    if mvox > float(sz_cfg.get("max_prepass_mvox", 512)):
+        print(f"[WARN] Affinity mip {low_mip} has {mvox:.0f} Mvox (> max_prepass_mvox); "
+              f"sizing blocks by voxel count only.")
+        return None
+
+    low_vol = CloudVolume(input_path, mip=low_mip, bounded=False, progress=False, fill_missing=True)
+    aff = np.transpose(low_vol[:, :, :], (3, 2, 1, 0))   # (c, z, y, x)
+    scale = float(np.iinfo(aff.dtype).max) if np.issubdtype(aff.dtype, np.integer) else 1.0
+    boundary = (aff.mean(axis=0) / scale) < float(sz_cfg.get("boundary_thr", 0.5))
+    del aff
+
+    # Block coordinates are voxels at the stage mip
+    scale_zyx = [float(a) / float(b) for a, b in
+                 zip(scales[low_mip]["resolution"][::-1], scales[mip]["resolution"][::-1])]
+    origin_zyx = [float(v) * s for v, s in zip(scales[low_mip]["voxel_offset"][::-1], scale_zyx)]
+    density = np.asarray(block_low_res_means(boundary, blocks, scale_zyx, origin_zyx), dtype=np.float64)
+    print(f"[INFO] Boundary density pre-pass at mip {low_mip}: "
+          f"median {np.median(density):.3f}, max {density.max():.3f}")
+    return density
+
+
+def estimate_block_work(global_cfg, stage_cfg, blocks, sz_cfg) -> np.ndarray:
+    """
+    Work estimate of every block, in Mvox-equivalents:
+    voxels read (mask crop when the mask summary is on) * (1 + density_weight * boundary density)
+    """
+    summary = read_mask_summary(global_cfg, stage_cfg.get("mip", 0), blocks)
+    if summary is None:
+        voxels = np.asarray([box_voxels(b) for b in blocks], dtype=np.float64)
+    else:
+        voxels = np.asarray([box_voxels(crop) if crop is not None else 0 for _, crop in summary],
+                            dtype=np.float64)
+    work = voxels / 1e6
+    density = _boundary_density(global_cfg, stage_cfg, blocks, sz_cfg)
+    if density is not None:
+        work *= 1.0 + float(sz_cfg.get("density_weight", 4.0)) * density
+    return work
+
+
+def size_classes(work: np.ndarray, n_classes: int) -> np.ndarray:
+    """Class of every block (0 = smallest) from quantiles of the work estimates"""
+    n_classes = max(1, int(n_classes))
+    if n_classes == 1 or len(work) == 0:
+        return np.zeros(len(work), dtype=np.int64)
+    edges = np.unique(np.quantile(work, np.linspace(0, 1, n_classes + 1)[1:-1]))
+    return np.searchsorted(edges, work, side="left").astype(np.int64)
+
+
+def _telemetry_by_block(metadata_dir):
+    """{block index: (peak_rss_mb, wall_s)} of the latest segmentation record of every block"""
+    latest = {}
+    for rec in load_telemetry(metadata_dir, stage="segmentation"):
+        if isinstance(rec.get("task"), int) and rec.get("peak_rss_mb"):
+            latest[rec["task"]] = (float(rec["peak_rss_mb"]), float(rec["wall_s"]))
+    return latest
+
+
+def plan_size_classes(global_cfg, stage_cfg, blocks, pending) -> list:
+    """
+    Group the pending blocks into size classes with tuned resources.
+    Per-block peak memory and wall time of a class come from (first available):
+      telemetry:  p95 of the previous runs' blocks of that class (at least min_samples)
+      rate:       p95 memory/time per unit of work over all recorded blocks, times the class max work
+      config:     hpc.mem (per cpu) * cpus and hpc.time, taken as the budget of the largest blocks,
+                  scaled by the class max work (no safety margins)
+    Returns: list of dicts {cls, indices, work_max, blocks_per_job, time, mem, cpus, source}
+    """
+    hpc = stage_cfg.get("hpc", {}) or {}
+    sz_cfg = hpc.get("sizing", {}) or {}
+    workers = int(hpc.get("workers_per_job", 2))
+    cpus = int(hpc.get("cpus", 8))
+    blocks_per_job = int(hpc.get("blocks_per_job", 8))
+    mem_margin = float(sz_cfg.get("mem_margin", 1.3))
+    time_margin = float(sz_cfg.get("time_margin", 1.5))
+    min_samples = int(sz_cfg.get("min_samples", 5))
+    min_mem_mb = parse_mem_mb(sz_cfg.get("min_mem", "1G"))
+    min_time_s = parse_time_s(sz_cfg.get("min_time", "00:10:00"))
+
+    work = estimate_block_work(global_cfg, stage_cfg, blocks, sz_cfg)
+    classes = size_classes(work, sz_cfg.get("classes", 3))
+    w_max = max(float(work.max()), 1e-9)
+
+    # Configured resources: one task of blocks_per_job blocks of the largest work
+    cfg_rss = parse_mem_mb(hpc.get("mem", "16G")) * cpus / min(workers, blocks_per_job)
+    cfg_wall = parse_time_s(hpc.get("time", "04:00:00")) / math.ceil(blocks_per_job / workers)
+
+    measured = _telemetry_by_block(stage_cfg.get("metadata_dir", "./local_metadata"))
+    rate = None
+    if len(measured) >= min_samples:
+        idx = [i for i in measured if i < len(work) and work[i] > 0]
+        if len(idx) >= min_samples:
+            rate = (float(np.percentile([measured[i][0] / work[i] for i in idx], 95)),
+                    float(np.percentile([measured[i][1] / work[i] for i in idx], 95)))
+
+    pending = np.asarray(sorted(pending), dtype=np.int64)
+    plans = []
+    for c in sorted(set(classes[pending].tolist())):
+        members = pending[classes[pending] == c]
+        c_max = float(work[members].max())
+        margins = (mem_margin, time_margin)
+        samples = [measured[i] for i in np.flatnonzero(classes == c).tolist() if i in measured]
+        if len(samples) >= min_samples:
+            rss = float(np.percentile([s[0] for s in samples], 95))
+            wall = float(np.percentile([s[1] for s in samples], 95))
+            source = f"telemetry ({len(samples)} blocks)"
+        elif rate is not None:
+            rss, wall = rate[0] * c_max, rate[1] * c_max
+            source = f"telemetry rate ({len(measured)} blocks)"
+        else:
+            rss, wall = cfg_rss * c_max / w_max, cfg_wall * c_max / w_max
+            margins = (1.0, 1.0)   # the configured resources are a budget already
+            source = "config scaled by work"
+
+        # Packing: small blocks share a task, up to about the work of a task of the largest blocks
+        per_job = blocks_per_job
+        if sz_cfg.get("pack", True):
+            per_job = int(min(max(blocks_per_job * w_max / max(c_max, 1e-9), 1),
+                              max(int(sz_cfg.get("pack_max_blocks", 16)), blocks_per_job)))
+        mem_total = max(min_mem_mb, rss * margins[0] * min(workers, per_job))
+        task_time = max(min_time_s, wall * margins[1] * math.ceil(per_job / workers))
+        plans.append({
+            "cls": int(c),
+            "indices": members.tolist(),
+            "work_max": c_max,
+            "blocks_per_job": per_job,
+            "cpus": cpus,
+            "mem": f"{int(math.ceil(mem_total / cpus))}M",   # per cpu, like hpc.mem
+            "time": format_time(task_time),
+            "source": source,
+        })
+    return plans
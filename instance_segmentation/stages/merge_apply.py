@@ -2,6 +2,9 @@
 import os
 import json
 import gc
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from tqdm import tqdm
 from cloudvolume import CloudVolume
@@ -14,11 +17,18 @@ from magneton.instance_segmentation.config import (
 )
 
 from magneton.instance_segmentation.utils.meta_utils import load_index_meta
+from magneton.instance_segmentation.utils.block_utils import (
+    grid_cells_zyx, owned_regions_zyx, is_chunk_aligned_zyx
+)
 from magneton.instance_segmentation.utils.relabel_utils import (
-    update_id_pools, build_rep_map_from_pools, relabel_array_inplace_with_map
+    IdPoolUnionFind, load_unions_txt, load_lookup_table, relabel_array_inplace_with_map
 )
 from magneton.instance_segmentation.utils.io_utils import export_tif_from_volume
-from magneton.instance_segmentation.state.checkpoint import load_merge_state, save_merge_state
+from magneton.instance_segmentation.utils.telemetry import timed, task_record, append_telemetry, telemetry_enabled
+from magneton.instance_segmentation.state.checkpoint import (
+    load_merge_state, save_merge_state, load_unions_array, unions_bin_path,
+    mark_merge_done, load_merge_done, reset_merge_done,
+)
 
 
 def _load_offsets(merge_ckpt_dir):
@@ -29,26 +39,149 @@ def _load_offsets(merge_ckpt_dir):
 
 
 def _load_unions(merge_ckpt_dir):
+    """
+    Return unions as two aligned uint64 arrays (a[k], b[k]).
+    Memory-maps the binary unions log; falls back to a legacy unions.txt.
+    """
+    if os.path.exists(unions_bin_path(merge_ckpt_dir)):
+        unions = load_unions_array(merge_ckpt_dir, mmap=True)
+        return unions[:, 0], unions[:, 1]
     path = os.path.join(merge_ckpt_dir, "unions.txt")
+    return load_unions_txt(path)
+
+
+# Per-process state of the apply workers (set once by _init_apply_worker)
+_APPLY_LUT = None
+_APPLY_OUT = None
+_APPLY_TELEMETRY = None
+
+
+def _init_apply_worker(lut_path, output_path, non_aligned_writes=True, telemetry_dir=None):
+    """
+    Map the shared lookup table read-only and open the output volume once per process;
+    with telemetry_dir, every block task appends its telemetry record there
+    """
+    global _APPLY_LUT, _APPLY_OUT, _APPLY_TELEMETRY
+    _APPLY_TELEMETRY = telemetry_dir
+    _APPLY_LUT = load_lookup_table(lut_path) if lut_path else None
+    _APPLY_OUT = CloudVolume(output_path, mip=0, bounded=False, compress=False,
+                             progress=False, non_aligned_writes=non_aligned_writes)
+
+
+def _apply_block_task(i, in_path, region, off):
+    """Read a region (owned or full extent) of one block, add its global offset, relabel, write it out"""
+    z1, z2, y1, y2, x1, x2 = region
+    if z2 <= z1 or y2 <= y1 or x2 <= x1:
+        return i
+    start, phases = time.time(), {}
+    nbytes = (z2 - z1) * (y2 - y1) * (x2 - x1) * 4
+    if in_path is None:
+        # Empty block (mask pre-pass): background only
+        with timed(phases, "write"):
+            _APPLY_OUT[x1:x2, y1:y2, z1:z2] = np.zeros((x2 - x1, y2 - y1, z2 - z1, 1), dtype=np.uint32)
+        _apply_telemetry(i, start, phases, 0, nbytes)
+        return i
+
+    with timed(phases, "read"):
+        local_vol = CloudVolume(in_path, mip=0, bounded=False, progress=False)
+        seg_xyz = local_vol[x1:x2, y1:y2, z1:z2][:, :, :, 0]     # xyz
+        seg_zyx = np.transpose(seg_xyz, (2, 1, 0)).astype(np.uint32, copy=False)
+
+    with timed(phases, "relabel"):
+        # Add global offset (to avoid duplicate IDs across blocks)
+        if off:
+            nz = seg_zyx != 0
+            seg_zyx[nz] += np.uint32(off)
+
+        # Application-Representative Mapping
+        if _APPLY_LUT is not None:
+            relabel_array_inplace_with_map(seg_zyx, _APPLY_LUT)
+
+    # Write back to global scope out_vol
+    with timed(phases, "write"):
+        _APPLY_OUT[x1:x2, y1:y2, z1:z2] = np.transpose(seg_zyx, (2, 1, 0))[:, :, :, np.newaxis]
+
+    del seg_xyz, seg_zyx
+    gc.collect()
+    _apply_telemetry(i, start, phases, nbytes, nbytes)
+    return i
+
+
+def _apply_telemetry(i, start, phases, bytes_read, bytes_written):
+    if _APPLY_TELEMETRY is not None:
+        append_telemetry(_APPLY_TELEMETRY, task_record(
+            "merge-apply", i, start, phases, bytes_read=bytes_read, bytes_written=bytes_written,
+            voxels=bytes_written // 4))
+
+
+def _unions_digest(merge_ckpt_dir, chunk_bytes=1 << 24):
+    """Size and md5 of the unions file (binary log, or legacy unions.txt) read in chunks"""
+    path = unions_bin_path(merge_ckpt_dir)
     if not os.path.exists(path):
-        return []
-    pairs = []
-    with open(path, "r") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            a, b = line.split()
-            pairs.append((int(a), int(b)))
-    return pairs
-
-
-def apply_pools_to_global(global_cfg, stage_cfg):
+        path = os.path.join(merge_ckpt_dir, "unions.txt")
+        if not os.path.exists(path):
+            return None
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            md5.update(chunk)
+    return {"file": os.path.basename(path), "size": os.path.getsize(path), "md5": md5.hexdigest()}
+
+
+def _apply_signature(offsets, next_gid, unions_digest):
+    """Identify the relabeling a set of written blocks was produced with (offsets and union content)"""
+    key = json.dumps({"offsets": offsets, "next_gid": next_gid, "unions": unions_digest}, sort_keys=True)
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def _write_waves(blocks_meta):
+    """
+    Group blocks so that blocks written concurrently never touch the same storage chunk:
+    owned regions of neighboring blocks may share a chunk, so blocks are dispatched in
+    8 waves by grid-cell parity. Irregular layouts are written one block at a time.
+    """
+    cells = grid_cells_zyx([tuple(b["coords"]) for b in blocks_meta])
+    if cells is None:
+        print("[WARN] Block coordinates are not on a regular grid; writing blocks serially.")
+        return None
+    waves = {}
+    for blk, (cz, cy, cx) in zip(blocks_meta, cells):
+        waves.setdefault((cz % 2, cy % 2, cx % 2), []).append(blk)
+    return [waves[k] for k in sorted(waves)]
+
+
+def _write_regions(blocks_meta, write_policy, chunk_zyx, origin_zyx, bounds_zyx):
+    """
+    Region each block writes under the write policy:
+      - "full":  the whole block extent (overlaps are rewritten; later blocks win), serial only
+      - "owned": the half-overlap-trimmed owned region
+      - "chunk": the owned region with its cuts snapped to the output chunk grid where possible
+    Returns: ({index: region}, whether every write is chunk-aligned)
+    """
+    boxes = [tuple(b["coords"]) for b in blocks_meta]
+    if write_policy == "full":
+        regions = boxes
+    elif write_policy == "owned":
+        regions = owned_regions_zyx(boxes)
+    elif write_policy == "chunk":
+        regions = owned_regions_zyx(boxes, chunk_zyx=chunk_zyx, origin_zyx=origin_zyx)
+    else:
+        raise ValueError(f"Unknown write policy: {write_policy}")
+    aligned = write_policy != "full" and all(
+        is_chunk_aligned_zyx(r, chunk_zyx, origin_zyx, bounds_zyx)
+        for r in regions if r[1] > r[0] and r[3] > r[2] and r[5] > r[4]
+    )
+    return dict(zip((b["index"] for b in blocks_meta), regions)), aligned
+
+
+def apply_pools_to_global(global_cfg, stage_cfg, restart=False):
     """
     Phase 2:
     - Read offsets and unions generated in Phase 1
-    - Construct id_pools -> rep_map
-    - Read block by block (with global offset) -> Apply rep_map -> Write to out_vol
+    - Construct id_pools -> dense representative lookup table (shared via a memory-mapped .npy)
+    - Relabel blocks in a process pool; each block writes only its owned (half-overlap-trimmed)
+      region, snapped to the output chunk grid with write_policy="chunk"
+    - Record per-block completion in merge_ckpt_dir/applied/, so an interrupted run resumes
     """
     input_path     = global_cfg["paths"]["input"]
     output_path    = global_cfg["paths"]["output"]
@@ -56,6 +189,9 @@ def apply_pools_to_global(global_cfg, stage_cfg):
 
     metadata_dir   = stage_cfg.get("metadata_dir", "./local_metadata")
     mip            = stage_cfg.get("mip", 0)
+    workers        = int(stage_cfg.get("workers", os.cpu_count() or 1))
+    write_policy   = stage_cfg.get("write_policy", "chunk")
+    telemetry_dir  = metadata_dir if telemetry_enabled(global_cfg) else None
 
     export_cfg         = stage_cfg.get("export_tif", {})
     export_tif_enabled = export_cfg.get("enable", False)
@@ -70,15 +206,39 @@ def apply_pools_to_global(global_cfg, stage_cfg):
 
     # offsets / unions
     offsets, next_gid = _load_offsets(merge_ckpt_dir)
-    unions = _load_unions(merge_ckpt_dir)
-    print(f"[INFO] Loaded {len(unions)} union pairs, next_gid={next_gid}")
+    union_a, union_b = _load_unions(merge_ckpt_dir)
+    print(f"[INFO] Loaded {union_a.size} union pairs, next_gid={next_gid}")
 
-    # generate pools
-    id_pools = []
-    for a, b in unions:
-        update_id_pools(id_pools, a, b)
-    rep_map = build_rep_map_from_pools(id_pools)
-    print(f"[INFO] Pools={len(id_pools)}, rep_map entries={len(rep_map)}")
+    # Completed blocks and the lookup table are only valid for the same offsets and unions
+    state = load_merge_state(merge_ckpt_dir)
+    signature = _apply_signature(offsets, next_gid, _unions_digest(merge_ckpt_dir))
+    if restart or state.get("apply_signature") != signature:
+        reset_merge_done(merge_ckpt_dir)
+        state["apply_signature"] = signature
+        state["apply_write_policy"] = write_policy
+        state.pop("lut_signature", None)
+        save_merge_state(merge_ckpt_dir, state)
+    elif state.get("apply_write_policy", write_policy) != write_policy:
+        # Regions of different policies do not tile the volume together
+        print(f"[WARN] write_policy changed to {write_policy}; rewriting all blocks.")
+        reset_merge_done(merge_ckpt_dir)
+        state["apply_write_policy"] = write_policy
+        save_merge_state(merge_ckpt_dir, state)
+
+    # generate pools -> dense representative lookup table (lut[gid] = rep gid),
+    # persisted as a memory-mapped .npy that every worker maps read-only
+    lut_path = os.path.join(merge_ckpt_dir, "rep_lut.npy") if union_a.size else None
+    if lut_path and state.get("lut_signature") == signature and os.path.exists(lut_path):
+        print(f"[INFO] Reusing lookup table {lut_path}")
+    elif lut_path:
+        id_pools = IdPoolUnionFind.from_pairs(union_a, union_b)
+        id_pools.save_lookup_table(lut_path, next_gid)
+        state["lut_signature"] = signature
+        state["num_pools"] = id_pools.num_pools()
+        save_merge_state(merge_ckpt_dir, state)
+        print(f"[INFO] Pools={id_pools.num_pools()}, pooled ids={len(id_pools)}, lookup table -> {lut_path}")
+        del id_pools
+    del union_a, union_b
 
     # Create global out_vol (using input resolution/voxel_offset/size)
     aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
@@ -92,43 +252,59 @@ def apply_pools_to_global(global_cfg, stage_cfg):
                           progress=False, non_aligned_writes=True)
     out_vol.commit_info(); out_vol.commit_provenance()
 
-    # # Load merge state
-    # state = load_merge_state(merge_ckpt_dir)
-    # merged_blocks = set(state.get("merged_blocks", []))
-
-    # Write out_vol
-    for blk in tqdm(blocks_meta, desc="Apply Pools (blocks)"):
-        try:
-            i = blk["index"]
-            z1, z2, y1, y2, x1, x2 = blk["coords"]
-            in_path = blk["path"]
-            off = int(offsets.get(i, 0))
-
-            # Read entire block (global coordinate slice)
-            local_vol = CloudVolume(in_path, mip=0, bounded=False, progress=False)
-            seg_xyz = local_vol[x1:x2, y1:y2, z1:z2][:, :, :, 0]     # xyz
-            seg_zyx = np.transpose(seg_xyz, (2, 1, 0)).astype(np.uint32, copy=False)
-
-            # Add global offset (to avoid duplicate IDs across blocks)
-            if off:
-                nz = seg_zyx != 0
-                seg_zyx[nz] += np.uint32(off)
+    # Write regions are computed on the full block layout, then pending blocks are filtered
+    chunk_zyx = tuple(int(v) for v in aff_vol.chunk_size)[::-1]
+    origin_zyx = tuple(int(v) for v in aff_vol.voxel_offset)[::-1]
+    bounds_zyx = tuple(o + int(n) for o, n in zip(origin_zyx, vol_size_xyz[::-1]))
+    regions, aligned = _write_regions(blocks_meta, write_policy, chunk_zyx, origin_zyx, bounds_zyx)
+    print(f"[INFO] write_policy={write_policy}, chunk-aligned writes: {aligned}")
+    applied = load_merge_done(merge_ckpt_dir)
+    pending = [b for b in blocks_meta if b["index"] not in applied]
+    print(f"[INFO] {len(blocks_meta) - len(pending)} blocks already written, {len(pending)} pending.")
 
-            # Application-Representative Mapping
-            if rep_map:
-                relabel_array_inplace_with_map(seg_zyx, rep_map)
+    def _task_args(blk):
+        i = blk["index"]
+        return i, blk["path"], regions[i], int(offsets.get(i, 0))
 
-            # Write back to global scope out_vol
-            out_vol[x1:x2, y1:y2, z1:z2] = np.transpose(seg_zyx, (2, 1, 0))[:, :, :, np.newaxis]
+    # Write out_vol: chunk-aligned disjoint writes run fully parallel; owned regions that may
+    # share a chunk go in parity waves; full-extent writes overlap and stay serial
+    non_aligned = not aligned
+    if workers <= 1 or not pending or write_policy == "full":
+        waves = None
+    elif aligned:
+        waves = [pending]
+    else:
+        waves = _write_waves(pending)
+    if waves is None:
+        _init_apply_worker(lut_path, output_path, non_aligned, telemetry_dir)
+        for blk in tqdm(pending, desc="Apply Pools (blocks)"):
+            try:
+                i = _apply_block_task(*_task_args(blk))
+                mark_merge_done(merge_ckpt_dir, i)
+            except KeyboardInterrupt:
+                break
+    else:
+        print(f"[INFO] Dispatch with {workers} workers in {len(waves)} waves.")
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_apply_worker,
+                                 initargs=(lut_path, output_path, non_aligned, telemetry_dir)) as ex, \
+                tqdm(total=len(pending), desc="Apply Pools (blocks)") as pbar:
+            for wave in waves:
+                futs = {ex.submit(_apply_block_task, *_task_args(blk)): blk["index"] for blk in wave}
+                for fut in as_completed(futs):
+                    try:
+                        mark_merge_done(merge_ckpt_dir, fut.result())
+                    except Exception as e:
+                        print(f"[WARN] block {futs[fut]} failed: {e}")
+                    pbar.update(1)
 
-            del seg_xyz, seg_zyx
-            gc.collect()
-        except KeyboardInterrupt:
-            break
+    applied = load_merge_done(merge_ckpt_dir)
+    n_done = sum(b["index"] in applied for b in blocks_meta)
+    if n_done < len(blocks_meta):
+        print(f"[WARN] {len(blocks_meta) - n_done} blocks not written; rerun merge-apply to resume.")
+        return
 
     # Optional: export preview
     if export_tif_enabled:
-        from magneton.instance_segmentation.utils.io_utils import export_tif_from_volume
         export_tif_from_volume(out_vol, export_tif_path, max_slices=max_slices)
 
     print("[DONE] Phase-2 finished, global volume ready.")
@@ -137,11 +313,12 @@ def apply_pools_to_global(global_cfg, stage_cfg):
 def main():
     parser = argparse.ArgumentParser(description="Convert 3D/4D TIFF or HDF5 to Neuroglancer Precomputed format.")
     parser.add_argument("--config", default="configs/config_prec.yaml", type=str, help="Path to configuration YAML.")
+    parser.add_argument("--restart", action="store_true", help="Rewrite all blocks, ignoring merge-apply checkpoints.")
     args = parser.parse_args()
 
     cfg = load_config(args.config)
     stage_cfg = get_stage_config(cfg, "merge")
-    apply_pools_to_global(cfg, stage_cfg)
+    apply_pools_to_global(cfg, stage_cfg, restart=args.restart)
 
 
 if __name__ == "__main__":
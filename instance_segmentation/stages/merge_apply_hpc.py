@@ -6,7 +6,8 @@ import subprocess
 from pathlib import Path
 
 from magneton.instance_segmentation.config import load_config, load_global_config_path
-from magneton.instance_segmentation.utils.block_utils import generate_blocks_zyx
+from magneton.instance_segmentation.utils.block_utils import blocks_from_config
+from magneton.instance_segmentation.state.checkpoint import load_local_done
 from cloudvolume import CloudVolume
 
 
@@ -15,7 +16,7 @@ def _ensure_dir(p: str):
 
 
 def _pending_block_indices(cfg, restart=False):
-    """Compute all blocks and filter out completed blocks (depending on checkpoints/local/*.done)"""
+    """Compute all blocks and filter out completed blocks (one bulk read of the segmentation checkpoint)"""
     input_path = cfg["paths"]["input"]
     mip = cfg.get("local_stage", {}).get("mip", 0)
 
@@ -23,19 +24,14 @@ def _pending_block_indices(cfg, restart=False):
     vol_size_xyz = tuple(aff_vol.info["scales"][0]["size"])
     vol_shape_zyx = (vol_size_xyz[2], vol_size_xyz[1], vol_size_xyz[0])
 
-    block_size = tuple(cfg["block"]["size"])
-    overlap = tuple(cfg["block"]["overlap"])
-    blocks = generate_blocks_zyx(vol_shape_zyx, block_size, overlap)
+    chunk_zyx = tuple(int(c) for c in aff_vol.chunk_size)[::-1]
+    blocks = blocks_from_config(cfg, vol_shape_zyx, chunk_zyx)
 
     local_ckpt_dir = cfg["checkpoint"]["segmentation_dir"]
     os.makedirs(local_ckpt_dir, exist_ok=True)
 
-    pending = []
-    for i, _coords in enumerate(blocks):
-        done_flag = os.path.join(local_ckpt_dir, f"block_{i:04d}.done")
-        if os.path.exists(done_flag) or restart:
-            pending.append(i)
-    return pending
+    done = load_local_done(local_ckpt_dir)
+    return [i for i in range(len(blocks)) if (i in done) or restart]
 
 
 def _write_manifest(job_dir: str, indices, blocks_per_job: int):
@@ -3,6 +3,9 @@ import os
 import json
 import math
 import gc
+import time
+import hashlib
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import argparse
 
@@ -16,14 +19,16 @@ from magneton.instance_segmentation.config import (
     load_global_config_path,
 )
 
-from magneton.instance_segmentation.utils.meta_utils import load_index_meta
-from magneton.instance_segmentation.utils.block_utils import intersect_boxes_zyx
+from magneton.instance_segmentation.utils.meta_utils import load_index_meta, compact_index_meta
+from magneton.instance_segmentation.state.checkpoint import UnionsLog, load_done_pairs, reset_unions_log
+from magneton.instance_segmentation.utils.block_utils import overlapping_pairs_zyx, grid_cells_zyx
+from magneton.instance_segmentation.utils.telemetry import timed, task_record, append_telemetry, telemetry_enabled
 from magneton.instance_segmentation.utils.relabel_utils import (
     accumulate_local_global_pairs,
     update_id_pools,               # For optional memory aggregation only
     build_rep_map_from_pools,      # Optional
 )
-from magneton.instance_segmentation.utils.relabel_utils import select_pairs 
+from magneton.instance_segmentation.utils.relabel_utils import select_pairs, select_pairs_arrays, count_label_pairs
 
 
 def _compute_global_offsets(blocks_meta, start_gid=1):
@@ -45,52 +50,30 @@ def _compute_global_offsets(blocks_meta, start_gid=1):
     return offsets, cur
 
 
-def _pairs_for_overlaps(blocks_meta):
+def _pairs_for_overlaps(blocks_meta, mode="auto"):
     """
     List all pairs of blocks (i, j, ov_zyx, global_box_i, global_box_j) that intersect, where i < j.
     ov_zyx = (zz1, zz2, yy1, yy2, xx1, xx2)
+    mode: "auto"/"grid" (neighbor enumeration on the block grid, interval tree if irregular),
+          "interval" or "brute" (O(N^2))
     """
-    done = [b for b in blocks_meta if b.get("done", False)]
+    # Blocks skipped by the mask pre-pass (no path) hold no labels and pair with nothing
+    done = [b for b in blocks_meta if b.get("done", False) and b.get("path")]
     done.sort(key=lambda b: b["index"])
+    boxes = [tuple(b["coords"]) for b in done]
     pairs = []
-    #  Simple O(N^2); if there are many blocks, grid/index optimization can be used.
-    for a in range(len(done)):
-        i = done[a]["index"]
-        Ai = tuple(done[a]["coords"])
-        for b in range(a + 1, len(done)):
-            j = done[b]["index"]
-            Bj = tuple(done[b]["coords"])
-            ov = intersect_boxes_zyx(Ai, Bj)
-            if ov is None:
-                continue
-            pairs.append((i, j, ov, Ai, Bj))
+    for a, b, ov in overlapping_pairs_zyx(boxes, mode=mode):
+        pairs.append((done[a]["index"], done[b]["index"], ov, boxes[a], boxes[b]))
     return pairs
 
 
-def _overlap_union_task(
-    i, j, ov, Ai, Bj,
-    path_i, path_j,
-    offset_i, offset_j,
-    thresholds_pack
-):
+def _select_union_pairs(a, b, offset_i, offset_j, thresholds_pack):
     """
-    Child process task: Read two partitions in the overlap region, apply a global offset, count pairs, and select union pairs.
-    Return: [(gid_a, gid_b), ...] where gid_* is a globally unique ID with the offset already applied.
+    Apply global offsets to two aligned overlap arrays (zyx, uint32), count pairs, and select union pairs.
+    Return: [(gid_a, gid_b), ...]
     """
-    (zz1, zz2, yy1, yy2, xx1, xx2) = ov
-    (z1, z2, y1, y2, x1, x2) = Ai
-    (Z1, Z2, Y1, Y2, X1, X2) = Bj
-
     min_overlap_vox, min_frac_local, min_frac_global, max_voxel_size, require_recip, allow_union_amb, dom_ratio, min_iou = thresholds_pack
 
-    # Read both sides of the overlap (using CloudVolume's global slice: xyz)
-    vi = CloudVolume(path_i, mip=0, bounded=False, progress=False)
-    vj = CloudVolume(path_j, mip=0, bounded=False, progress=False)
-    a_xyz = vi[xx1:xx2, yy1:yy2, zz1:zz2][:, :, :, 0]
-    b_xyz = vj[xx1:xx2, yy1:yy2, zz1:zz2][:, :, :, 0]
-    a = np.transpose(a_xyz, (2, 1, 0)).astype(np.uint32, copy=False)  # zyx
-    b = np.transpose(b_xyz, (2, 1, 0)).astype(np.uint32, copy=False)
-
     # Global offset, ensuring cross-block uniqueness
     if offset_i:
         ai = a != 0
@@ -99,14 +82,12 @@ def _overlap_union_task(
         bj = b != 0
         b[bj] += np.uint32(offset_j)
 
-    pair_counts = {}
-    accumulate_local_global_pairs(a, b, pair_counts)
-
-    if not pair_counts:
+    la, gb, cnt = count_label_pairs(a, b)
+    if cnt.size == 0:
         return []
 
-    selected = select_pairs(
-        pair_counts=pair_counts,
+    selected = select_pairs_arrays(
+        la, gb, cnt,
         min_overlap_vox=min_overlap_vox,
         min_frac_local=min_frac_local,
         min_frac_global=min_frac_global,
@@ -121,16 +102,227 @@ def _overlap_union_task(
     return [(int(la), int(gb)) for (la, gb) in selected]
 
 
+def _read_box_zyx(path, box):
+    """Read a (z1,z2,y1,y2,x1,x2) box of a block volume as a zyx uint32 array"""
+    (z1, z2, y1, y2, x1, x2) = box
+    vol = CloudVolume(path, mip=0, bounded=False, progress=False)
+    xyz = vol[x1:x2, y1:y2, z1:z2][:, :, :, 0]
+    return np.transpose(xyz, (2, 1, 0)).astype(np.uint32, copy=False)
+
+
+def _overlap_union_task(
+    i, j, ov, Ai, Bj,
+    path_i, path_j,
+    offset_i, offset_j,
+    thresholds_pack,
+    telemetry_dir=None,
+):
+    """
+    Child process task: Read two partitions in the overlap region, apply a global offset, count pairs, and select union pairs.
+    With telemetry_dir, the pair's telemetry record is appended there.
+    Return: [(gid_a, gid_b), ...] where gid_* is a globally unique ID with the offset already applied.
+    """
+    start, phases = time.time(), {}
+    # Read both sides of the overlap (using CloudVolume's global slice: xyz)
+    with timed(phases, "read"):
+        a = _read_box_zyx(path_i, ov)
+        b = _read_box_zyx(path_j, ov)
+    nbytes = a.nbytes + b.nbytes
+    with timed(phases, "select"):
+        selected = _select_union_pairs(a, b, offset_i, offset_j, thresholds_pack)
+    if telemetry_dir is not None:
+        append_telemetry(telemetry_dir, task_record(
+            "merge-pools", (i, j), start, phases, bytes_read=nbytes, voxels=a.size, n_unions=len(selected)))
+    return selected
+
+
+# ---------- Cached pooling (each block border read once) ----------
+def _face_for_overlap(ov, box):
+    """
+    Face (axis, side) of `box` whose border slab contains the overlap box `ov`:
+    the thinnest axis along which ov touches the block border. side 0 = low, 1 = high.
+    Return None if ov does not touch any border (irregular layouts).
+    """
+    best = None
+    for d in range(3):
+        lo, hi = ov[2 * d], ov[2 * d + 1]
+        b1, b2 = box[2 * d], box[2 * d + 1]
+        if lo == b1 and hi == b2:
+            continue
+        if lo == b1:
+            side = 0
+        elif hi == b2:
+            side = 1
+        else:
+            continue
+        if best is None or hi - lo < best[0]:
+            best = (hi - lo, d, side)
+    return None if best is None else (best[1], best[2])
+
+
+def _plan_face_slabs(pairs):
+    """
+    For every block, the border slabs to read once: {index -> {face -> slab box}}, and
+    for every pair, the faces of i and j containing its overlap.
+    A face slab spans the full block along the two other axes, and along its own axis
+    the union of all overlaps assigned to it (this also covers edges and corners).
+    """
+    slabs = {}
+    pair_faces = []
+    for (i, j, ov, Ai, Bj) in pairs:
+        faces = []
+        for idx, box in ((i, Ai), (j, Bj)):
+            face = _face_for_overlap(ov, box)
+            if face is None:
+                face = ("box",) + tuple(ov)
+                slabs.setdefault(idx, {})[face] = tuple(ov)
+            else:
+                d = face[0]
+                cur = slabs.setdefault(idx, {}).get(face)
+                slab = list(box)
+                if cur is None:
+                    slab[2 * d], slab[2 * d + 1] = ov[2 * d], ov[2 * d + 1]
+                else:
+                    slab[2 * d] = min(cur[2 * d], ov[2 * d])
+                    slab[2 * d + 1] = max(cur[2 * d + 1], ov[2 * d + 1])
+                slabs[idx][face] = tuple(slab)
+            faces.append(face)
+        pair_faces.append(tuple(faces))
+    return slabs, pair_faces
+
+
+def _morton_key(cell):
+    """Interleave the bits of a (cz, cy, cx) cell index (Z-order curve)"""
+    key = 0
+    cz, cy, cx = (int(c) for c in cell)
+    for bit in range(21):
+        key |= ((cz >> bit) & 1) << (3 * bit + 2)
+        key |= ((cy >> bit) & 1) << (3 * bit + 1)
+        key |= ((cx >> bit) & 1) << (3 * bit)
+    return key
+
+
+def _locality_order(blocks_meta):
+    """Block indices in Z-order over the block grid (raster order if the grid is irregular)"""
+    done = sorted((b for b in blocks_meta if b.get("done", False)), key=lambda b: b["index"])
+    boxes = [tuple(b["coords"]) for b in done]
+    cells = grid_cells_zyx(boxes)
+    if cells is None:
+        cells = [(b[0], b[2], b[4]) for b in boxes]
+        keys = cells
+    else:
+        keys = [_morton_key(c) for c in cells]
+    order = sorted(range(len(done)), key=lambda k: keys[k])
+    return [done[k]["index"] for k in order]
+
+
+class _SlabLRU:
+    """Bounded (bytes) LRU cache of border slabs, keyed by (block index, face)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        value = loader()
+        self.items[key] = value
+        self.nbytes += value[1].nbytes
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            _, (_, old) = self.items.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return value
+
+
+def _crop_slab(slab_box, slab, ov):
+    """Crop the overlap box out of a cached slab (both in global zyx coordinates)"""
+    z0, y0, x0 = slab_box[0], slab_box[2], slab_box[4]
+    (zz1, zz2, yy1, yy2, xx1, xx2) = ov
+    return slab[zz1 - z0:zz2 - z0, yy1 - y0:yy2 - y0, xx1 - x0:xx2 - x0]
+
+
+def _cached_union_task(segment, block_slabs, paths, offsets, thresholds_pack, cache_bytes, telemetry_dir=None):
+    """
+    Child process task for one contiguous segment of the locality-aware walk.
+    segment: [(i, j, ov, face_i, face_j), ...] in walk order
+    Each block face slab is read once into an LRU and every pair statistic is computed from it.
+    With telemetry_dir, one record per pair is appended there (bytes_read: slabs read for that pair).
+    Return: ([(i, j, unions), ...], hits, misses)
+    """
+    cache = _SlabLRU(cache_bytes)
+    read_bytes = [0]
+
+    def slab_for(idx, face):
+        box = block_slabs[idx][face]
+
+        def load():
+            slab = _read_box_zyx(paths[idx], box)
+            read_bytes[0] += slab.nbytes
+            return box, slab
+        return cache.get((idx, face), load)
+
+    results = []
+    for (i, j, ov, face_i, face_j) in segment:
+        start, phases = time.time(), {}
+        before = read_bytes[0]
+        with timed(phases, "read"):
+            box_i, slab_i = slab_for(i, face_i)
+            box_j, slab_j = slab_for(j, face_j)
+        with timed(phases, "select"):
+            # Copies: offsets are applied in place and the slabs stay in the cache
+            a = _crop_slab(box_i, slab_i, ov).copy()
+            b = _crop_slab(box_j, slab_j, ov).copy()
+            selected = _select_union_pairs(a, b, offsets[i], offsets[j], thresholds_pack)
+        results.append((i, j, selected))
+        if telemetry_dir is not None:
+            append_telemetry(telemetry_dir, task_record(
+                "merge-pools", (i, j), start, phases, bytes_read=read_bytes[0] - before, voxels=a.size,
+                n_unions=len(selected)))
+    return results, cache.hits, cache.misses
+
+
+def _cached_segments(pairs, blocks_meta, n_segments):
+    """
+    Split the pairs into contiguous segments of the locality-aware block walk.
+    A pair is handled when the walk reaches the later of its two blocks.
+    Return: (segments, block_slabs)
+    """
+    order = _locality_order(blocks_meta)
+    rank = {idx: r for r, idx in enumerate(order)}
+    block_slabs, pair_faces = _plan_face_slabs(pairs)
+
+    items = []
+    for (i, j, ov, _Ai, _Bj), (face_i, face_j) in zip(pairs, pair_faces):
+        items.append((max(rank[i], rank[j]), (i, j, ov, face_i, face_j)))
+    items.sort(key=lambda t: t[0])
+
+    n_segments = max(1, min(int(n_segments), len(order)))
+    per_segment = int(math.ceil(len(order) / float(n_segments)))
+    segments = [[] for _ in range(n_segments)]
+    for r, item in items:
+        segments[min(r // per_segment, n_segments - 1)].append(item)
+    return [seg for seg in segments if seg], block_slabs
+
+
 def build_id_pools_parallel(global_cfg, stage_cfg, restart=False):
     """
     Phase 1:
     - Calculate global block offsets based on metadata (using max_id prefix sums)
     - Parallel traverse all intersecting block pairs, count overlaps, select pairs, and generate union pairs
-    - Write union pairs to merge_ckpt_dir/unions.txt (each line: “<a> <b>”),
+    - Append union pairs to merge_ckpt_dir/unions.bin (uint64 records "<a> <b>") and mark each
+        finished block pair in merge_ckpt_dir/pairs_done.bin, so an interrupted run resumes,
         and write merge_ckpt_dir/global_offsets.json
     """
     metadata_dir   = stage_cfg.get("metadata_dir", "./local_metadata")
     merge_ckpt_dir = global_cfg["checkpoint"]["merge_dir"]
+    telemetry_dir  = metadata_dir if telemetry_enabled(global_cfg) else None
 
     # Thresholds Package
     thresholds_pack = (
@@ -144,7 +336,8 @@ def build_id_pools_parallel(global_cfg, stage_cfg, restart=False):
         stage_cfg.get("min_iou", 0.7),
     )
 
-    # Read metadata
+    # Read metadata (fold the index log written by the segmentation shards into index.json first)
+    compact_index_meta(metadata_dir)
     index_data = load_index_meta(metadata_dir)
     blocks_meta = index_data.get("blocks", [])
     print(f"[INFO] Loaded metadata for {len(blocks_meta)} blocks")
@@ -156,39 +349,89 @@ def build_id_pools_parallel(global_cfg, stage_cfg, restart=False):
         json.dump({"offsets": offsets, "next_gid": next_gid}, f, indent=2)
 
     # List all intersecting block pairs
-    pairs = _pairs_for_overlaps(blocks_meta)
+    pairs = _pairs_for_overlaps(blocks_meta, mode=stage_cfg.get("pair_index", "auto"))
+
+    # Unions log (binary, append-only) with a per-pair completion index
+    if restart:
+        reset_unions_log(merge_ckpt_dir)
+    signature = hashlib.md5(json.dumps(offsets, sort_keys=True).encode("utf-8")).hexdigest()
+    unions_log = UnionsLog(merge_ckpt_dir, offsets_signature=signature)
+    unions_path = unions_log.path
+
     if not pairs:
         print("[INFO] No overlapping pairs found.")
-        # Still writing blank, unions.txt
-        open(os.path.join(merge_ckpt_dir, "unions.txt"), "w").close()
+        # Still leaves a blank unions log
+        unions_log.close()
         return
 
-    unions_path = os.path.join(merge_ckpt_dir, "unions.txt")
-    # Reset mode
-    if restart and os.path.exists(unions_path):
-        os.remove(unions_path)
+    done_pairs = load_done_pairs(merge_ckpt_dir)
+    if done_pairs:
+        pairs = [p for p in pairs if (p[0], p[1]) not in done_pairs]
+        print(f"[INFO] Resuming: {len(done_pairs)} pairs already done, {len(pairs)} pending.")
+    if not pairs:
+        unions_log.close()
+        print(f"[DONE] Pooling up-to-date. unions -> {unions_path}")
+        return
 
     workers = int(stage_cfg.get("workers", os.cpu_count() or 1))
-    print(f"[INFO] Overlap pairs: {len(pairs)}; dispatch with {workers} workers.")
+    pool_mode = stage_cfg.get("pool_mode", "pair")
+    print(f"[INFO] Overlap pairs: {len(pairs)}; dispatch with {workers} workers (pool_mode={pool_mode}).")
 
     # Create an ndex->path mapping
     path_by_idx = {b["index"]: b["path"] for b in blocks_meta if b.get("done", False)}
+
+    if pool_mode == "cached":
+        # Walk blocks in Z-order; each worker reads every block face slab of its segment once
+        blocks_per_segment = int(stage_cfg.get("blocks_per_segment", 64))
+        n_done = len(path_by_idx)
+        n_segments = max(workers, int(math.ceil(n_done / float(max(1, blocks_per_segment)))))
+        segments, block_slabs = _cached_segments(pairs, blocks_meta, n_segments)
+        cache_bytes = int(float(stage_cfg.get("cache_mb", 4096)) * 1024 * 1024)
+        hits = misses = 0
+        with ProcessPoolExecutor(max_workers=workers) as ex, unions_log:
+            futs = []
+            for seg in segments:
+                blocks_in_seg = {i for (i, j, *_rest) in seg} | {j for (i, j, *_rest) in seg}
+                futs.append(ex.submit(
+                    _cached_union_task,
+                    seg,
+                    {k: block_slabs[k] for k in blocks_in_seg},
+                    {k: path_by_idx[k] for k in blocks_in_seg},
+                    {k: int(offsets[k]) for k in blocks_in_seg},
+                    thresholds_pack,
+                    cache_bytes,
+                    telemetry_dir,
+                ))
+            for fut in tqdm(as_completed(futs), total=len(futs), desc="Pools Phase (cached segments)"):
+                try:
+                    results, h, m = fut.result()
+                    hits += h
+                    misses += m
+                    for i, j, pairs_sel in results:
+                        unions_log.append_pair(i, j, pairs_sel)
+                except Exception as e:
+                    print(f"[WARN] segment task failed: {e}")
+        print(f"[INFO] Slab cache: {misses} reads, {hits} hits over {len(pairs)} pairs.")
+        print(f"[DONE] Pooling finished. unions -> {unions_path}, offsets -> global_offsets.json")
+        return
+
     # Parallel processing
-    with ProcessPoolExecutor(max_workers=workers) as ex, open(unions_path, "a") as out:
-        futs = []
+    with ProcessPoolExecutor(max_workers=workers) as ex, unions_log:
+        futs = {}
         for (i, j, ov, Ai, Bj) in pairs:
-            futs.append(ex.submit(
+            futs[ex.submit(
                 _overlap_union_task,
                 i, j, ov, Ai, Bj,
                 path_by_idx[i], path_by_idx[j],
                 int(offsets[i]), int(offsets[j]),
-                thresholds_pack
-            ))
+                thresholds_pack,
+                telemetry_dir,
+            )] = (i, j)
         for fut in tqdm(as_completed(futs), total=len(futs), desc="Pools Phase (pairs)"):
             try:
                 pairs_sel = fut.result()
-                for a, b in pairs_sel:
-                    out.write(f"{a} {b}\n")
+                i, j = futs[fut]
+                unions_log.append_pair(i, j, pairs_sel)
             except Exception as e:
                 print(f"[WARN] pair task failed: {e}")
 
@@ -3,10 +3,10 @@ import numpy as np
 from tqdm import tqdm
 from cloudvolume import CloudVolume
 
-from magneton.instance_segmentation.utils.meta_utils import load_index_meta
+from magneton.instance_segmentation.utils.meta_utils import load_index_meta, compact_index_meta
 from magneton.instance_segmentation.utils.relabel_utils import (
     accumulate_local_global_pairs, update_id_pools,
-    build_rep_map_from_pools, relabel_array_inplace_with_map
+    build_rep_map_from_pools, relabel_array_inplace_with_map, lookup_table_from_map
 )
 from magneton.instance_segmentation.state.checkpoint import load_merge_state, save_merge_state
 from magneton.instance_segmentation.utils.io_utils import export_tif_from_volume
@@ -16,7 +16,7 @@ def merge_local_blocks(global_cfg, stage_cfg,
                        restart=False, force_overlap_identity=False):
     """
     Execute merge stage:
-    - Read block information from local_metadata/index.json
+    - Read block information from local_metadata (index.json + index log)
     - Merge per-block segmentation into the global CloudVolume
     - Resolve cross-block overlaps using ID pools
     """
@@ -56,7 +56,8 @@ def merge_local_blocks(global_cfg, stage_cfg,
     out_vol.commit_info()
     out_vol.commit_provenance()
 
-    # Read metadata
+    # Read metadata (fold the index log written by the segmentation shards into index.json first)
+    compact_index_meta(metadata_dir)
     index_data = load_index_meta(metadata_dir)
     blocks_meta = index_data.get("blocks", [])
     print(f"[INFO] Loaded metadata for {len(blocks_meta)} blocks")
@@ -82,9 +83,13 @@ def merge_local_blocks(global_cfg, stage_cfg,
             in_path = blk["path"]
 
             try:
-                local_vol = CloudVolume(in_path, mip=0, bounded=False, progress=False)
-                seg_local = local_vol[:][:,:,:,0]
-                seg_local = np.transpose(seg_local, (2, 1, 0))  # (z,y,x)
+                if in_path is None:
+                    # Empty block (mask pre-pass): background only
+                    seg_local = np.zeros((z2 - z1, y2 - y1, x2 - x1), dtype=np.uint32)
+                else:
+                    local_vol = CloudVolume(in_path, mip=0, bounded=False, progress=False)
+                    seg_local = local_vol[:][:,:,:,0]
+                    seg_local = np.transpose(seg_local, (2, 1, 0))  # (z,y,x)
             except Exception as e:
                 raise RuntimeError(f"Failed to read local block {i} at {in_path}: {e}")
 
@@ -114,13 +119,14 @@ def merge_local_blocks(global_cfg, stage_cfg,
     final_rep_map = build_rep_map_from_pools(id_pools)
     if final_rep_map:
         print(f"[INFO] Applying final relabel with {len(final_rep_map)} entries...")
+        rep_lut = lookup_table_from_map(final_rep_map, next_gid)
         for blk in tqdm(blocks_meta, desc="FinalRelabel"):
             if not blk.get("done", False):
                 continue
             z1, z2, y1, y2, x1, x2 = blk["coords"]
             seg_blk = out_vol[x1:x2, y1:y2, z1:z2][:, :, :, 0]
             seg_blk = np.transpose(seg_blk, (2, 1, 0))
-            relabel_array_inplace_with_map(seg_blk, final_rep_map)
+            relabel_array_inplace_with_map(seg_blk, rep_lut)
             seg_xyz = np.transpose(seg_blk, (2, 1, 0))
             out_vol[x1:x2, y1:y2, z1:z2] = seg_xyz[:, :, :, np.newaxis]
     else:
@@ -0,0 +1,91 @@
+import os
+import time
+from tqdm import tqdm
+from cloudvolume import CloudVolume
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from magneton.instance_segmentation.waterz_block import replay_merge_history
+from magneton.instance_segmentation.utils.io_utils import load_block_history, write_block_output
+from magneton.instance_segmentation.utils.meta_utils import load_index_meta, save_block_meta, compact_index_meta
+from magneton.instance_segmentation.utils.telemetry import (
+    timed, task_record, append_telemetry, telemetry_enabled, worker_id,
+)
+
+
+def _rethreshold_block(i, coords, history_dir, threshold, out_path, resolution, chunk_size, crop=None) -> dict:
+    """Replay one block's merge history up to threshold and write it to its own CloudVolume"""
+    start, phases = time.time(), {}
+    with timed(phases, "read"):
+        fragments, merges = load_block_history(history_dir, i)
+    with timed(phases, "replay"):
+        seg_local = replay_merge_history(fragments, merges, threshold)
+    with timed(phases, "write"):
+        block_meta = write_block_output(out_path, seg_local, coords, resolution, chunk_size, crop=crop)
+    block_meta["telemetry"] = dict(start=start, phases=phases, bytes_read=int(fragments.nbytes + merges.nbytes),
+                                   bytes_written=int(seg_local.nbytes), voxels=int(seg_local.size),
+                                   n_supervoxels=int(fragments.max()), n_merges=int(len(merges)),
+                                   worker=worker_id())
+    block_meta["index"] = i
+    if crop is not None:
+        block_meta["crop"] = list(crop)
+    block_meta["threshold"] = float(threshold)
+    return block_meta
+
+
+def rethreshold_blocks(global_cfg, stage_cfg, threshold=None):
+    """
+    Execute rethreshold stage:
+    - Read the blocks of the segmentation metadata (saved with history.enable)
+    - Replay each block's merge history up to the new threshold (no watershed/agglomeration)
+    - Output per-block CloudVolume and metadata, ready for merge-pools/merge-apply
+      (point merge_stage.metadata_dir at the rethreshold metadata_dir)
+    """
+    input_path = global_cfg["paths"]["input"]
+    output_local_base = global_cfg["paths"]["output_local_base"]
+    seg_metadata_dir = stage_cfg.get("metadata_dir", "./local_metadata")
+    mip = stage_cfg.get("mip", 0)
+
+    re_cfg = stage_cfg.get("rethreshold", {}) or {}
+    threshold = float(threshold if threshold is not None else re_cfg.get("threshold", 0.5))
+    out_base = re_cfg.get("output_local_base") or f"{output_local_base}_r{threshold:g}"
+    metadata_dir = re_cfg.get("metadata_dir") or f"{seg_metadata_dir}_r{threshold:g}"
+    workers = int(re_cfg.get("workers") or stage_cfg.get("workers", os.cpu_count() or 1))
+    telemetry = telemetry_enabled(global_cfg)
+
+    aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
+    resolution, chunk_size = aff_vol.resolution, aff_vol.chunk_size
+
+    blocks = sorted(load_index_meta(seg_metadata_dir)["blocks"], key=lambda b: b["index"])
+    # Blocks skipped by the mask pre-pass carry over unchanged
+    empty = [b for b in blocks if b.get("path") is None]
+    for b in empty:
+        save_block_meta(metadata_dir, b)
+    tasks = [b for b in blocks if b.get("history")]
+    if len(tasks) < len(blocks) - len(empty):
+        print(f"[WARN] {len(blocks) - len(empty) - len(tasks)} blocks have no merge history "
+              f"(segment them with segmentation_stage.history.enable); skipped.")
+    if not tasks:
+        print("[INFO] No blocks with merge history. Nothing to rethreshold.")
+        return
+    beyond = [b["index"] for b in tasks if threshold > b["history"]["max_threshold"]]
+    if beyond:
+        print(f"[WARN] Threshold {threshold:g} is above the recorded history of {len(beyond)} blocks; "
+              f"they stop at their max_threshold (raise history.max_threshold and re-segment).")
+
+    print(f"[INFO] Rethresholding {len(tasks)} blocks at {threshold:g} with {workers} workers -> {out_base}")
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures = [
+            ex.submit(_rethreshold_block, b["index"], tuple(b["coords"]), b["history"]["dir"], threshold,
+                      f"{out_base}_{b['index']}", resolution, chunk_size, b.get("crop"))
+            for b in tasks
+        ]
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Rethreshold Blocks"):
+            block_meta = fut.result()
+            record = block_meta.pop("telemetry")
+            with timed(record["phases"], "metadata"):
+                save_block_meta(metadata_dir, block_meta)
+            if telemetry:
+                append_telemetry(metadata_dir, task_record("rethreshold", block_meta["index"], **record))
+
+    compact_index_meta(metadata_dir)
+    print(f"[DONE] Rethreshold stage finished. Metadata at {metadata_dir}")
@@ -1,14 +1,40 @@
 import os
 import gc
+import time
+import threading
 import numpy as np
 from tqdm import tqdm
 from cloudvolume import CloudVolume
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from magneton.instance_segmentation.waterz_block import run_waterz_block
-from magneton.instance_segmentation.utils.block_utils import generate_blocks_zyx
-from magneton.instance_segmentation.state.checkpoint import mark_local_done, is_local_done
-from magneton.instance_segmentation.utils.meta_utils import save_block_meta
+from magneton.instance_segmentation.waterz_block import run_waterz_block, prebuild_waterz
+from magneton.instance_segmentation.utils.block_utils import blocks_from_config, box_voxels, read_mask_summary
+from magneton.instance_segmentation.state.checkpoint import mark_local_done, load_local_done
+from magneton.instance_segmentation.utils.meta_utils import save_block_meta, compact_index_meta
+from magneton.instance_segmentation.utils.io_utils import save_block_history, write_block_output
+from magneton.instance_segmentation.utils.pipeline_utils import run_block_pipeline, report_utilization
+from magneton.instance_segmentation.utils.shm_utils import SharedBlockPool, attach_shared
+from magneton.instance_segmentation.utils.telemetry import (
+    timed, task_record, append_telemetry, telemetry_enabled, worker_id,
+)
+
+def warmup_waterz(stage_cfg):
+    """
+    Pre-build the waterz agglomeration modules named in the stage config
+    (merge_function plus optional warmup_merge_functions), so that workers
+    only load the cached modules instead of compiling them per block.
+    """
+    merge_functions = [stage_cfg.get("merge_function", 'aff50_his256')]
+    merge_functions += list(stage_cfg.get("warmup_merge_functions", []))
+    built = prebuild_waterz(
+        merge_functions,
+        discretize_queue=stage_cfg.get("discretize_queue", 256),
+        cache_dir=stage_cfg.get("waterz_cache_dir", None),
+    )
+    for mf, module_name in built.items():
+        print(f"[INFO] waterz module ready: {mf} -> {module_name}")
+    return built
+
 
 def segmentation_blocks(global_cfg, stage_cfg, restart=False):
     """
@@ -24,20 +50,27 @@ def segmentation_blocks(global_cfg, stage_cfg, restart=False):
     mask_path   = global_cfg["mask"]["path"]
     output_local_base = global_cfg["paths"]["output_local_base"]
 
-    block_size  = tuple(global_cfg["block"]["size"])
-    overlap     = tuple(global_cfg["block"]["overlap"])
-
     local_ckpt_dir = global_cfg["checkpoint"]["segmentation_dir"]
     metadata_dir   = stage_cfg.get("metadata_dir", "./local_metadata")
     mip            = stage_cfg.get("mip", 0)
 
     thresholds     = stage_cfg.get("thresholds", [0.4])
     aff_thresholds = stage_cfg.get("aff_thresholds", [0.00001, 0.99999])
-    sv_type        = stage_cfg.get("sv_type", "3d")
+    sv_type        = stage_cfg.get("sv_type", stage_cfg.get("supervoxel", "3d"))
     interior_thr   = stage_cfg.get("interior_thr", 0.1)
     min_distance   = stage_cfg.get("min_distance", 3)
     sv_2d          = stage_cfg.get("sv_2d", 'maxima_distance')
     merge_function = stage_cfg.get("merge_function", 'aff50_his256' )
+    discretize_queue = stage_cfg.get("discretize_queue", 256)
+    waterz_cache_dir = stage_cfg.get("waterz_cache_dir", None)
+    memory_lean    = stage_cfg.get("memory_lean", False)
+    history_dir    = _history_dir(stage_cfg)
+    history_thr    = (stage_cfg.get("history", {}) or {}).get("max_threshold", None)
+    seed_method    = stage_cfg.get("seed_method", "peak_local_max")
+    seed_sampling  = stage_cfg.get("seed_sampling", None)
+    sv_2d_workers  = int(stage_cfg.get("sv_2d_workers", 1))
+    sv_2d_executor = stage_cfg.get("sv_2d_executor", "thread")
+    telemetry      = telemetry_enabled(global_cfg)
 
     # Open the volume input
     aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
@@ -49,7 +82,8 @@ def segmentation_blocks(global_cfg, stage_cfg, restart=False):
     vol_shape_zyx = (vol_size_xyz[2], vol_size_xyz[1], vol_size_xyz[0])
 
     # Generate blocks
-    blocks = generate_blocks_zyx(vol_shape_zyx, block_size, overlap)
+    chunk_zyx = tuple(int(c) for c in aff_vol.chunk_size)[::-1]
+    blocks = blocks_from_config(global_cfg, vol_shape_zyx, chunk_zyx, verbose=True)
 
     if restart:
         print(f"[INFO] Restart mode: clearing local checkpoints and metadata at {local_ckpt_dir}, {metadata_dir}")
@@ -60,59 +94,247 @@ def segmentation_blocks(global_cfg, stage_cfg, restart=False):
             for fn in os.listdir(metadata_dir):
                 os.remove(os.path.join(metadata_dir, fn))
 
+    # Skip completed blocks; with a mask, skip empty blocks and crop the others to the mask
+    def _finish_empty(block_meta):
+        mark_local_done(local_ckpt_dir, block_meta["index"])
+        save_block_meta(metadata_dir, block_meta)
+
+    done = load_local_done(local_ckpt_dir)
+    pending = [(i, coords) for i, coords in enumerate(blocks) if i not in done]
+    pending, plans = _mask_prepass(global_cfg, mip, blocks, pending, _finish_empty)
+
     # Traverse block
-    for i, (z1, z2, y1, y2, x1, x2) in enumerate(tqdm(blocks, desc="Local Blocks")):
+    for i, (z1, z2, y1, y2, x1, x2) in tqdm(pending, desc="Local Blocks"):
         out_path = f"{output_local_base}_{i}"
-        on_disk = out_path.replace("file://", "")
-
-        # Skip completed blocks
-        if is_local_done(local_ckpt_dir, i):
-            continue
+        occupancy, crop = plans.get(i, (None, None))
+        (rz1, rz2, ry1, ry2, rx1, rx2) = crop or (z1, z2, y1, y2, x1, x2)
+        start, phases = time.time(), {}
 
         # Read sub-block affinity
-        aff = aff_vol[x1:x2, y1:y2, z1:z2]
-        aff = np.transpose(aff, (3, 2, 1, 0))   # (c, z, y, x)
-        if mask_flag:
-            mask = mask_vol[x1:x2, y1:y2, z1:z2]
-            mask = np.transpose(mask, (3, 2, 1, 0))[0] > 0
-        else:
-            mask = None
-        # Run segmentation
-        seg_local = run_waterz_block(aff, mask=mask, 
+        with timed(phases, "read"):
+            aff = aff_vol[rx1:rx2, ry1:ry2, rz1:rz2]
+            aff = np.transpose(aff, (3, 2, 1, 0))   # (c, z, y, x)
+            if mask_flag:
+                mask = mask_vol[rx1:rx2, ry1:ry2, rz1:rz2]
+                mask = np.transpose(mask, (3, 2, 1, 0))[0] > 0
+            else:
+                mask = None
+        bytes_read = aff.nbytes + (mask.nbytes if mask is not None else 0)
+        # Run segmentation; extra thresholds stream to their own layers as they are produced
+        stats = {}
+        history = {} if history_dir else None
+        on_threshold, layers = _threshold_writer(i, (z1, z2, y1, y2, x1, x2), output_local_base,
+                                                 aff_vol.resolution, aff_vol.chunk_size, thresholds, crop=crop)
+        seg_local = run_waterz_block(aff, mask=mask, on_threshold=on_threshold,
                                      seg_thresholds=thresholds, aff_thresholds=aff_thresholds, 
                                      sv_type=sv_type, interior_thr=interior_thr, min_distance=min_distance,
-                                     sv_2d=sv_2d, merge_function=merge_function)
-        seg_xyz = np.transpose(seg_local, (2, 1, 0))
-
-        # Write CloudVolume
-        vol_size_block = (x2 - x1, y2 - y1, z2 - z1)
-        seg_info = CloudVolume.create_new_info(
-            num_channels=1, layer_type="segmentation", data_type="uint32", encoding="raw",
-            resolution=aff_vol.resolution, voxel_offset=[int(x1), int(y1), int(z1)],
-            volume_size=list(map(int, vol_size_block)), chunk_size=aff_vol.chunk_size,
-        )
-        out_local = CloudVolume(out_path, info=seg_info, compress=False,
-                                progress=False, non_aligned_writes=True)
-        out_local.commit_info()
-        out_local.commit_provenance()
-        out_local[:, :, :] = seg_xyz[:, :, :, np.newaxis]
-
-        # Mark checkpoint
-        mark_local_done(local_ckpt_dir, i)
-
-        # Save metadata
-        block_meta = {
-            "index": i,
-            "coords": [z1, z2, y1, y2, x1, x2],
-            "path": out_path,
-            "done": True,
-            "max_id": int(seg_local.max())
-        }
+                                     sv_2d=sv_2d, merge_function=merge_function,
+                                     discretize_queue=discretize_queue, waterz_cache_dir=waterz_cache_dir,
+                                     memory_lean=memory_lean, stats=stats, history=history,
+                                     history_threshold=history_thr,
+                                     seed_method=seed_method, seed_sampling=seed_sampling,
+                                     sv_2d_workers=sv_2d_workers, sv_2d_executor=sv_2d_executor)
+        with timed(phases, "history"):
+            history_meta = _save_history(i, history_dir, history)
+
+        # Write CloudVolume, save metadata, mark checkpoint
+        coords = (z1, z2, y1, y2, x1, x2)
+        with timed(phases, "write"):
+            block_meta = write_block_output(out_path, seg_local, coords, aff_vol.resolution, aff_vol.chunk_size,
+                                            crop=crop)
+        block_meta["index"] = i
+        block_meta["peak_rss_mb"] = round(stats["peak_rss_mb"], 1)
+        _attach_mask_plan(block_meta, occupancy, crop)
+        _attach_threshold_layers(block_meta, thresholds, layers)
+        _attach_history(block_meta, history_meta)
+        stats["time_history"] = phases.pop("history")
+        block_meta["telemetry"] = _block_telemetry(start, phases, stats, bytes_read,
+                                                   box_voxels(coords) * 4 * (1 + len(layers)))
+        _finish_block(block_meta, metadata_dir, local_ckpt_dir, telemetry)
+
+        print(f"[INFO] Finished block {i}, max_id={block_meta['max_id']}, "
+              f"peak RSS {block_meta['peak_rss_mb']:.0f} MB, saved at {out_path}")
+
+    compact_index_meta(metadata_dir)
+    print("[DONE] Local stage finished.")
+
+
+def _seg_kwargs(stage_cfg) -> dict:
+    """run_waterz_block keyword arguments from the stage config"""
+    return dict(
+        seg_thresholds=stage_cfg.get("thresholds", [0.4]),
+        aff_thresholds=stage_cfg.get("aff_thresholds", [0.00001, 0.99999]),
+        sv_type=stage_cfg.get("sv_type", stage_cfg.get("supervoxel", "3d")),
+        interior_thr=stage_cfg.get("interior_thr", 0.1),
+        min_distance=stage_cfg.get("min_distance", 3),
+        sv_2d=stage_cfg.get("sv_2d", 'maxima_distance'),
+        merge_function=stage_cfg.get("merge_function", 'aff50_his256'),
+        discretize_queue=stage_cfg.get("discretize_queue", 256),
+        waterz_cache_dir=stage_cfg.get("waterz_cache_dir", None),
+        memory_lean=stage_cfg.get("memory_lean", False),
+        history_threshold=(stage_cfg.get("history", {}) or {}).get("max_threshold", None),
+        seed_method=stage_cfg.get("seed_method", "peak_local_max"),
+        seed_sampling=stage_cfg.get("seed_sampling", None),
+        sv_2d_workers=int(stage_cfg.get("sv_2d_workers", 1)),
+        sv_2d_executor=stage_cfg.get("sv_2d_executor", "thread"),
+    )
+
+
+def _history_dir(stage_cfg):
+    """Merge-history directory when history.enable is set, else None"""
+    hist_cfg = stage_cfg.get("history", {}) or {}
+    if not hist_cfg.get("enable", False):
+        return None
+    return hist_cfg.get("dir", "./merge_history")
+
+
+def _save_history(i, history_dir, history):
+    """Persist a block's fragments + merge history filled by run_waterz_block; return its metadata"""
+    if history_dir is None or not history:
+        return None
+    save_block_history(history_dir, i, history["fragments"], history["merges"])
+    return {"dir": history_dir, "max_threshold": float(history["max_threshold"]),
+            "n_merges": int(len(history["merges"]))}
+
+
+def _attach_history(block_meta, history_meta):
+    if history_meta is not None:
+        block_meta["history"] = history_meta
+    return block_meta
+
+
+def _block_telemetry(start, phases, stats, bytes_read, bytes_written) -> dict:
+    """
+    Partial telemetry record of a segmented block: phases (read/write, seconds) merged with the
+    run_waterz_block timings in stats; _finish_block completes and appends it
+    """
+    compute = {
+        "supervoxel": stats.get("time_supervoxel", 0.0),
+        "agglomerate": stats.get("time_agglomerate", 0.0),
+        "write_thresholds": stats.get("time_on_threshold", 0.0),
+        "history": stats.get("time_history", 0.0),
+    }
+    ordered = {"read": phases.get("read", 0.0)}
+    ordered.update(compute)
+    ordered.update({k: v for k, v in phases.items() if k != "read"})
+    return dict(start=start, phases=ordered, worker=stats.get("worker") or worker_id(),
+                bytes_read=int(bytes_read), bytes_written=int(bytes_written),
+                peak_rss_mb=round(stats.get("peak_rss_mb", 0.0), 1),
+                n_supervoxels=stats.get("n_supervoxels"), n_edges=stats.get("n_edges"))
+
+
+def _finish_block(block_meta, metadata_dir, local_ckpt_dir, telemetry=True):
+    """Save a finished block's metadata and checkpoint, then append its telemetry record"""
+    record = block_meta.pop("telemetry", None)
+    phases = {}
+    with timed(phases, "metadata"):
         save_block_meta(metadata_dir, block_meta)
+        mark_local_done(local_ckpt_dir, block_meta["index"])
+    if telemetry and record is not None:
+        record["phases"].update(phases)
+        record["voxels"] = box_voxels(block_meta.get("crop") or block_meta["coords"])
+        append_telemetry(metadata_dir, task_record("segmentation", block_meta["index"], **record))
 
-        print(f"[INFO] Finished block {i}, max_id={block_meta['max_id']}, saved at {out_path}")
 
-    print("[DONE] Local stage finished.")
+def _empty_block_meta(i, coords) -> dict:
+    """Metadata of a block with no masked voxels: done, nothing written, no ids"""
+    return {"index": i, "coords": list(coords), "path": None, "done": True, "max_id": 0,
+            "mask_occupancy": 0.0}
+
+
+def _mask_prepass(global_cfg, mip, blocks, tasks, finish_empty):
+    """
+    Apply the mask summary to the pending (i, coords) tasks: empty blocks are handed to
+    finish_empty as done with max_id=0 (mask.summary.skip_empty), partially occupied ones get
+    the bounding box of the mask to read and segment (mask.summary.crop).
+    Returns: (remaining tasks, {i: (occupancy, crop or None)})
+    """
+    summary = read_mask_summary(global_cfg, mip, blocks)
+    if summary is None:
+        return tasks, {}
+    sum_cfg = global_cfg["mask"].get("summary", {}) or {}
+    skip_empty = sum_cfg.get("skip_empty", True)
+    do_crop = sum_cfg.get("crop", True)
+
+    remaining, plans = [], {}
+    n_empty = n_crop = 0
+    read_vox = full_vox = 0
+    for i, coords in tasks:
+        occupancy, crop = summary[i]
+        if crop is None and skip_empty:
+            finish_empty(_empty_block_meta(i, coords))
+            n_empty += 1
+            continue
+        if not do_crop or crop is None or tuple(crop) == tuple(coords):
+            crop = None
+        else:
+            n_crop += 1
+        plans[i] = (occupancy, crop)
+        remaining.append((i, coords))
+        full_vox += box_voxels(coords)
+        read_vox += box_voxels(crop or coords)
+    if n_empty or n_crop:
+        print(f"[INFO] Mask pre-pass: {n_empty} empty blocks skipped, {n_crop} blocks cropped "
+              f"({100.0 * read_vox / max(1, full_vox):.1f}% of the remaining block voxels read)")
+    return remaining, plans
+
+
+def _attach_mask_plan(block_meta, occupancy, crop):
+    """Record the mask occupancy and the crop box (if any) a block was segmented with"""
+    if occupancy is not None:
+        block_meta["mask_occupancy"] = round(float(occupancy), 4)
+    if crop is not None:
+        block_meta["crop"] = list(crop)
+    return block_meta
+
+
+def _read_block_inputs(aff_vol, mask_vol, coords):
+    """Read the affinity (c, z, y, x) and optional mask (z, y, x) of one block"""
+    (z1, z2, y1, y2, x1, x2) = coords
+    aff = aff_vol[x1:x2, y1:y2, z1:z2]
+    aff = np.transpose(aff, (3, 2, 1, 0))  # (c, z, y, x)
+    mask = None
+    if mask_vol is not None:
+        mask = mask_vol[x1:x2, y1:y2, z1:z2]
+        mask = np.transpose(mask, (3, 2, 1, 0))[0] > 0
+    return aff, mask
+
+
+def threshold_block_path(output_local_base: str, i: int, threshold: float) -> str:
+    """Per-block output path of an additional (non-primary) agglomeration threshold"""
+    return f"{output_local_base}_t{float(threshold):g}_{i}"
+
+
+def _threshold_writer(i, coords, output_local_base, resolution, chunk_size, thresholds, crop=None):
+    """
+    on_threshold callback for run_waterz_block: the lowest threshold is the block's primary
+    output (returned and written by the caller); every higher threshold is written to its
+    own CloudVolume as soon as the agglomeration pass reaches it, then dropped.
+    Segmentations of a crop box (crop) are padded back to the block.
+    Returns: (callback or None, {threshold: {"path", "max_id"}} filled by the callback)
+    """
+    layers = {}
+    if len(thresholds) < 2:
+        return None, layers
+    primary = min(thresholds)
+
+    def on_threshold(thr, seg):
+        if thr == primary:
+            return
+        path = threshold_block_path(output_local_base, i, thr)
+        meta = write_block_output(path, seg, coords, resolution, chunk_size, crop=crop)
+        layers[f"{float(thr):g}"] = {"path": path, "max_id": meta["max_id"]}
+
+    return on_threshold, layers
+
+
+def _attach_threshold_layers(block_meta, thresholds, layers):
+    """Record every threshold layer of a block (primary included) under block_meta["thresholds"]"""
+    if len(thresholds) < 2:
+        return block_meta
+    primary = {f"{float(min(thresholds)):g}": {"path": block_meta["path"], "max_id": block_meta["max_id"]}}
+    block_meta["thresholds"] = {**primary, **layers}
+    return block_meta
 
 
 def _process_block(
@@ -125,68 +347,204 @@ def _process_block(
     output_local_base: str,
     mip: int,
     stage_cfg,
+    plan=(None, None),
 ) -> dict:
-    """Process a single block in an independent process; return block_meta (without writing to metadata/index.json)"""
-    (z1, z2, y1, y2, x1, x2) = coords
+    """
+    Process a single block in an independent process; return block_meta (metadata is saved by the caller).
+    plan: (mask occupancy, crop box) from the mask pre-pass; only the crop box is read and segmented
+    """
+    occupancy, crop = plan
     out_path = f"{output_local_base}_{i}"
+    start, phases = time.time(), {}
 
     # Open input volume (in-process isolated instance to prevent handle sharing)
-    aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
-    aff = aff_vol[x1:x2, y1:y2, z1:z2]
-    aff = np.transpose(aff, (3, 2, 1, 0))  # (c, z, y, x)
-    
-    thresholds     = stage_cfg.get("thresholds", [0.4])
-    aff_thresholds = stage_cfg.get("aff_thresholds", [0.00001, 0.99999])
-    sv_type        = stage_cfg.get("sv_type", "3d")
-    interior_thr   = stage_cfg.get("interior_thr", 0.1)
-    min_distance   = stage_cfg.get("min_distance", 3)
-    sv_2d          = stage_cfg.get("sv_2d", 'maxima_distance')
-    merge_function = stage_cfg.get("merge_function", 'aff50_his256' )
+    with timed(phases, "read"):
+        aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
+        mask_vol = CloudVolume(mask_path, mip=mip, bounded=False, progress=False) if mask_flag else None
+        aff, mask = _read_block_inputs(aff_vol, mask_vol, crop or coords)
+    bytes_read = aff.nbytes + (mask.nbytes if mask is not None else 0)
+
+    # Segmentation (higher thresholds are written as they are produced)
+    seg_kwargs = _seg_kwargs(stage_cfg)
+    on_threshold, layers = _threshold_writer(i, coords, output_local_base, aff_vol.resolution,
+                                             aff_vol.chunk_size, seg_kwargs["seg_thresholds"], crop=crop)
+    history_dir = _history_dir(stage_cfg)
+    history = {} if history_dir else None
+    stats = {}
+    seg_local = run_waterz_block(aff, mask=mask, stats=stats, on_threshold=on_threshold,
+                                 history=history, **seg_kwargs)
+    t0 = time.perf_counter()
+    history_meta = _save_history(i, history_dir, history)
+    stats["time_history"] = time.perf_counter() - t0
 
-    # Optional: mask
-    mask = None
-    if mask_flag:
-        mask_vol = CloudVolume(mask_path, mip=mip, bounded=False, progress=False)
-        mask = mask_vol[x1:x2, y1:y2, z1:z2]
-        mask = np.transpose(mask, (3, 2, 1, 0))[0] > 0
+    # Write to this CloudVolume block
+    with timed(phases, "write"):
+        block_meta = write_block_output(out_path, seg_local, coords, aff_vol.resolution, aff_vol.chunk_size,
+                                         crop=crop)
+    block_meta["index"] = i
+    block_meta["peak_rss_mb"] = round(stats["peak_rss_mb"], 1)
+    _attach_mask_plan(block_meta, occupancy, crop)
+    _attach_threshold_layers(block_meta, seg_kwargs["seg_thresholds"], layers)
+    _attach_history(block_meta, history_meta)
+    block_meta["telemetry"] = _block_telemetry(start, phases, stats, bytes_read,
+                                               box_voxels(coords) * 4 * (1 + len(layers)))
+
+    del aff, seg_local, history
+    gc.collect()
 
-    # Segmentation
-    seg_local = run_waterz_block(aff, mask=mask, seg_thresholds=thresholds, aff_thresholds=aff_thresholds, 
-                                    sv_type=sv_type, interior_thr=interior_thr, min_distance=min_distance,
-                                    sv_2d=sv_2d, merge_function=merge_function)
-    seg_xyz = np.transpose(seg_local, (2, 1, 0))  # (x,y,z)
+    # Return metadata (written uniformly by the main process to metadata & checkpoint to avoid concurrent contention);
+    # its "telemetry" entry is popped by _finish_block
+    return block_meta
+
+
+def _segment_block(i: int, inputs, seg_kwargs: dict, out_info, history_dir=None):
+    """
+    Pipeline compute step (worker process): (coords, crop, aff, mask) -> (uint32 segmentation, stats).
+    Higher thresholds are written from the worker (out_info: output base, resolution, chunk size)
+    and listed in stats["thresholds"]; the merge history, if enabled, is saved here too.
+    """
+    coords, crop, aff, mask = inputs
+    on_threshold, layers = _threshold_writer(i, coords, *out_info, seg_kwargs["seg_thresholds"], crop=crop)
+    history = {} if history_dir else None
+    stats = {}
+    seg_local = run_waterz_block(aff, mask=mask, stats=stats, on_threshold=on_threshold,
+                                 history=history, **seg_kwargs)
+    stats["thresholds"] = layers
+    t0 = time.perf_counter()
+    stats["history"] = _save_history(i, history_dir, history)
+    stats["time_history"] = time.perf_counter() - t0
+    stats["worker"] = worker_id()
+    del aff, mask
+    gc.collect()
+    return seg_local, stats
 
-    # Write to this CloudVolume block
-    vol_size_block = (x2 - x1, y2 - y1, z2 - z1)
-    seg_info = CloudVolume.create_new_info(
-        num_channels=1,
-        layer_type="segmentation",
-        data_type="uint32",
-        encoding="raw",
-        resolution=aff_vol.resolution,
-        voxel_offset=[int(x1), int(y1), int(z1)],
-        volume_size=list(map(int, vol_size_block)),
-        chunk_size=aff_vol.chunk_size,
-    )
-    out_local = CloudVolume(
-        out_path, info=seg_info, compress=False, progress=False, non_aligned_writes=True
-    )
-    out_local.commit_info()
-    out_local.commit_provenance()
-    out_local[:, :, :] = seg_xyz[:, :, :, np.newaxis]
 
-    max_id = int(seg_local.max())
-    del aff, seg_local, seg_xyz
+def _segment_block_shared(i: int, refs, seg_kwargs: dict, out_info, history_dir=None):
+    """
+    Pipeline compute step with shared-memory buffers: attach the affinity/mask segments
+    zero-copy, segment, and store the uint32 result in the preallocated output segment.
+    Returns: (None, stats), the segmentation being in the output segment
+    """
+    coords, crop, aff_ref, mask_ref, out_ref = refs
+    on_threshold, layers = _threshold_writer(i, coords, *out_info, seg_kwargs["seg_thresholds"], crop=crop)
+    history = {} if history_dir else None
+    handles = []
+    aff, shm = attach_shared(aff_ref)
+    handles.append(shm)
+    mask = None
+    if mask_ref is not None:
+        mask, shm = attach_shared(mask_ref)
+        handles.append(shm)
+    out, shm = attach_shared(out_ref)
+    handles.append(shm)
+    stats = {}
+    try:
+        seg_local = run_waterz_block(aff, mask=mask, stats=stats, on_threshold=on_threshold,
+                                     history=history, **seg_kwargs)
+        out[...] = seg_local
+        stats["thresholds"] = layers
+        t0 = time.perf_counter()
+        stats["history"] = _save_history(i, history_dir, history)
+        stats["time_history"] = time.perf_counter() - t0
+        stats["worker"] = worker_id()
+    finally:
+        del aff, mask, out
+        for shm in handles:
+            shm.close()
     gc.collect()
+    return None, stats
 
-    # Return metadata (written uniformly by the main process to metadata & checkpoint to avoid concurrent contention)
-    return {
-        "index": i,
-        "coords": [z1, z2, y1, y2, x1, x2],
-        "path": out_path,
-        "done": True,
-        "max_id": max_id,
-    }
+
+def _segmentation_pipeline(tasks, *, input_path, mask_flag, mask_path, output_local_base,
+                           mip, stage_cfg, workers, on_done, progress=None, plans=None):
+    """
+    Prefetching executor: reader threads read the next blocks ahead into a bounded queue,
+    worker processes segment them, writer threads write the results.
+    With pipeline.shared_memory, blocks travel as shared-memory segments instead of pickles.
+    plans: {i: (mask occupancy, crop box)} from the mask pre-pass
+    """
+    plans = plans or {}
+    pipe_cfg = stage_cfg.get("pipeline", {}) or {}
+    read_workers = int(pipe_cfg.get("read_workers", 2))
+    write_workers = int(pipe_cfg.get("write_workers", 2))
+    prefetch_depth = int(pipe_cfg.get("prefetch_depth", 2))
+    memory_cap_gb = pipe_cfg.get("memory_cap_gb", None)
+    use_shm = bool(pipe_cfg.get("shared_memory", True))
+
+    aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
+    resolution, chunk_size = aff_vol.resolution, aff_vol.chunk_size
+    itemsize = np.dtype(aff_vol.dtype).itemsize * int(aff_vol.num_channels)
+    local = threading.local()
+    seg_kwargs = _seg_kwargs(stage_cfg)
+    thresholds = seg_kwargs["seg_thresholds"]
+
+    pool = SharedBlockPool() if use_shm else None
+    out_refs = {}
+    reads = {}  # i -> (start, read seconds, bytes read)
+
+    def read_fn(i, coords):
+        # One CloudVolume handle per reader thread
+        if not hasattr(local, "aff_vol"):
+            local.aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
+            local.mask_vol = CloudVolume(mask_path, mip=mip, bounded=False, progress=False) if mask_flag else None
+        crop = plans.get(i, (None, None))[1]
+        start = time.time()
+        t0 = time.perf_counter()
+        aff, mask = _read_block_inputs(local.aff_vol, local.mask_vol, crop or coords)
+        reads[i] = (start, time.perf_counter() - t0, aff.nbytes + (mask.nbytes if mask is not None else 0))
+        if pool is None:
+            return coords, crop, aff, mask
+        # Decode straight into shared segments (the transpose copy lands in shared memory),
+        # and reserve the output segment the worker fills in
+        aff_ref = pool.put(aff, owner=i)
+        mask_ref = pool.put(mask, owner=i) if mask is not None else None
+        out_ref, _ = pool.alloc(aff.shape[1:], np.uint32, owner=i)
+        out_refs[i] = out_ref
+        return coords, crop, aff_ref, mask_ref, out_ref
+
+    def write_fn(i, coords, result):
+        # result: (segmentation, stats); the segmentation is None when it sits in the output segment
+        seg_local, stats = result
+        if seg_local is None:
+            seg_local = pool.view(out_refs[i])
+        occupancy, crop = plans.get(i, (None, None))
+        phases = {}
+        with timed(phases, "write"):
+            block_meta = write_block_output(f"{output_local_base}_{i}", seg_local, coords, resolution,
+                                             chunk_size, crop=crop)
+        block_meta["index"] = i
+        block_meta["peak_rss_mb"] = round(stats["peak_rss_mb"], 1)
+        _attach_mask_plan(block_meta, occupancy, crop)
+        _attach_threshold_layers(block_meta, thresholds, stats.get("thresholds", {}))
+        _attach_history(block_meta, stats.get("history"))
+        start, phases["read"], bytes_read = reads.pop(i, (time.time(), 0.0, 0))
+        block_meta["telemetry"] = _block_telemetry(
+            start, phases, stats, bytes_read, box_voxels(coords) * 4 * (1 + len(stats.get("thresholds", {}))))
+        return block_meta
+
+    def nbytes_fn(i, coords):
+        return box_voxels(plans.get(i, (None, None))[1] or coords) * itemsize
+
+    def _release(i):
+        out_refs.pop(i, None)
+        pool.release_owner(i)
+
+    try:
+        timers = run_block_pipeline(
+            tasks, read_fn, _segment_block if pool is None else _segment_block_shared, write_fn, on_done,
+            workers=workers, read_workers=read_workers, write_workers=write_workers,
+            prefetch_depth=prefetch_depth,
+            memory_cap_bytes=float(memory_cap_gb) * 1024 ** 3 if memory_cap_gb else None,
+            nbytes_fn=nbytes_fn,
+            compute_args=(seg_kwargs, (output_local_base, resolution, chunk_size), _history_dir(stage_cfg)),
+            cleanup_fn=_release if pool is not None else None, progress=progress,
+        )
+        if pool is not None:
+            print(f"[INFO] Shared block pool peak: {pool.nbytes / 1024 ** 2:.0f} MB")
+    finally:
+        if pool is not None:
+            pool.close()
+    report_utilization(timers)
 
 
 def segmentation_blocks_parallel(global_cfg, stage_cfg, restart=False):
@@ -195,21 +553,19 @@ def segmentation_blocks_parallel(global_cfg, stage_cfg, restart=False):
     - Partition large-volume affinity into chunks
     - Run `run_waterz_block` in parallel for each chunk
     - Output per-block CloudVolume
-    - Write metadata and checkpoint via master process (to avoid contention for concurrent writes to `index.json`)
+    - Write metadata and checkpoint via master process, then compact the metadata index log
     """
     input_path = global_cfg["paths"]["input"]
     mask_flag = global_cfg["mask"]["flag"]
     mask_path = global_cfg["mask"]["path"]
     output_local_base = global_cfg["paths"]["output_local_base"]
 
-    block_size = tuple(global_cfg["block"]["size"])
-    overlap = tuple(global_cfg["block"]["overlap"])
-
     local_ckpt_dir = global_cfg["checkpoint"]["segmentation_dir"]
     metadata_dir = stage_cfg.get("metadata_dir", "./local_metadata")
     # thresholds = stage_cfg.get("thresholds", [0.4])
     mip = stage_cfg.get("mip", 0)
     workers = int(stage_cfg.get("workers", os.cpu_count() or 1))
+    telemetry = telemetry_enabled(global_cfg)
 
     # Open input volume (main process used only for retrieving shape/meta information)
     aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
@@ -217,7 +573,8 @@ def segmentation_blocks_parallel(global_cfg, stage_cfg, restart=False):
     vol_shape_zyx = (vol_size_xyz[2], vol_size_xyz[1], vol_size_xyz[0])
 
     # Generated in blocks
-    blocks = generate_blocks_zyx(vol_shape_zyx, block_size, overlap)
+    chunk_zyx = tuple(int(c) for c in aff_vol.chunk_size)[::-1]
+    blocks = blocks_from_config(global_cfg, vol_shape_zyx, chunk_zyx, verbose=True)
 
     # Restart
     if restart:
@@ -231,17 +588,50 @@ def segmentation_blocks_parallel(global_cfg, stage_cfg, restart=False):
                 
     #  Filter out completed blocks
     tasks = []
+    done = load_local_done(local_ckpt_dir)
     for i, coords in enumerate(blocks):
-        if is_local_done(local_ckpt_dir, i):
+        if i in done:
             continue
         tasks.append((i, coords))
 
+    # Mask pre-pass: empty blocks finish right here, partially occupied ones are cropped
+    def _finish_empty(block_meta):
+        save_block_meta(metadata_dir, block_meta)
+        mark_local_done(local_ckpt_dir, block_meta["index"])
+
+    tasks, plans = _mask_prepass(global_cfg, mip, blocks, tasks, _finish_empty)
+
     if not tasks:
         print("[INFO] No pending blocks. Local stage up-to-date.")
         return
 
+    # Compile waterz once in the main process; workers reuse the cached module
+    warmup_waterz(stage_cfg)
+
     print(f"[INFO] Dispatching {len(tasks)} blocks with {workers} workers...")
 
+    def _finish(block_meta):
+        # Metadata, checkpoints and telemetry are written by the master process as blocks complete
+        _finish_block(block_meta, metadata_dir, local_ckpt_dir, telemetry)
+        print(
+            f"[INFO] Finished block {block_meta['index']}, "
+            f"max_id={block_meta['max_id']}, peak RSS {block_meta.get('peak_rss_mb', 0):.0f} MB, "
+            f"saved at {block_meta['path']}"
+        )
+
+    # Pipelined processing: prefetch reads, segment in workers, write in background threads
+    if (stage_cfg.get("pipeline", {}) or {}).get("enable", True):
+        with tqdm(total=len(tasks), desc="Local Blocks (pipeline)") as pbar:
+            _segmentation_pipeline(
+                tasks, input_path=input_path, mask_flag=mask_flag, mask_path=mask_path,
+                output_local_base=output_local_base, mip=mip, stage_cfg=stage_cfg,
+                workers=workers, on_done=lambda i, block_meta: _finish(block_meta), progress=pbar,
+                plans=plans,
+            )
+        compact_index_meta(metadata_dir)
+        print("[DONE] Local stage finished (parallel).")
+        return
+
     # Parallel processing
     futures = []
     with ProcessPoolExecutor(max_workers=workers) as ex:
@@ -256,21 +646,17 @@ def segmentation_blocks_parallel(global_cfg, stage_cfg, restart=False):
                     mask_path=mask_path,
                     output_local_base=output_local_base,
                     mip=mip,
-                    stage_cfg=stage_cfg
+                    stage_cfg=stage_cfg,
+                    plan=plans.get(i, (None, None)),
                 )
             )
 
         for fut in tqdm(as_completed(futures), total=len(futures), desc="Local Blocks (parallel)"):
             try:
                 block_meta = fut.result()  # If a single block encounters an exception, it will be thrown here to facilitate troubleshooting.
-                # Write metadata and checkpoints sequentially to avoid concurrent write contention on index.json.
-                save_block_meta(metadata_dir, block_meta)
-                mark_local_done(local_ckpt_dir, block_meta["index"])
-                print(
-                    f"[INFO] Finished block {block_meta['index']}, "
-                    f"max_id={block_meta['max_id']}, saved at {block_meta['path']}"
-                )
+                _finish(block_meta)
             except KeyboardInterrupt:
                 break
 
+    compact_index_meta(metadata_dir)
     print("[DONE] Local stage finished (parallel).")
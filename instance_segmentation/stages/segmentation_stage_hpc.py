@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import math
 import json
 import subprocess
 from pathlib import Path
 
 from magneton.instance_segmentation.config import load_config, load_global_config_path
-from magneton.instance_segmentation.utils.block_utils import generate_blocks_zyx
-from cloudvolume import CloudVolume
+from magneton.instance_segmentation.utils.block_utils import blocks_for_volume
+from magneton.instance_segmentation.state.checkpoint import load_local_done
+from magneton.instance_segmentation.state.work_queue import BlockQueue
+from magneton.instance_segmentation.stages.segmentation_stage import warmup_waterz
+from magneton.instance_segmentation.stages.hpc_sizing import plan_size_classes
+from magneton.instance_segmentation.tools.local_array import run_local_array
 
 
 def _ensure_dir(p: str):
@@ -15,27 +20,14 @@ def _ensure_dir(p: str):
 
 
 def _pending_block_indices(cfg, restart=False):
-    """Compute all blocks and filter out completed blocks (depending on checkpoints/local/*.done)"""
-    input_path = cfg["paths"]["input"]
-    mip = cfg.get("local_stage", {}).get("mip", 0)
-
-    aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
-    vol_size_xyz = tuple(aff_vol.info["scales"][0]["size"])
-    vol_shape_zyx = (vol_size_xyz[2], vol_size_xyz[1], vol_size_xyz[0])
-
-    block_size = tuple(cfg["block"]["size"])
-    overlap = tuple(cfg["block"]["overlap"])
-    blocks = generate_blocks_zyx(vol_shape_zyx, block_size, overlap)
+    """Compute all blocks and filter out completed blocks (one bulk read of the segmentation checkpoint)"""
+    blocks = blocks_for_volume(cfg)
 
     local_ckpt_dir = cfg["checkpoint"]["segmentation_dir"]
     os.makedirs(local_ckpt_dir, exist_ok=True)
 
-    pending = []
-    for i, _coords in enumerate(blocks):
-        done_flag = os.path.join(local_ckpt_dir, f"block_{i:04d}.done")
-        if not os.path.exists(done_flag) or restart:
-            pending.append(i)
-    return pending
+    done = load_local_done(local_ckpt_dir)
+    return [i for i in range(len(blocks)) if (i not in done) or restart]
 
 
 def _write_manifest(job_dir: str, indices, blocks_per_job: int):
@@ -52,10 +44,40 @@ def _write_manifest(job_dir: str, indices, blocks_per_job: int):
     return manifest, len(chunks)
 
 
-def _slurm_script(cfg, stage_cfg, job_dir, array_len):
-    hpc = stage_cfg["hpc"]
+def _shard_lines(stage_cfg, job_dir, python_bin, queue_dir=None):
+    """Script lines running one array task: its manifest line, or the shared block queue"""
+    workers_per_job = int(stage_cfg["hpc"].get("workers_per_job", 2))
+    manifest = os.path.join(job_dir, "manifest.txt")
+    global_cfgs = load_global_config_path("magneton/config.yaml")
+    # global_cfgs = cfg
+    # cfg_path = global_cfgs.get("instance_segmentation/mian", "magneton/instance_segmentation/configs/config.yaml")
+    cfg_path = (
+        global_cfgs.get("instance_segmentation", {})
+                .get("mian", "magneton/instance_segmentation/configs/config.yaml")
+    )
+    if queue_dir:
+        # Every array task leases blocks from the shared queue until it is drained
+        return [
+            "set -e",
+            f'echo \"Running shard on queue: {queue_dir}\"',
+            f"{python_bin} -m magneton.instance_segmentation.tools.run_local_shard "
+            f"--config {cfg_path} --queue {queue_dir} --workers {workers_per_job} --debug"
+        ]
+    return [
+        "set -e",
+        f"INDICES=$(sed -n \"$((SLURM_ARRAY_TASK_ID+1))p\" {manifest})",
+        f'echo \"Running shard indices: $INDICES\"',
+
+        # Run the locally parallel scripts within each job (which will parse indices and run on a single node using ProcessPool).
+        f"{python_bin} -m magneton.instance_segmentation.tools.run_local_shard "
+        f"--config {cfg_path} --indices \"$INDICES\" --workers {workers_per_job} --debug"
+    ]
+
+
+def _slurm_script(cfg, stage_cfg, job_dir, array_len, queue_dir=None, resources=None):
+    """resources: per-array overrides of hpc time / mem (per cpu) / cpus (size classes)"""
+    hpc = {**stage_cfg["hpc"], **(resources or {})}
     python_bin = hpc.get("python_bin", "python")
-    workers_per_job = int(hpc.get("workers_per_job", 2))
     time = hpc.get("time", "04:00:00")
     mem = hpc.get("mem", "16G")
     cpus = hpc.get("cpus", "8")
@@ -97,23 +119,24 @@ def _slurm_script(cfg, stage_cfg, job_dir, array_len):
     if env:         lines.append(f"conda activate {env}")
     if work_path:   lines.append(f"cd {work_path}")
 
-    manifest = os.path.join(job_dir, "manifest.txt")
-    global_cfgs = load_global_config_path("magneton/config.yaml")
-    # global_cfgs = cfg
-    # cfg_path = global_cfgs.get("instance_segmentation/mian", "magneton/instance_segmentation/configs/config.yaml")
-    cfg_path = (
-        global_cfgs.get("instance_segmentation", {})
-                .get("mian", "magneton/instance_segmentation/configs/config.yaml")
-    )
-    lines += [
-        "set -e",
-        f"INDICES=$(sed -n \"$((SLURM_ARRAY_TASK_ID+1))p\" {manifest})",
-        f'echo \"Running shard indices: $INDICES\"',
+    lines += _shard_lines(stage_cfg, job_dir, python_bin, queue_dir)
 
-        # Run the locally parallel scripts within each job (which will parse indices and run on a single node using ProcessPool).
-        f"{python_bin} -m magneton.instance_segmentation.tools.run_local_shard "
-        f"--config {cfg_path} --indices \"$INDICES\" --workers {workers_per_job} --debug"
-    ]
+    with open(script_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(script_path, 0o755)
+    return script_path
+
+
+def _local_script(cfg, stage_cfg, job_dir, queue_dir=None):
+    """Array task script for the local scheduler: the Slurm task body without the SBATCH/module/conda lines"""
+    hpc = stage_cfg["hpc"]
+    python_bin = (hpc.get("local", {}) or {}).get("python_bin") or sys.executable
+    work_path = hpc.get("work_path", None)
+
+    script_path = os.path.join(job_dir, "submit_local.sh")
+    lines = ["#!/bin/bash"]
+    if work_path:   lines.append(f"cd {work_path}")
+    lines += _shard_lines(stage_cfg, job_dir, python_bin, queue_dir)
 
     with open(script_path, "w") as f:
         f.write("\n".join(lines) + "\n")
@@ -141,13 +164,76 @@ def submit_local_hpc(global_cfg, stage_cfg, restart=False, dry_run=False):
         print("[INFO] No pending blocks (or all completed).")
         return
 
-    manifest, n_chunks = _write_manifest(job_dir, pending, blocks_per_job)
+    # Adaptive sizing: one job array per block size class, with its own resources and blocks per task
+    if (hpc.get("sizing", {}) or {}).get("enable", False):
+        arrays = plan_size_classes(global_cfg, stage_cfg, blocks_for_volume(global_cfg), pending)
+        for arr in arrays:
+            arr["job_dir"] = os.path.join(job_dir, f"class_{arr['cls']}")
+            print(f"[INFO] Size class {arr['cls']}: {len(arr['indices'])} blocks, max work {arr['work_max']:.1f}, "
+                  f"{arr['blocks_per_job']} blocks/task, mem {arr['mem']}/cpu, time {arr['time']} ({arr['source']})")
+        _ensure_dir(job_dir)
+        with open(os.path.join(job_dir, "sizing.json"), "w") as f:
+            json.dump([dict({k: v for k, v in arr.items() if k != "indices"}, n_blocks=len(arr["indices"]))
+                       for arr in arrays], f, indent=2)
+    else:
+        arrays = [{"job_dir": job_dir, "indices": pending, "blocks_per_job": blocks_per_job}]
+
+    # Pre-build waterz modules into the (shared) cache so array tasks do not compile
+    if hpc.get("warmup", True) and not dry_run:
+        warmup_waterz(stage_cfg)
+
+    results = []
+    for arr in arrays:
+        results += _submit_array(global_cfg, stage_cfg, arr, scheduler, dry_run, reset_queue=restart) or []
+    return results if scheduler == "local" and not dry_run else None
+
+
+def _submit_array(global_cfg, stage_cfg, arr, scheduler, dry_run=False, reset_queue=False):
+    """
+    Write the manifest (or block queue) and script of one job array, then submit or run it.
+    reset_queue: clear the block queue (leases of running shards, failed blocks) before adding
+    """
+    hpc = stage_cfg.get("hpc", {})
+    job_dir = arr["job_dir"]
+    pending = arr["indices"]
+    resources = {k: arr[k] for k in ("time", "mem", "cpus") if k in arr}
+
+    manifest, n_chunks = _write_manifest(job_dir, pending, arr["blocks_per_job"])
     print(f"[INFO] {len(pending)} blocks pending processing, manifest: {manifest}, estimated to generate {n_chunks} jobs.")
 
+    # Work-stealing mode: array tasks lease blocks from a file queue instead of fixed manifest lines
+    q_cfg = hpc.get("queue", {}) or {}
+    queue_dir = None
+    if q_cfg.get("enable", False):
+        queue_dir = os.path.abspath(q_cfg.get("dir") or os.path.join(job_dir, "queue"))
+        if "cls" in arr and q_cfg.get("dir"):
+            queue_dir = os.path.join(queue_dir, f"class_{arr['cls']}")
+        queue = BlockQueue(queue_dir, max_attempts=int(q_cfg.get("max_attempts", 3)))
+        added = queue.populate(pending, reset=reset_queue or bool(q_cfg.get("reset", False)))
+        n_chunks = int(q_cfg.get("array_tasks") or n_chunks)
+        print(f"[INFO] Block queue: {queue_dir} ({added} blocks added, {len(queue)} queued or leased, "
+              f"{len(queue.failed())} failed; {n_chunks} array tasks)")
+
     # Generate Script
     if scheduler == "slurm":
-        script_path = _slurm_script(global_cfg, stage_cfg, job_dir, n_chunks)
+        script_path = _slurm_script(global_cfg, stage_cfg, job_dir, n_chunks, queue_dir=queue_dir,
+                                    resources=resources)
         submit_cmd = ["sbatch", script_path]
+    elif scheduler == "local":
+        # Run the array tasks as local subprocesses (testing/benchmarking the HPC path on one machine)
+        script_path = _local_script(global_cfg, stage_cfg, job_dir, queue_dir=queue_dir)
+        local = hpc.get("local", {}) or {}
+        concurrency = int(local.get("concurrency") or hpc.get("hpc_num", 1))
+        print(f"[INFO] Local scheduler: {n_chunks} array tasks of {script_path}, concurrency {concurrency}")
+        if dry_run:
+            return None
+        return run_local_array(
+            script_path, n_chunks, concurrency=concurrency, log_dir=os.path.join(job_dir, "logs"),
+            job_name="segmentation_chunks", cpus=resources.get("cpus", hpc.get("cpus", 1)),
+            fail_tasks=local.get("fail_tasks", []) or [], fail_rate=float(local.get("fail_rate", 0.0)),
+            kill_after_s=local.get("kill_after_s", None), slow_tasks=local.get("slow_tasks", []) or [],
+            slow_s=float(local.get("slow_s", 0.0)), seed=int(local.get("seed", 0)),
+        )
     else:
         raise ValueError(f"Unknown scheduler: {scheduler}")
 
@@ -160,6 +246,7 @@ def submit_local_hpc(global_cfg, stage_cfg, restart=False, dry_run=False):
         except Exception as e:
             print(f"[WARN] Submission failed:{e}")
             print(f"[HINT] You can manually execute the command:{' '.join(submit_cmd)}")
+    return None
 
 def segmentation_blocks_hpc(global_cfg, stage_cfg, restart=False, dry_run=False):
-    submit_local_hpc(global_cfg, stage_cfg, restart=restart, dry_run=dry_run)
+    return submit_local_hpc(global_cfg, stage_cfg, restart=restart, dry_run=dry_run)
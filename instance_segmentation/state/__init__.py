@@ -4,13 +4,29 @@ state: checkpoint/state management
 """
 from .checkpoint import (
     load_merge_state, save_merge_state,
-    local_done_path, mark_local_done, is_local_done,
+    done_log_path, local_done_path, mark_local_done, load_local_done, is_local_done,
+    merge_done_path, mark_merge_done, load_merge_done, is_merge_done, reset_merge_done,
+    UnionsLog, load_done_pairs, load_unions_array, reset_unions_log,
 )
+from .work_queue import BlockQueue, LeaseRenewer
 
 __all__ = [
     "load_merge_state",
     "save_merge_state",
+    "done_log_path",
     "local_done_path",
     "mark_local_done",
+    "load_local_done",
     "is_local_done",
+    "merge_done_path",
+    "mark_merge_done",
+    "load_merge_done",
+    "is_merge_done",
+    "reset_merge_done",
+    "UnionsLog",
+    "load_done_pairs",
+    "load_unions_array",
+    "reset_unions_log",
+    "BlockQueue",
+    "LeaseRenewer",
 ]
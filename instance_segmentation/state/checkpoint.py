@@ -1,5 +1,6 @@
 import os
 import json
+import numpy as np
 
 # ---------- General Tools ----------
 def _load_json(path, default=None):
@@ -18,19 +19,54 @@ def _save_json(path, state: dict):
         json.dump(state, f, indent=2)
     os.replace(tmp, path)
 
+# ---------- Block completion sets ----------
+# Finished block indices of a checkpoint folder are appended to <folder>/done.bin as uint64
+# records, one O_APPEND write each, so concurrent processes (HPC shards) can mark blocks.
+# Loading reads the whole set at once; legacy block_XXXX.done flags are folded in with a
+# single os.scandir, instead of one stat per block.
+DONE_LOG = "done.bin"
+
+def done_log_path(folder: str) -> str:
+    return os.path.join(folder, DONE_LOG)
+
+def _mark_done(folder: str, i: int):
+    os.makedirs(folder, exist_ok=True)
+    fd = os.open(done_log_path(folder), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, np.asarray([i], dtype=np.uint64).tobytes())
+    finally:
+        os.close(fd)
+
+def _load_done(folder: str) -> set:
+    if not os.path.isdir(folder):
+        return set()
+    done = set(_read_records(done_log_path(folder), 1)[:, 0].tolist())
+    with os.scandir(folder) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith("block_") and name.endswith(".done"):
+                try:
+                    done.add(int(name[6:-5]))
+                except ValueError:
+                    pass
+    return done
+
 # ---------- Segmentation stage ----------
 def local_done_path(local_ckpt_dir: str, i: int) -> str:
-    """Return the path to the .done file in the local checkpoint"""
+    """Return the path to the legacy .done file in the local checkpoint"""
     return os.path.join(local_ckpt_dir, f"block_{i:04d}.done")
 
 def mark_local_done(local_ckpt_dir: str, i: int):
     """Mark a block as completed"""
-    os.makedirs(local_ckpt_dir, exist_ok=True)
-    open(local_done_path(local_ckpt_dir, i), "w").close()
+    _mark_done(local_ckpt_dir, i)
+
+def load_local_done(local_ckpt_dir: str) -> set:
+    """Set of completed block indices"""
+    return _load_done(local_ckpt_dir)
 
 def is_local_done(local_ckpt_dir: str, i: int) -> bool:
-    """Check whether a block is complete"""
-    return os.path.exists(local_done_path(local_ckpt_dir, i))
+    """Check whether a block is complete (use load_local_done when checking many blocks)"""
+    return i in load_local_done(local_ckpt_dir)
 
 # ---------- Merge stage ----------
 def load_merge_state(merge_ckpt_dir: str):
@@ -42,3 +78,129 @@ def save_merge_state(merge_ckpt_dir: str, state: dict):
     """Save merge state (state.json)"""
     state_path = os.path.join(merge_ckpt_dir, "state.json")
     _save_json(state_path, state)
+
+def merge_done_path(merge_ckpt_dir: str, i: int) -> str:
+    """Return the path to the legacy .done file of a block written by merge-apply"""
+    return os.path.join(merge_ckpt_dir, "applied", f"block_{i:04d}.done")
+
+def mark_merge_done(merge_ckpt_dir: str, i: int):
+    """Mark a block as relabeled and written to the global volume"""
+    _mark_done(os.path.join(merge_ckpt_dir, "applied"), i)
+
+def load_merge_done(merge_ckpt_dir: str) -> set:
+    """Set of block indices written by merge-apply"""
+    return _load_done(os.path.join(merge_ckpt_dir, "applied"))
+
+def is_merge_done(merge_ckpt_dir: str, i: int) -> bool:
+    """Check whether a block has been written by merge-apply (use load_merge_done when checking many blocks)"""
+    return i in load_merge_done(merge_ckpt_dir)
+
+def reset_merge_done(merge_ckpt_dir: str):
+    """Remove all merge-apply block completion flags"""
+    applied_dir = os.path.join(merge_ckpt_dir, "applied")
+    if os.path.isdir(applied_dir):
+        for name in os.listdir(applied_dir):
+            if name.endswith(".done") or name == DONE_LOG:
+                os.remove(os.path.join(applied_dir, name))
+
+# ---------- Merge stage: unions log ----------
+# Binary, append-only record files in merge_ckpt_dir:
+#   unions.bin      uint64 records (gid_a, gid_b), memory-mappable as an (N, 2) array
+#   pairs_done.bin  uint64 records (i, j, n_unions), one per finished block pair
+#   unions_meta.json  offsets signature the records were produced with
+# A pair is appended to unions.bin first and marked done afterwards, so an interrupted
+# run only re-processes unfinished pairs (possible duplicate unions are harmless).
+UNION_RECORD = 2
+DONE_RECORD = 3
+
+def unions_bin_path(merge_ckpt_dir: str) -> str:
+    return os.path.join(merge_ckpt_dir, "unions.bin")
+
+def pairs_done_path(merge_ckpt_dir: str) -> str:
+    return os.path.join(merge_ckpt_dir, "pairs_done.bin")
+
+def _unions_meta_path(merge_ckpt_dir: str) -> str:
+    return os.path.join(merge_ckpt_dir, "unions_meta.json")
+
+def _read_records(path: str, width: int, mmap: bool = False) -> np.ndarray:
+    """Read complete uint64 records of `width` values (a torn tail record is ignored)"""
+    if not os.path.exists(path):
+        return np.zeros((0, width), dtype=np.uint64)
+    n = os.path.getsize(path) // (8 * width)
+    if n == 0:
+        return np.zeros((0, width), dtype=np.uint64)
+    if mmap:
+        return np.memmap(path, dtype=np.uint64, mode="r", shape=(n, width))
+    return np.fromfile(path, dtype=np.uint64, count=n * width).reshape(n, width)
+
+def _truncate_to_records(path: str, width: int):
+    if os.path.exists(path):
+        size = os.path.getsize(path)
+        rec = 8 * width
+        if size % rec:
+            with open(path, "r+b") as f:
+                f.truncate(size - size % rec)
+
+def reset_unions_log(merge_ckpt_dir: str):
+    """Remove the unions log, completion index and legacy unions.txt"""
+    for p in (unions_bin_path(merge_ckpt_dir), pairs_done_path(merge_ckpt_dir),
+              _unions_meta_path(merge_ckpt_dir), os.path.join(merge_ckpt_dir, "unions.txt")):
+        if os.path.exists(p):
+            os.remove(p)
+
+def load_done_pairs(merge_ckpt_dir: str) -> set:
+    """Set of finished (i, j) block pairs"""
+    done = _read_records(pairs_done_path(merge_ckpt_dir), DONE_RECORD)
+    return set(zip(done[:, 0].tolist(), done[:, 1].tolist()))
+
+def load_unions_array(merge_ckpt_dir: str, mmap: bool = True) -> np.ndarray:
+    """All union pairs as an (N, 2) uint64 array (memory-mapped by default)"""
+    return _read_records(unions_bin_path(merge_ckpt_dir), UNION_RECORD, mmap=mmap)
+
+class UnionsLog:
+    """
+    Single-writer appender for the unions log (used by the merge-pools main process).
+    Opening validates the offsets signature: records produced with different global
+    offsets are discarded, since their global IDs would no longer be valid.
+    """
+
+    def __init__(self, merge_ckpt_dir: str, offsets_signature: str = None):
+        self.merge_ckpt_dir = merge_ckpt_dir
+        os.makedirs(merge_ckpt_dir, exist_ok=True)
+        meta = _load_json(_unions_meta_path(merge_ckpt_dir), default={})
+        if meta.get("offsets_signature") != offsets_signature:
+            if os.path.exists(pairs_done_path(merge_ckpt_dir)):
+                print("[WARN] Global offsets changed since the last run; discarding recorded unions.")
+            reset_unions_log(merge_ckpt_dir)
+            _save_json(_unions_meta_path(merge_ckpt_dir), {"offsets_signature": offsets_signature})
+        _truncate_to_records(unions_bin_path(merge_ckpt_dir), UNION_RECORD)
+        _truncate_to_records(pairs_done_path(merge_ckpt_dir), DONE_RECORD)
+        self.path = unions_bin_path(merge_ckpt_dir)
+        self._unions = open(self.path, "ab")
+        self._done = open(pairs_done_path(merge_ckpt_dir), "ab")
+
+    def append_pair(self, i: int, j: int, unions):
+        """Append the unions of block pair (i, j), then mark the pair done"""
+        arr = np.asarray(unions, dtype=np.uint64).reshape(-1, UNION_RECORD)
+        if arr.size:
+            self._unions.write(arr.tobytes())
+            self._unions.flush()
+        self._done.write(np.asarray([i, j, arr.shape[0]], dtype=np.uint64).tobytes())
+        self._done.flush()
+
+    def close(self):
+        for f in (self._unions, self._done):
+            if f.closed:
+                continue
+            try:
+                os.fsync(f.fileno())
+            except OSError:
+                pass
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,151 @@
+import os
+import time
+import random
+import threading
+
+# ---------- Block work queue ----------
+# File-backed lease queue of block indices, the same scheme as the igneous fq:// TaskQueue:
+#   <queue_dir>/queue/<expires>--<index>--<attempts>   one file per queued or leased block
+#   <queue_dir>/failed/<index>--<attempts>             blocks that exhausted max_attempts
+# A worker leases a block by renaming its file to a future expiry time; rename is atomic, so
+# exactly one worker wins. Leases of killed workers expire and are taken over by others.
+# Completed blocks are removed from the queue (their completion is tracked by the checkpoint).
+
+
+def _task_name(expires: float, i: int, attempts: int) -> str:
+    return f"{int(expires):012d}--{i:08d}--{attempts}"
+
+
+def _parse_name(name: str):
+    expires, i, attempts = name.split("--")
+    return int(expires), int(i), int(attempts)
+
+
+class BlockQueue:
+    """
+    Lease-based queue of block indices shared by the shard workers of an HPC job array.
+    Tokens returned by lease/renew are the current file names of the leased blocks.
+    """
+
+    def __init__(self, queue_dir: str, max_attempts: int = 3):
+        self.queue_dir = queue_dir
+        self.max_attempts = int(max_attempts)
+        self._queue = os.path.join(queue_dir, "queue")
+        self._failed = os.path.join(queue_dir, "failed")
+        os.makedirs(self._queue, exist_ok=True)
+        os.makedirs(self._failed, exist_ok=True)
+
+    def populate(self, indices, reset: bool = False) -> int:
+        """
+        Add the indices that have no queue entry yet; queued and leased blocks (shards still
+        running) and failed blocks are kept. reset=True clears the queue and failed/ first.
+        Returns: number of blocks added
+        """
+        if reset:
+            for folder in (self._queue, self._failed):
+                for name in os.listdir(folder):
+                    os.remove(os.path.join(folder, name))
+        present = set(self.indices()) | set(self.failed())
+        added = 0
+        for i in indices:
+            if int(i) in present:
+                continue
+            open(os.path.join(self._queue, _task_name(0, int(i), 0)), "w").close()
+            added += 1
+        return added
+
+    def indices(self) -> list:
+        """Block indices still queued or leased"""
+        return sorted(_parse_name(n)[1] for n in os.listdir(self._queue))
+
+    def failed(self) -> list:
+        """Block indices that exhausted max_attempts"""
+        return sorted(int(n.split("--")[0]) for n in os.listdir(self._failed))
+
+    def __len__(self):
+        return len(os.listdir(self._queue))
+
+    def lease(self, seconds: float):
+        """
+        Lease an available block (never leased, released, or with an expired lease) for seconds.
+        Returns: (index, token), or None when no block is available right now
+        """
+        now = time.time()
+        names = sorted(n for n in os.listdir(self._queue) if _parse_name(n)[0] <= now)
+        # Randomize among the first candidates so concurrent workers rarely race for one file
+        head = names[:64]
+        random.shuffle(head)
+        for name in head + names[64:]:
+            _, i, attempts = _parse_name(name)
+            src = os.path.join(self._queue, name)
+            try:
+                if attempts >= self.max_attempts:
+                    os.rename(src, os.path.join(self._failed, f"{i:08d}--{attempts}"))
+                    print(f"[WARN] Block {i} failed {attempts} attempts; moved to {self._failed}")
+                    continue
+                token = _task_name(now + seconds, i, attempts + 1)
+                os.rename(src, os.path.join(self._queue, token))
+                return i, token
+            except FileNotFoundError:
+                continue  # taken by another worker
+        return None
+
+    def renew(self, token: str, seconds: float):
+        """Extend a lease; returns the new token, or None if the lease was lost (expired and taken over)"""
+        _, i, attempts = _parse_name(token)
+        new = _task_name(time.time() + seconds, i, attempts)
+        try:
+            os.rename(os.path.join(self._queue, token), os.path.join(self._queue, new))
+        except FileNotFoundError:
+            return None
+        return new
+
+    def complete(self, token: str):
+        """Remove a finished block from the queue"""
+        try:
+            os.remove(os.path.join(self._queue, token))
+        except FileNotFoundError:
+            pass
+
+    def release(self, token: str):
+        """Return a leased block to the queue right away (e.g. after a failure); the attempt still counts"""
+        _, i, attempts = _parse_name(token)
+        try:
+            os.rename(os.path.join(self._queue, token), os.path.join(self._queue, _task_name(0, i, attempts)))
+        except FileNotFoundError:
+            pass
+
+
+class LeaseRenewer(threading.Thread):
+    """Background thread renewing the leases held by a worker every lease_seconds / 3"""
+
+    def __init__(self, queue: BlockQueue, lease_seconds: float):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.lease_seconds = float(lease_seconds)
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+
+    def add(self, i: int, token: str):
+        with self._lock:
+            self._tokens[i] = token
+
+    def pop(self, i: int):
+        """Stop renewing block i; returns its current token (None if the lease was lost)"""
+        with self._lock:
+            return self._tokens.pop(i, None)
+
+    def run(self):
+        while not self._halt.wait(self.lease_seconds / 3.0):
+            with self._lock:
+                for i, token in list(self._tokens.items()):
+                    if token is None:
+                        continue
+                    self._tokens[i] = self.queue.renew(token, self.lease_seconds)
+                    if self._tokens[i] is None:
+                        print(f"[WARN] Lease of block {i} expired and was taken over; it may be processed twice.")
+
+    def stop(self):
+        self._halt.set()
+        self.join()
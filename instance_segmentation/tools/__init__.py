@@ -7,5 +7,26 @@ try:
 except Exception:
     run_local_shard_main = None
 
+try:
+    from .warmup_waterz import main as warmup_waterz_main
+except Exception:
+    warmup_waterz_main = None
+
+try:
+    from .bench_seeds import main as bench_seeds_main
+except Exception:
+    bench_seeds_main = None
+
+try:
+    from .status import main as status_main
+except Exception:
+    status_main = None
+
+try:
+    from .local_array import main as local_array_main, run_local_array
+except Exception:
+    local_array_main = run_local_array = None
+
 
-__all__ = ["run_local_shard_main", ]
+__all__ = ["run_local_shard_main", "warmup_waterz_main", "bench_seeds_main", "status_main",
+           "local_array_main", "run_local_array", ]
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Local scheduler: run the array tasks of a generated job script as subprocesses on one
+machine, with the environment variables Slurm sets for job arrays (SLURM_ARRAY_TASK_ID, ...).
+Concurrency limits and injected failures (tasks that fail at start, get killed mid-run or
+start late) exercise shard scaling, stragglers and resume logic without a cluster.
+"""
+import os
+import time
+import random
+import signal
+import argparse
+import subprocess
+
+
+def _array_env(job_id, task_id, array_len, job_name, cpus, submit_dir):
+    env = dict(os.environ)
+    env.update({
+        "SLURM_JOB_ID": str(job_id + 1 + task_id),
+        "SLURM_ARRAY_JOB_ID": str(job_id),
+        "SLURM_ARRAY_TASK_ID": str(task_id),
+        "SLURM_ARRAY_TASK_COUNT": str(array_len),
+        "SLURM_ARRAY_TASK_MIN": "0",
+        "SLURM_ARRAY_TASK_MAX": str(array_len - 1),
+        "SLURM_JOB_NAME": job_name,
+        "SLURM_CPUS_PER_TASK": str(cpus),
+        "SLURM_SUBMIT_DIR": submit_dir,
+        "SLURM_LOCALID": "0",
+        "SLURMD_NODENAME": f"local{task_id}",
+    })
+    return env
+
+
+def run_local_array(script_path, array_len, concurrency=1, log_dir=None, job_name="local_array", cpus=1,
+                    fail_tasks=(), fail_rate=0.0, kill_after_s=None, slow_tasks=(), slow_s=0.0, seed=0,
+                    poll_s=0.2) -> list:
+    """
+    Run array tasks 0..array_len-1 of script_path with at most `concurrency` at a time.
+    Injected failures:
+      fail_tasks / fail_rate: these tasks exit 1 without running, or are killed (SIGKILL)
+                              after kill_after_s seconds when it is set
+      slow_tasks:             these tasks start slow_s seconds late (holding their slot)
+    Logs go to log_dir/<job_name>_<job_id>_<task>.out/.err like the Slurm scripts.
+    Returns: [{task, returncode, wall_s, injected}] in task order
+    """
+    rng = random.Random(seed)
+    failing = set(int(t) for t in fail_tasks) | {t for t in range(array_len) if rng.random() < fail_rate}
+    slow = set(int(t) for t in slow_tasks)
+    job_id = int(time.time()) % 1000000 * 1000
+    log_dir = log_dir or os.path.join(os.path.dirname(os.path.abspath(script_path)), "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    submit_dir = os.getcwd()
+
+    pending = list(range(array_len))
+    running, results = {}, {}
+
+    def _launch(t):
+        if t in failing and kill_after_s is None:
+            return None
+        cmd = ["bash", script_path]
+        if t in slow and slow_s > 0:
+            cmd = ["bash", "-c", f'sleep {float(slow_s)} && exec bash "$0"', script_path]
+        base = os.path.join(log_dir, f"{job_name}_{job_id}_{t}")
+        with open(base + ".out", "w") as out, open(base + ".err", "w") as err:
+            return subprocess.Popen(cmd, stdout=out, stderr=err,
+                                    env=_array_env(job_id, t, array_len, job_name, cpus, submit_dir),
+                                    start_new_session=True)
+
+    print(f"[INFO] Local array {job_id}: {array_len} tasks of {script_path}, concurrency {concurrency}, "
+          f"injected failures {sorted(failing)}, slow {sorted(slow)}")
+    while pending or running:
+        while pending and len(running) < concurrency:
+            t = pending.pop(0)
+            start = time.time()
+            proc = _launch(t)
+            if proc is None:
+                results[t] = {"task": t, "returncode": 1, "wall_s": 0.0, "injected": "fail"}
+                continue
+            running[t] = (proc, start)
+
+        time.sleep(poll_s)
+        for t, (proc, start) in list(running.items()):
+            rc = proc.poll()
+            if rc is None and t in failing and time.time() - start >= kill_after_s:
+                os.killpg(proc.pid, signal.SIGKILL)  # the whole task, including its worker processes
+                rc = proc.wait()
+            if rc is None:
+                continue
+            del running[t]
+            results[t] = {"task": t, "returncode": rc, "wall_s": round(time.time() - start, 2),
+                          "injected": "kill" if t in failing else ("slow" if t in slow else None)}
+            print(f"[INFO] Array task {t} exited with {rc} after {results[t]['wall_s']:.1f}s")
+
+    results = [results[t] for t in range(array_len)]
+    n_failed = sum(1 for r in results if r["returncode"] != 0)
+    print(f"[DONE] Local array finished: {array_len - n_failed}/{array_len} tasks succeeded, logs in {log_dir}")
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run a job array script locally, the way Slurm would.")
+    ap.add_argument("script", type=str, help="Job script (e.g. <job_dir>/submit_local.sh)")
+    ap.add_argument("--array", required=True, type=int, help="Number of array tasks")
+    ap.add_argument("--concurrency", default=1, type=int)
+    ap.add_argument("--cpus", default=1, type=int, help="SLURM_CPUS_PER_TASK")
+    ap.add_argument("--fail-tasks", default=[], type=int, nargs="*")
+    ap.add_argument("--fail-rate", default=0.0, type=float)
+    ap.add_argument("--kill-after", default=None, type=float, help="Kill failing tasks after N seconds")
+    ap.add_argument("--slow-tasks", default=[], type=int, nargs="*")
+    ap.add_argument("--slow", default=0.0, type=float, help="Start delay of slow tasks (seconds)")
+    ap.add_argument("--seed", default=0, type=int)
+    args = ap.parse_args()
+    results = run_local_array(args.script, args.array, concurrency=args.concurrency, cpus=args.cpus,
+                              fail_tasks=args.fail_tasks, fail_rate=args.fail_rate, kill_after_s=args.kill_after,
+                              slow_tasks=args.slow_tasks, slow_s=args.slow, seed=args.seed)
+    raise SystemExit(1 if any(r["returncode"] != 0 and not r["injected"] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,94 @@
 # -*- coding: utf-8 -*-
 import os
 import gc
+import time
 import argparse
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 from magneton.instance_segmentation.config import load_config, get_stage_config
-from magneton.instance_segmentation.stages.segmentation_stage import _process_block   
-from magneton.instance_segmentation.state.checkpoint import mark_local_done, is_local_done
+from magneton.instance_segmentation.stages.segmentation_stage import _process_block, _mask_prepass, _finish_block
+from magneton.instance_segmentation.state.checkpoint import mark_local_done, load_local_done
+from magneton.instance_segmentation.state.work_queue import BlockQueue, LeaseRenewer
 from magneton.instance_segmentation.utils.meta_utils import save_block_meta
-from magneton.instance_segmentation.utils.block_utils import generate_blocks_zyx
-from cloudvolume import CloudVolume
+from magneton.instance_segmentation.utils.block_utils import blocks_for_volume
+from magneton.instance_segmentation.utils.telemetry import telemetry_enabled
 
 
-def _get_blocks(cfg):
-    input_path = cfg["paths"]["input"]
-    mip = cfg.get("local_stage", {}).get("mip", 0)
-    aff_vol = CloudVolume(input_path, mip=mip, bounded=False, progress=False)
-    vol_size_xyz = tuple(aff_vol.info["scales"][0]["size"])
-    vol_shape_zyx = (vol_size_xyz[2], vol_size_xyz[1], vol_size_xyz[0])
-    block_size = tuple(cfg["block"]["size"])
-    overlap = tuple(cfg["block"]["overlap"])
-    return generate_blocks_zyx(vol_shape_zyx, block_size, overlap)
+def _run_queue(queue, q_cfg, workers, submit, finish, skip):
+    """
+    Work-stealing loop: lease blocks from the shared queue while workers are free, renew the
+    leases in the background, remove finished blocks and release failed ones; exits when the
+    queue is drained (waiting for blocks still leased by other shards, whose leases may expire).
+    submit(ex, i): submit block i to the executor, returns its future
+    skip(i): True if block i needs no processing (already done or empty); it is removed from the queue
+    """
+    lease_seconds = float(q_cfg.get("lease_seconds", 1800))
+    poll_seconds = float(q_cfg.get("poll_seconds", 30))
+    renewer = LeaseRenewer(queue, lease_seconds)
+    renewer.start()
+    running = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            while True:
+                while len(running) < workers:
+                    leased = queue.lease(lease_seconds)
+                    if leased is None:
+                        break
+                    i, token = leased
+                    if skip(i):
+                        queue.complete(token)
+                        continue
+                    renewer.add(i, token)
+                    running[submit(ex, i)] = i
+                if not running:
+                    if not len(queue):
+                        break
+                    time.sleep(poll_seconds)  # the remaining blocks are leased by other shards
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    i = running.pop(fut)
+                    token = renewer.pop(i)
+                    try:
+                        meta = fut.result()
+                    except Exception as e:
+                        print(f"[WARN] Block {i} failed: {e}; released to the queue.")
+                        if token is not None:
+                            queue.release(token)
+                        if isinstance(e, BrokenProcessPool):
+                            raise
+                        continue
+                    finish(meta)
+                    if token is not None:
+                        queue.complete(token)
+    finally:
+        # Leases of unfinished blocks (interrupt, broken pool) go back to the queue
+        for i in list(running.values()):
+            token = renewer.pop(i)
+            if token is not None:
+                queue.release(token)
+        renewer.stop()
+    if queue.failed():
+        print(f"[WARN] Blocks that exhausted their attempts: {queue.failed()}")
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", default="./instance_segmentation/configs/config.yaml", type=str)
-    ap.add_argument("--indices", required=True, type=str, help="Comma-separated block indices, such as: 0,1,2")
+    ap.add_argument("--indices", default=None, type=str, help="Comma-separated block indices, such as: 0,1,2")
+    ap.add_argument("--queue", default=None, type=str,
+                    help="Block queue folder (hpc.queue): lease blocks until the queue is drained")
     ap.add_argument("--workers", default=2, type=int, help="Number of parallel workers within a node")
     ap.add_argument("--debug", action="store_true")
     args = ap.parse_args()
+    if (args.indices is None) == (args.queue is None):
+        ap.error("exactly one of --indices or --queue is required")
 
     cfg = load_config(args.config)
-    stage_cfg = get_stage_config(cfg, "segmentation_stage")
-    blocks = _get_blocks(cfg)
+    stage_cfg = get_stage_config(cfg, "segmentation")
+    blocks = blocks_for_volume(cfg)
 
     input_path  = cfg["paths"]["input"]
     mask_flag   = cfg["mask"]["flag"]
@@ -45,36 +100,71 @@ def main():
     local_ckpt_dir = cfg["checkpoint"]["segmentation_dir"]
     metadata_dir   = stage_cfg.get("metadata_dir", "magneton/local_metadata")
 
-    # Analyzing indices
-    idx_list = [int(x) for x in args.indices.strip().split(",") if x.strip() != ""]
+    # Mask pre-pass: empty blocks are recorded as done here, the others cropped to the mask
+    def _finish_empty(meta):
+        save_block_meta(metadata_dir, meta)
+        mark_local_done(local_ckpt_dir, meta["index"])
+
+    # In queue mode every shard runs the pre-pass; an empty block is recorded by the shard leasing it
+    empty = {}
+    def _defer_empty(meta):
+        empty[meta["index"]] = meta
+
+    def _finish(meta):
+        _finish_block(meta, metadata_dir, local_ckpt_dir, telemetry_enabled(cfg))
+        print(f"[INFO] Finished block {meta['index']} (HPC shard), max_id={meta['max_id']}, "
+              f"peak RSS {meta.get('peak_rss_mb', 0):.0f} MB, path={meta['path']}")
+
+    if args.queue is not None:
+        q_cfg = (stage_cfg.get("hpc", {}) or {}).get("queue", {}) or {}
+        queue = BlockQueue(args.queue, max_attempts=int(q_cfg.get("max_attempts", 3)))
+        idx_list = queue.indices()
+    else:
+        idx_list = [int(x) for x in args.indices.strip().split(",") if x.strip() != ""]
     # Filtering completed
-    todo = [i for i in idx_list if not is_local_done(local_ckpt_dir, i)]
+    done = load_local_done(local_ckpt_dir)
+    todo = [i for i in idx_list if i not in done]
+    todo, plans = _mask_prepass(cfg, mip, blocks, [(i, blocks[i]) for i in todo],
+                                _finish_empty if args.queue is None else _defer_empty)
+
+    def _submit(ex, i):
+        return ex.submit(
+            _process_block,
+            i, blocks[i],
+            input_path=input_path,
+            mask_flag=mask_flag,
+            mask_path=mask_path,
+            output_local_base=output_local_base,
+            mip=mip,
+            stage_cfg=stage_cfg,
+            plan=plans.get(i, (None, None)),
+        )
+
+    if args.queue is not None:
+        def _skip(i):
+            if i in empty:
+                _finish_empty(empty.pop(i))
+                return True
+            return i in done
+
+        _run_queue(queue, q_cfg, args.workers, _submit, _finish, _skip)
+        gc.collect()
+        print("[DONE] Local shard finished (queue drained).")
+        return
+
     if not todo:
         print("[INFO] The blocks corresponding to this task have been completed and skipped.")
         return
 
     futures = []
     with ProcessPoolExecutor(max_workers=args.workers) as ex:
-        for i in todo:
-            coords = blocks[i]
-            fut = ex.submit(
-                _process_block,
-                i, coords,
-                input_path=input_path,
-                mask_flag=mask_flag,
-                mask_path=mask_path,
-                output_local_base=output_local_base,
-                mip=mip,
-                stage_cfg=stage_cfg
-            )
-            futures.append(fut)
+        for i, _coords in todo:
+            futures.append(_submit(ex, i))
 
         for fut in as_completed(futures):
-            meta = fut.result()
-            save_block_meta(metadata_dir, meta)
-            mark_local_done(local_ckpt_dir, meta["index"])
-            print(f"[INFO] Finished block {meta['index']} (HPC shard), max_id={meta['max_id']}, path={meta['path']}")
+            _finish(fut.result())
 
+    # Shards only append to the metadata index log; merge-pools/merge compact it once
     gc.collect()
     print("[DONE] Local shard finished.")
 
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline status: completed checkpoints per stage, and the telemetry summary
+(throughput, per-phase times, stragglers, ETA) recorded in the metadata folders.
+"""
+import argparse
+
+from magneton.instance_segmentation.config import load_config
+from magneton.instance_segmentation.utils.block_utils import blocks_from_config
+from magneton.instance_segmentation.utils.meta_utils import load_index_meta
+from magneton.instance_segmentation.state.checkpoint import load_local_done, load_merge_done
+from magneton.instance_segmentation.utils.telemetry import print_telemetry_status
+
+
+def _block_count(cfg):
+    """Number of blocks of the configured block plan (None if the input volume cannot be opened)"""
+    try:
+        from cloudvolume import CloudVolume
+        mip = cfg.get("segmentation_stage", {}).get("mip", 0)
+        aff_vol = CloudVolume(cfg["paths"]["input"], mip=mip, bounded=False, progress=False)
+        vol_size_xyz = tuple(aff_vol.info["scales"][0]["size"])
+        chunk_zyx = tuple(int(c) for c in aff_vol.chunk_size)[::-1]
+        return len(blocks_from_config(cfg, vol_size_xyz[::-1], chunk_zyx))
+    except Exception as e:
+        print(f"[WARN] Block count unavailable ({e}); no ETA.")
+        return None
+
+
+def print_status(cfg):
+    """Print checkpoint counts and the telemetry summary of every stage"""
+    seg_metadata_dir = cfg.get("segmentation_stage", {}).get("metadata_dir", "./local_metadata")
+    merge_metadata_dir = cfg.get("merge_stage", {}).get("metadata_dir", seg_metadata_dir)
+    merge_ckpt_dir = cfg["checkpoint"]["merge_dir"]
+    straggler_factor = float((cfg.get("telemetry", {}) or {}).get("straggler_factor", 2.0))
+
+    n_blocks = _block_count(cfg)
+    total = f"/{n_blocks}" if n_blocks is not None else ""
+    print(f"[INFO] Segmentation: {len(load_local_done(cfg['checkpoint']['segmentation_dir']))}{total} blocks done")
+    print(f"[INFO] Merge-apply:  {len(load_merge_done(merge_ckpt_dir))}{total} blocks written")
+
+    # Blocks skipped by the mask pre-pass finish without telemetry
+    n_empty = sum(1 for b in load_index_meta(seg_metadata_dir).get("blocks", []) if b.get("path") is None)
+    totals = {}
+    if n_blocks is not None:
+        totals = {"segmentation": n_blocks - n_empty, "merge-apply": n_blocks, "rethreshold": n_blocks - n_empty}
+    for folder in dict.fromkeys([seg_metadata_dir, merge_metadata_dir]):
+        print(f"[Telemetry] {folder}")
+        print_telemetry_status(folder, totals, straggler_factor=straggler_factor)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Show pipeline progress, throughput, stragglers and ETA.")
+    ap.add_argument("--config", default="./instance_segmentation/configs/config.yaml", type=str)
+    args = ap.parse_args()
+    print_status(load_config(args.config))
+
+
+if __name__ == "__main__":
+    main()
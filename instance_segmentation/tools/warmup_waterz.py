@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import argparse
+
+from magneton.instance_segmentation.config import load_config, get_stage_config
+from magneton.instance_segmentation.stages.segmentation_stage import warmup_waterz
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Pre-build the waterz modules named in the segmentation config.")
+    ap.add_argument("--config", default="./instance_segmentation/configs/config.yaml", type=str)
+    ap.add_argument("--cache-dir", default=None, type=str, help="Override segmentation_stage.waterz_cache_dir")
+    args = ap.parse_args()
+
+    cfg = load_config(args.config)
+    stage_cfg = dict(get_stage_config(cfg, "segmentation"))
+    if args.cache_dir:
+        stage_cfg["waterz_cache_dir"] = args.cache_dir
+
+    warmup_waterz(stage_cfg)
+    print("[DONE] waterz warm-up finished.")
+
+
+if __name__ == "__main__":
+    main()
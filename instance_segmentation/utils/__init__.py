@@ -2,14 +2,27 @@
 """
 utils: Utility Module Collection
 """
-from .block_utils import generate_blocks_zyx, intersect_boxes_zyx
-from .io_utils import export_tif_from_volume
+from .block_utils import (
+    generate_blocks_zyx, intersect_boxes_zyx, overlapping_pairs_zyx,
+    plan_blocks_zyx, auto_block_size_zyx, io_amplification, blocks_from_config,
+    mask_block_summary, block_low_res_means, blocks_for_volume, box_voxels, read_mask_summary,
+)
+from .io_utils import (
+    export_tif_from_volume, block_history_paths, save_block_history, load_block_history,
+    uncrop_block, write_block_output,
+)
 from .meta_utils import (
-    load_index_meta, save_block_meta, block_meta_path, index_meta_path
+    load_index_meta, save_block_meta, block_meta_path, index_meta_path,
+    index_log_path, compact_index_meta,
 )
 from .relabel_utils import (
     update_id_pools, build_rep_map_from_pools, relabel_array_inplace_with_map,
-    accumulate_local_global_pairs,
+    accumulate_local_global_pairs, IdPoolUnionFind, load_unions_txt,
+    count_label_pairs, select_pairs, select_pairs_arrays,
+    load_lookup_table, lookup_table_from_map,
+)
+from .telemetry import (
+    telemetry_path, append_telemetry, load_telemetry, summarize_telemetry, print_telemetry_status,
 )
 
 from .interrupts import InterruptController
@@ -17,14 +30,43 @@ from .interrupts import InterruptController
 __all__ = [
     "generate_blocks_zyx",
     "intersect_boxes_zyx",
+    "overlapping_pairs_zyx",
+    "plan_blocks_zyx",
+    "auto_block_size_zyx",
+    "io_amplification",
+    "blocks_from_config",
+    "mask_block_summary",
+    "block_low_res_means",
+    "blocks_for_volume",
+    "box_voxels",
+    "read_mask_summary",
     "export_tif_from_volume",
+    "block_history_paths",
+    "save_block_history",
+    "load_block_history",
+    "uncrop_block",
+    "write_block_output",
     "load_index_meta",
     "save_block_meta",
     "block_meta_path",
     "index_meta_path",
+    "index_log_path",
+    "compact_index_meta",
     "update_id_pools",
     "build_rep_map_from_pools",
     "relabel_array_inplace_with_map",
+    "load_lookup_table",
+    "lookup_table_from_map",
     "accumulate_local_global_pairs",
+    "IdPoolUnionFind",
+    "load_unions_txt",
+    "count_label_pairs",
+    "select_pairs",
+    "select_pairs_arrays",
+    "telemetry_path",
+    "append_telemetry",
+    "load_telemetry",
+    "summarize_telemetry",
+    "print_telemetry_status",
     "InterruptController"
 ]
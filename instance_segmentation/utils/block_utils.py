@@ -1,3 +1,10 @@
+import os
+import math
+
+import numpy as np
+from cloudvolume import CloudVolume
+
+
 def generate_blocks_zyx(vol_shape_zyx, block_size_zyx, overlap_zyx=(0, 0, 0)):
     """
     Generate chunks based on volume size (Z, Y, X)
@@ -19,6 +26,145 @@ def generate_blocks_zyx(vol_shape_zyx, block_size_zyx, overlap_zyx=(0, 0, 0)):
     return blocks
 
 
+def _axis_intervals(size, core, halo):
+    """[start, end) of each block along one axis: cores of `core` voxels, widened by `halo` on both sides"""
+    out = []
+    for c0 in range(0, size, core):
+        out.append((max(0, c0 - halo), min(size, c0 + core + halo)))
+    return out
+
+
+def plan_blocks_zyx(vol_shape_zyx, block_size_zyx, overlap_zyx, chunk_zyx, align_halo=False):
+    """
+    Chunk-aligned block planner.
+    Block cores (the owned regions) are snapped to multiples of the storage chunk size and
+    start on the chunk grid; each block adds half the overlap on each side (rounded up to
+    whole chunks with align_halo, so reads cover whole chunks too).
+    Returns: list of (z1,z2,y1,y2,x1,x2), in the same z/y/x order as generate_blocks_zyx
+    """
+    axes = []
+    for size, b, o, c in zip(vol_shape_zyx, block_size_zyx, overlap_zyx, chunk_zyx):
+        c = max(1, int(c))
+        core = max(c, int(round((int(b) - int(o)) / float(c))) * c)
+        halo = int(o) // 2 + int(o) % 2
+        if align_halo and halo:
+            halo = int(math.ceil(halo / float(c))) * c
+        axes.append(_axis_intervals(int(size), core, halo))
+    return [
+        (z1, z2, y1, y2, x1, x2)
+        for (z1, z2) in axes[0] for (y1, y2) in axes[1] for (x1, x2) in axes[2]
+    ]
+
+
+def auto_block_size_zyx(memory_budget_bytes, workers, overlap_zyx, chunk_zyx,
+                        bytes_per_voxel=80, aspect_zyx=(1, 1, 1)):
+    """
+    Largest chunk-aligned block size whose working set fits memory_budget_bytes / workers.
+    bytes_per_voxel: peak bytes per block voxel (affinities, boundary map, seeds, fragments, outputs)
+    aspect_zyx: relative block extents (e.g. the configured block size)
+    Returns: (bz, by, bx) including overlap
+    """
+    per_worker = float(memory_budget_bytes) / max(1, int(workers))
+    vox = per_worker / float(bytes_per_voxel)
+    scale = (vox / float(np.prod([float(a) for a in aspect_zyx]))) ** (1.0 / 3.0)
+    size = []
+    for a, o, c in zip(aspect_zyx, overlap_zyx, chunk_zyx):
+        c = max(1, int(c))
+        core = int((float(a) * scale - int(o)) // c) * c
+        size.append(max(c, core) + int(o))
+    # Shrink the largest axis until the block fits (the floor above may not be enough with large overlaps)
+    while np.prod(size) > vox and max(s - o for s, o in zip(size, overlap_zyx)) > min(chunk_zyx):
+        d = int(np.argmax([s - o for s, o in zip(size, overlap_zyx)]))
+        size[d] = max(int(chunk_zyx[d]) + int(overlap_zyx[d]), size[d] - int(chunk_zyx[d]))
+    return tuple(int(v) for v in size)
+
+
+def io_amplification(blocks, chunk_zyx, vol_shape_zyx, write_boxes=None):
+    """
+    Expected I/O amplification of a block plan on a chunked volume.
+    read:    voxels of all touched chunks / voxels requested by the block reads
+    write:   same for write_boxes (defaults to the chunk-snapped owned regions)
+    compute: voxels processed (with overlaps) / volume voxels
+    """
+    def touched(box):
+        n = 1
+        for d in range(3):
+            s1, s2 = int(box[2 * d]), int(box[2 * d + 1])
+            if s2 <= s1:
+                return 0
+            c = int(chunk_zyx[d])
+            lo = (s1 // c) * c
+            hi = min(int(vol_shape_zyx[d]), -(-s2 // c) * c)
+            n *= hi - lo
+        return n
+
+    def volume(box):
+        return max(0, box[1] - box[0]) * max(0, box[3] - box[2]) * max(0, box[5] - box[4])
+
+    if write_boxes is None:
+        write_boxes = owned_regions_zyx(blocks, chunk_zyx=chunk_zyx)
+    read_req = sum(volume(b) for b in blocks)
+    write_req = sum(volume(b) for b in write_boxes)
+    return {
+        "read": sum(touched(b) for b in blocks) / float(max(1, read_req)),
+        "write": sum(touched(b) for b in write_boxes) / float(max(1, write_req)),
+        "compute": read_req / float(max(1, int(np.prod([int(v) for v in vol_shape_zyx])))),
+    }
+
+
+def blocks_from_config(cfg, vol_shape_zyx, chunk_zyx=None, verbose=False):
+    """
+    Block list for the global config (cfg["block"]); every stage must use this so block indices agree.
+      block.planner.enable = false: generate_blocks_zyx(size, overlap)
+      block.planner.enable = true:  plan_blocks_zyx snapped to chunk_zyx; with planner.memory_budget_gb
+                                    the block size is picked by auto_block_size_zyx for planner.workers
+    """
+    block_cfg = cfg["block"]
+    block_size = tuple(block_cfg["size"])
+    overlap = tuple(block_cfg["overlap"])
+    planner = block_cfg.get("planner", {}) or {}
+    if not planner.get("enable", False) or chunk_zyx is None:
+        blocks = generate_blocks_zyx(vol_shape_zyx, block_size, overlap)
+        if verbose and chunk_zyx is not None:
+            amp = io_amplification(blocks, chunk_zyx, vol_shape_zyx)
+            print(f"[INFO] Block plan: {len(blocks)} blocks of {block_size}; I/O amplification "
+                  f"read x{amp['read']:.2f}, write x{amp['write']:.2f}, compute x{amp['compute']:.2f}")
+        return blocks
+
+    chunk_zyx = tuple(int(c) for c in chunk_zyx)
+    budget_gb = planner.get("memory_budget_gb", None)
+    if budget_gb:
+        workers = int(planner.get("workers")
+                      or cfg.get("segmentation_stage", {}).get("workers", os.cpu_count() or 1))
+        block_size = auto_block_size_zyx(
+            float(budget_gb) * 1024 ** 3, workers, overlap, chunk_zyx,
+            bytes_per_voxel=float(planner.get("bytes_per_voxel", 80)),
+            aspect_zyx=block_size,
+        )
+    blocks = plan_blocks_zyx(vol_shape_zyx, block_size, overlap, chunk_zyx,
+                             align_halo=planner.get("align_halo", False))
+    if verbose:
+        amp = io_amplification(blocks, chunk_zyx, vol_shape_zyx)
+        print(f"[INFO] Block plan (chunk-aligned to {chunk_zyx}): {len(blocks)} blocks of {block_size}; "
+              f"I/O amplification read x{amp['read']:.2f}, write x{amp['write']:.2f}, compute x{amp['compute']:.2f}")
+    return blocks
+
+
+def blocks_for_volume(cfg):
+    """blocks_from_config for the input volume of the global config (size and chunk size at local_stage.mip)"""
+    mip = cfg.get("local_stage", {}).get("mip", 0)
+    aff_vol = CloudVolume(cfg["paths"]["input"], mip=mip, bounded=False, progress=False)
+    vol_size_xyz = tuple(aff_vol.info["scales"][0]["size"])
+    chunk_zyx = tuple(int(c) for c in aff_vol.chunk_size)[::-1]
+    return blocks_from_config(cfg, vol_size_xyz[::-1], chunk_zyx)
+
+
+def box_voxels(box):
+    """Voxel count of a box (z1,z2,y1,y2,x1,x2)"""
+    (z1, z2, y1, y2, x1, x2) = box
+    return (z2 - z1) * (y2 - y1) * (x2 - x1)
+
+
 def intersect_1d(a1, a2, b1, b2):
     """1D interval intersection"""
     c1 = max(a1, b1)
@@ -41,3 +187,323 @@ def intersect_boxes_zyx(A, B):
     if None in (zz1, yy1, xx1):
         return None
     return (zz1, zz2, yy1, yy2, xx1, xx2)
+
+
+def _low_res_footprint(box, shape_zyx, scale_zyx, origin_zyx):
+    """(lo, hi) voxel ranges of a block box in a low-resolution volume"""
+    lo, hi = [], []
+    for d in range(3):
+        s, o = float(scale_zyx[d]), float(origin_zyx[d])
+        l = int(max(0, math.floor((box[2 * d] - o) / s)))
+        h = int(min(shape_zyx[d], math.ceil((box[2 * d + 1] - o) / s)))
+        lo.append(l)
+        hi.append(max(l, h))
+    return lo, hi
+
+
+def block_low_res_means(vol_zyx, boxes, scale_zyx, origin_zyx=(0, 0, 0)):
+    """
+    Mean of a low-resolution volume under each block (same mapping as mask_block_summary).
+    Returns: list of float per box (0.0 for boxes outside the volume)
+    """
+    out = []
+    for box in boxes:
+        lo, hi = _low_res_footprint(box, vol_zyx.shape, scale_zyx, origin_zyx)
+        sub = vol_zyx[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        out.append(float(sub.mean()) if sub.size else 0.0)
+    return out
+
+
+def mask_block_summary(mask_zyx, boxes, scale_zyx, origin_zyx=(0, 0, 0), margin=1):
+    """
+    Per-block occupancy of a low-resolution mask.
+    mask_zyx:   boolean mask at the low resolution
+    scale_zyx:  block voxels per mask voxel along each axis
+    origin_zyx: block coordinate of mask voxel (0, 0, 0)
+    margin:     crop padding, in mask voxels
+    Returns: list of (occupancy, crop) per box; occupancy is the masked fraction of the mask
+    voxels under the box, crop the box (z1,z2,y1,y2,x1,x2) around the masked voxels,
+    clipped to the block, or None when the block is empty
+    """
+    out = []
+    for box in boxes:
+        lo, hi = _low_res_footprint(box, mask_zyx.shape, scale_zyx, origin_zyx)
+        sub = mask_zyx[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        if not sub.any():
+            out.append((0.0, None))
+            continue
+        crop = []
+        for d in range(3):
+            s, o = float(scale_zyx[d]), float(origin_zyx[d])
+            nz = np.flatnonzero(sub.any(axis=tuple(a for a in range(3) if a != d)))
+            c1 = int(math.floor(o + (lo[d] + nz[0] - margin) * s))
+            c2 = int(math.ceil(o + (lo[d] + nz[-1] + 1 + margin) * s))
+            crop += [max(int(box[2 * d]), c1), min(int(box[2 * d + 1]), c2)]
+        out.append((float(sub.mean()), tuple(crop)))
+    return out
+
+
+def read_mask_summary(global_cfg, mip, blocks):
+    """
+    Mask pre-pass: read the whole mask once at a low mip (mask.summary.mip, coarsest by default)
+    and summarize every block with mask_block_summary.
+    Returns: list of (occupancy, crop) per block, or None when mask.flag or mask.summary.enable is off
+    """
+    mask_cfg = global_cfg.get("mask", {}) or {}
+    sum_cfg = mask_cfg.get("summary", {}) or {}
+    if not mask_cfg.get("flag", False) or not sum_cfg.get("enable", True):
+        return None
+    scales = CloudVolume(mask_cfg["path"], mip=mip, bounded=False, progress=False).info["scales"]
+    summary_mip = sum_cfg.get("mip", None)
+    summary_mip = len(scales) - 1 if summary_mip is None else int(summary_mip)
+    low_vol = CloudVolume(mask_cfg["path"], mip=summary_mip, bounded=False, progress=False, fill_missing=True)
+    mask_zyx = np.transpose(low_vol[:, :, :], (3, 2, 1, 0))[0] > 0
+
+    # Block coordinates are voxels at the stage mip
+    scale_zyx = [float(a) / float(b) for a, b in
+                 zip(scales[summary_mip]["resolution"][::-1], scales[mip]["resolution"][::-1])]
+    origin_zyx = [float(v) * s for v, s in zip(scales[summary_mip]["voxel_offset"][::-1], scale_zyx)]
+    summary = mask_block_summary(mask_zyx, blocks, scale_zyx, origin_zyx,
+                                 margin=int(sum_cfg.get("margin", 1)))
+    print(f"[INFO] Mask summary at mip {summary_mip} (x{'/'.join(f'{s:g}' for s in scale_zyx)} zyx): "
+          f"{sum(1 for _, crop in summary if crop is None)}/{len(blocks)} blocks empty")
+    return summary
+
+
+# ---------- Overlap pair discovery ----------
+def grid_cells_zyx(boxes):
+    """
+    Map boxes onto the block grid (as produced by generate_blocks_zyx or plan_blocks_zyx).
+    Along each axis the cell index is the rank of the box start among all distinct starts.
+    boxes: list of (z1,z2,y1,y2,x1,x2)
+    Returns: list of (cz, cy, cx) per box, or None if the boxes are not on a grid
+    (duplicate cells, or a box reaching beyond its neighbor cell).
+    """
+    if not boxes:
+        return []
+    ranks, starts_by_axis = [], []
+    for d in range(3):
+        starts = sorted({int(b[2 * d]) for b in boxes})
+        starts_by_axis.append(starts)
+        ranks.append({s1: c for c, s1 in enumerate(starts)})
+    cells = []
+    for b in boxes:
+        cell = []
+        for d in range(3):
+            s1, s2 = int(b[2 * d]), int(b[2 * d + 1])
+            c = ranks[d][s1]
+            # A box may only overlap boxes of the adjacent cell along each axis
+            starts = starts_by_axis[d]
+            if c + 2 < len(starts) and s2 > starts[c + 2]:
+                return None
+            cell.append(c)
+        cells.append(tuple(cell))
+    if len(set(cells)) != len(cells):
+        return None
+    return cells
+
+
+class IntervalTree:
+    """
+    Static centered interval tree over half-open intervals [lo, hi).
+    Each node keeps the intervals with lo <= center < hi, sorted by lo and by hi.
+    query(lo, hi) returns the ids of all stored intervals intersecting [lo, hi).
+    """
+
+    def __init__(self, intervals):
+        # intervals: list of (lo, hi, id)
+        self.root = self._build([iv for iv in intervals if iv[1] > iv[0]])
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        # Center on the median start: the interval starting there always stays in this node
+        starts = sorted(lo for lo, _, _ in intervals)
+        center = starts[len(starts) // 2]
+        left, right, mid = [], [], []
+        for iv in intervals:
+            if iv[1] <= center:
+                left.append(iv)
+            elif iv[0] > center:
+                right.append(iv)
+            else:
+                mid.append(iv)
+        return {
+            "center": center,
+            "by_lo": sorted(mid, key=lambda iv: iv[0]),
+            "by_hi": sorted(mid, key=lambda iv: iv[1], reverse=True),
+            "left": self._build(left),
+            "right": self._build(right),
+        }
+
+    def query(self, lo, hi):
+        out = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            c = node["center"]
+            if hi <= c:
+                # Only intervals starting before hi can intersect
+                for iv in node["by_lo"]:
+                    if iv[0] >= hi:
+                        break
+                    out.append(iv[2])
+                stack.append(node["left"])
+            elif lo > c:
+                # Only intervals ending after lo can intersect
+                for iv in node["by_hi"]:
+                    if iv[1] <= lo:
+                        break
+                    out.append(iv[2])
+                stack.append(node["right"])
+            else:
+                # lo <= center < hi: every interval of this node intersects
+                out.extend(iv[2] for iv in node["by_lo"])
+                stack.append(node["left"])
+                stack.append(node["right"])
+        return out
+
+
+def _pairs_grid(boxes, cells):
+    """Neighbor enumeration on the block grid: only face/edge/corner neighbors are tested, O(N)"""
+    by_cell = {cell: k for k, cell in enumerate(cells)}
+    offsets = [
+        (dz, dy, dx)
+        for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+        if (dz, dy, dx) > (0, 0, 0)
+    ]
+    pairs = []
+    for a, (cz, cy, cx) in enumerate(cells):
+        for dz, dy, dx in offsets:
+            b = by_cell.get((cz + dz, cy + dy, cx + dx))
+            if b is None:
+                continue
+            ov = intersect_boxes_zyx(boxes[a], boxes[b])
+            if ov is not None:
+                pairs.append((min(a, b), max(a, b), ov))
+    return pairs
+
+
+def _pairs_interval(boxes):
+    """Interval-tree index on the most selective axis, then a vectorized check of the other axes"""
+    # Use the axis with the most distinct start coordinates to keep candidate lists short
+    axis = max(range(3), key=lambda d: len({int(b[2 * d]) for b in boxes}))
+    tree = IntervalTree([(int(b[2 * axis]), int(b[2 * axis + 1]), k) for k, b in enumerate(boxes)])
+    arr = np.asarray(boxes, dtype=np.int64).reshape(-1, 6)
+    pairs = []
+    for a, box in enumerate(boxes):
+        cand = np.asarray(tree.query(int(box[2 * axis]), int(box[2 * axis + 1])), dtype=np.int64)
+        cand = cand[cand > a]
+        for d in range(3):
+            if cand.size == 0:
+                break
+            lo, hi = arr[cand, 2 * d], arr[cand, 2 * d + 1]
+            cand = cand[(lo < box[2 * d + 1]) & (hi > box[2 * d])]
+        for b in cand.tolist():
+            ov = intersect_boxes_zyx(box, boxes[b])
+            if ov is not None:
+                pairs.append((a, b, ov))
+    return pairs
+
+
+def _pairs_brute(boxes):
+    """Reference O(N^2) scan over all box pairs"""
+    pairs = []
+    for a in range(len(boxes)):
+        for b in range(a + 1, len(boxes)):
+            ov = intersect_boxes_zyx(boxes[a], boxes[b])
+            if ov is not None:
+                pairs.append((a, b, ov))
+    return pairs
+
+
+def overlapping_pairs_zyx(boxes, mode="auto"):
+    """
+    List all intersecting box pairs.
+    boxes: list of (z1,z2,y1,y2,x1,x2)
+    mode:
+      - "grid": neighbor enumeration on the regular block grid (falls back to "interval" if irregular)
+      - "interval": interval-tree index
+      - "brute": O(N^2) double loop
+      - "auto": same as "grid"
+    Returns: sorted list of (a, b, ov_zyx) with positions a < b into `boxes`
+    """
+    boxes = [tuple(int(v) for v in b) for b in boxes]
+    if mode in ("auto", "grid"):
+        cells = grid_cells_zyx(boxes)
+        if cells is not None:
+            pairs = _pairs_grid(boxes, cells)
+        else:
+            if mode == "grid":
+                print("[WARN] Block coordinates are not on a regular grid; using interval-tree index.")
+            pairs = _pairs_interval(boxes)
+    elif mode == "interval":
+        pairs = _pairs_interval(boxes)
+    elif mode == "brute":
+        pairs = _pairs_brute(boxes)
+    else:
+        raise ValueError(f"Unknown pair index mode: {mode}")
+    pairs.sort(key=lambda p: (p[0], p[1]))
+    return pairs
+
+
+# ---------- Write ownership ----------
+def owned_regions_zyx(boxes, chunk_zyx=None, origin_zyx=(0, 0, 0)):
+    """
+    Split overlapping blocks into disjoint owned regions: along each axis a block gives up
+    the half of every overlap nearer to its neighbor (volume borders are kept).
+    With chunk_zyx, each cut is moved to the nearest chunk boundary (chunk grid starting at
+    origin_zyx) when that boundary still lies inside the overlap, so writes become chunk-aligned.
+    boxes: list of (z1,z2,y1,y2,x1,x2) on a block grid (as produced by generate_blocks_zyx)
+    Returns: list of owned (z1,z2,y1,y2,x1,x2), one per box
+    """
+    boxes = [tuple(int(v) for v in b) for b in boxes]
+    cuts = []
+    for d in range(3):
+        end_of = {}
+        for b in boxes:
+            end_of[b[2 * d]] = max(end_of.get(b[2 * d], b[2 * d]), b[2 * d + 1])
+        starts = sorted(end_of)
+        # Lower edge of each grid start; the upper edge is the next start's lower edge
+        lo, nxt = {}, {}
+        for k, s1 in enumerate(starts):
+            prev_end = end_of[starts[k - 1]] if k > 0 else s1
+            cut = s1
+            if prev_end > s1:
+                cut = (s1 + prev_end) // 2
+                if chunk_zyx is not None:
+                    c, o = int(chunk_zyx[d]), int(origin_zyx[d])
+                    snapped = o + int(round((cut - o) / float(c))) * c
+                    if s1 <= snapped <= prev_end:
+                        cut = snapped
+            lo[s1] = cut
+            nxt[s1] = starts[k + 1] if k + 1 < len(starts) else None
+        cuts.append((lo, nxt))
+    owned = []
+    for b in boxes:
+        box = []
+        for d in range(3):
+            lo, nxt = cuts[d]
+            s1, s2 = b[2 * d], b[2 * d + 1]
+            n = nxt[s1]
+            e = lo[n] if n is not None and n < s2 else s2
+            box += [lo[s1], max(lo[s1], e)]
+        owned.append(tuple(box))
+    return owned
+
+
+def is_chunk_aligned_zyx(box, chunk_zyx, origin_zyx=(0, 0, 0), bounds_zyx=None):
+    """
+    Whether every face of box lies on the chunk grid (or on the volume end in bounds_zyx),
+    i.e. a write of box touches only whole chunks.
+    """
+    for d in range(3):
+        c, o = int(chunk_zyx[d]), int(origin_zyx[d])
+        s1, s2 = int(box[2 * d]), int(box[2 * d + 1])
+        if (s1 - o) % c:
+            return False
+        if (s2 - o) % c and not (bounds_zyx is not None and s2 == int(bounds_zyx[d])):
+            return False
+    return True
@@ -1,5 +1,7 @@
+import os
 import numpy as np
 import tifffile
+from cloudvolume import CloudVolume
 
 def export_tif_from_volume(out_vol, save_path: str, max_slices: int = 200):
     """
@@ -17,3 +19,69 @@ def export_tif_from_volume(out_vol, save_path: str, max_slices: int = 200):
 
     tifffile.imwrite(save_path, seg.astype(np.uint32), dtype=np.uint32)
     print(f"[DONE] TIFF saved: {save_path}, shape={seg.shape}")
+
+
+# ---------- Block output ----------
+def uncrop_block(seg_local, coords, crop):
+    """Place the segmentation of a crop box into a zero-filled array of the full block"""
+    full = np.zeros(tuple(coords[2 * d + 1] - coords[2 * d] for d in range(3)), dtype=seg_local.dtype)
+    full[tuple(slice(crop[2 * d] - coords[2 * d], crop[2 * d + 1] - coords[2 * d]) for d in range(3))] = seg_local
+    return full
+
+
+def write_block_output(out_path, seg_local, coords, resolution, chunk_size, crop=None) -> dict:
+    """Write one segmented block (of the crop box, if given) to its own CloudVolume; return block_meta"""
+    (z1, z2, y1, y2, x1, x2) = coords
+    if crop is not None:
+        seg_local = uncrop_block(seg_local, coords, crop)
+    seg_xyz = np.transpose(seg_local, (2, 1, 0))  # (x,y,z)
+    vol_size_block = (x2 - x1, y2 - y1, z2 - z1)
+    seg_info = CloudVolume.create_new_info(
+        num_channels=1,
+        layer_type="segmentation",
+        data_type="uint32",
+        encoding="raw",
+        resolution=resolution,
+        voxel_offset=[int(x1), int(y1), int(z1)],
+        volume_size=list(map(int, vol_size_block)),
+        chunk_size=chunk_size,
+    )
+    out_local = CloudVolume(
+        out_path, info=seg_info, compress=False, progress=False, non_aligned_writes=True
+    )
+    out_local.commit_info()
+    out_local.commit_provenance()
+    out_local[:, :, :] = seg_xyz[:, :, :, np.newaxis]
+    return {
+        "index": None,
+        "coords": [z1, z2, y1, y2, x1, x2],
+        "path": out_path,
+        "done": True,
+        "max_id": int(seg_local.max()),
+    }
+
+
+# ---------- Merge history ----------
+def block_history_paths(history_dir: str, i: int):
+    """(fragments .npy, merges .npy) paths of one block's saved merge history"""
+    return (
+        os.path.join(history_dir, f"block_{i:04d}_fragments.npy"),
+        os.path.join(history_dir, f"block_{i:04d}_merges.npy"),
+    )
+
+def save_block_history(history_dir: str, i: int, fragments, merges):
+    """
+    Save a block's initial fragments (z,y,x) and merge-history table as .npy files;
+    each file is written to a temporary name and renamed, so readers never see partial arrays
+    """
+    os.makedirs(history_dir, exist_ok=True)
+    for path, arr in zip(block_history_paths(history_dir, i), (fragments, merges)):
+        tmp = path + ".tmp.npy"
+        np.save(tmp, np.ascontiguousarray(arr))
+        os.replace(tmp, path)
+
+def load_block_history(history_dir: str, i: int, mmap: bool = True):
+    """Return (fragments, merges) of one block, memory-mapped by default"""
+    frag_path, merge_path = block_history_paths(history_dir, i)
+    mode = "r" if mmap else None
+    return np.load(frag_path, mmap_mode=mode), np.load(merge_path, mmap_mode=mode)
@@ -1,6 +1,13 @@
 import os
 import json
 
+# Block metadata layout in metadata_dir:
+#   block_XXXX.json   metadata of one block
+#   index.log.jsonl   append-only log, one line per saved block (latest line of an index wins);
+#                     each line is a single O_APPEND write, so processes on many nodes can save concurrently
+#   index.json        compacted snapshot {"blocks": [...], "log_offset": bytes of the log already folded in}
+# Readers load the snapshot and replay the log from log_offset; compact_index_meta folds the log into the snapshot.
+
 def block_meta_path(metadata_dir: str, i: int) -> str:
     """Return the metadata file path for a single block"""
     return os.path.join(metadata_dir, f"block_{i:04d}.json")
@@ -9,10 +16,20 @@ def index_meta_path(metadata_dir: str) -> str:
     """Return to index file path"""
     return os.path.join(metadata_dir, "index.json")
 
+def index_log_path(metadata_dir: str) -> str:
+    """Return the append-only index log path"""
+    return os.path.join(metadata_dir, "index.log.jsonl")
+
+def _write_json_atomic(path: str, data: dict, indent=None):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=indent)
+    os.replace(tmp, path)
+
 # ---------- Write ----------
 def save_block_meta(metadata_dir: str, block_meta: dict):
     """
-    Save metadata for individual blocks while updating index.json
+    Save metadata for individual blocks and append it to the index log (O(1), safe across processes/nodes)
     block_meta must contain:
       index: int
       coords: [z1,z2,y1,y2,x1,x2]
@@ -21,30 +38,52 @@ def save_block_meta(metadata_dir: str, block_meta: dict):
       max_id: int
     """
     os.makedirs(metadata_dir, exist_ok=True)
-    path = block_meta_path(metadata_dir, block_meta["index"])
-    with open(path, "w") as f:
-        json.dump(block_meta, f, indent=2)
+    _write_json_atomic(block_meta_path(metadata_dir, block_meta["index"]), block_meta, indent=2)
 
-    # Update index.json
+    line = (json.dumps(block_meta, separators=(",", ":")) + "\n").encode("utf-8")
+    fd = os.open(index_log_path(metadata_dir), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def _read_index(metadata_dir: str):
+    """(blocks by index, log offset after the last complete line) from the snapshot plus the log tail"""
+    blocks, offset = {}, 0
     index_path = index_meta_path(metadata_dir)
     if os.path.exists(index_path):
         with open(index_path, "r") as f:
             index_data = json.load(f)
-    else:
-        index_data = {"blocks": []}
+        blocks = {blk["index"]: blk for blk in index_data.get("blocks", [])}
+        offset = int(index_data.get("log_offset", 0))
 
-    # Update or add the current block
-    found = False
-    for i, blk in enumerate(index_data["blocks"]):
-        if blk["index"] == block_meta["index"]:
-            index_data["blocks"][i] = block_meta
-            found = True
-            break
-    if not found:
-        index_data["blocks"].append(block_meta)
+    log_path = index_log_path(metadata_dir)
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        # A line still being appended (no newline yet) is left for the next read
+        end = tail.rfind(b"\n") + 1
+        for line in tail[:end].splitlines():
+            try:
+                blk = json.loads(line)
+            except ValueError:
+                continue
+            blocks[blk["index"]] = blk
+        offset += end
+    return blocks, offset
 
-    with open(index_path, "w") as f:
-        json.dump(index_data, f, indent=2)
+def compact_index_meta(metadata_dir: str) -> int:
+    """
+    Fold the index log into the index.json snapshot (the log itself is kept, readers skip
+    the folded part); safe to run while other processes keep saving. Returns the block count
+    """
+    if not os.path.isdir(metadata_dir):
+        return 0
+    blocks, offset = _read_index(metadata_dir)
+    _write_json_atomic(index_meta_path(metadata_dir),
+                       {"blocks": [blocks[i] for i in sorted(blocks)], "log_offset": offset}, indent=2)
+    return len(blocks)
 
 # ---------- Read ----------
 def load_block_meta(metadata_dir: str, i: int) -> dict:
@@ -56,9 +95,6 @@ def load_block_meta(metadata_dir: str, i: int) -> dict:
         return json.load(f)
 
 def load_index_meta(metadata_dir: str) -> dict:
-    """Read index.json"""
-    path = index_meta_path(metadata_dir)
-    if not os.path.exists(path):
-        return {"blocks": []}
-    with open(path, "r") as f:
-        return json.load(f)
+    """Read all block metadata (index.json snapshot + index log), sorted by block index"""
+    blocks, _ = _read_index(metadata_dir)
+    return {"blocks": [blocks[i] for i in sorted(blocks)]}
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Three-stage block pipeline: reader threads -> compute processes -> writer threads.
+Reads run ahead of compute (bounded by a prefetch depth and a memory cap), so CPU
+workers do not idle on storage reads and storage does not idle during compute.
+"""
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+class StageTimer:
+    """Busy seconds of one pipeline stage (utilization = busy / (wall * slots))"""
+
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = max(1, int(slots))
+        self.busy = 0.0
+        self.count = 0
+
+    def add(self, seconds):
+        self.busy += float(seconds)
+        self.count += 1
+
+    def utilization(self, wall):
+        return self.busy / max(1e-9, wall * self.slots)
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+def run_block_pipeline(
+    tasks,
+    read_fn,
+    compute_fn,
+    write_fn,
+    on_done=None,
+    *,
+    workers=1,
+    read_workers=2,
+    write_workers=2,
+    prefetch_depth=2,
+    memory_cap_bytes=None,
+    nbytes_fn=None,
+    compute_args=(),
+    cleanup_fn=None,
+    progress=None,
+):
+    """
+    Run tasks through read -> compute -> write.
+    tasks:      list of (i, coords)
+    read_fn:    (i, coords) -> inputs                      (reader threads)
+    compute_fn: (i, inputs, *compute_args) -> result       (worker processes; top-level, picklable)
+    write_fn:   (i, coords, result) -> out                 (writer threads)
+    on_done:    (i, out) -> None                           (main thread, e.g. metadata/checkpoint)
+    cleanup_fn: (i) -> None, called once per task after it is written or has failed (e.g. free buffers)
+    prefetch_depth:   blocks read ahead beyond the ones being computed
+    memory_cap_bytes: bound on the bytes of blocks read but not yet computed (nbytes_fn(i, coords));
+                      a single block larger than the cap is still admitted when nothing else is in flight
+    Returns: {stage -> StageTimer} with wall time under "wall"
+    """
+    pending = deque(tasks)
+    read_futs, comp_futs, write_futs = {}, {}, {}
+    ready = deque()                     # read inputs waiting for a compute slot (bounded queue)
+    held = {}                           # i -> bytes counted against the memory cap
+    timers = {
+        "read": StageTimer("read", read_workers),
+        "compute": StageTimer("compute", workers),
+        "write": StageTimer("write", write_workers),
+    }
+    nbytes_fn = nbytes_fn or (lambda i, coords: 0)
+    max_ahead = max(1, int(workers)) + max(0, int(prefetch_depth))
+    t_start = time.perf_counter()
+
+    def _admit():
+        while pending and len(read_futs) + len(ready) + len(comp_futs) < max_ahead:
+            i, coords = pending[0]
+            n = int(nbytes_fn(i, coords))
+            in_flight = sum(held.values())
+            if memory_cap_bytes and held and in_flight + n > memory_cap_bytes:
+                return
+            pending.popleft()
+            held[i] = n
+            read_futs[rex.submit(_timed, read_fn, i, coords)] = (i, coords)
+
+    def _cleanup(i):
+        if cleanup_fn is not None:
+            cleanup_fn(i)
+
+    def _dispatch():
+        # Keep the write backlog bounded too: results wait in memory until written
+        while ready and len(comp_futs) < workers and len(write_futs) < 2 * max(1, write_workers):
+            i, coords, inputs = ready.popleft()
+            comp_futs[cex.submit(_timed, compute_fn, i, inputs, *compute_args)] = (i, coords)
+
+    with ThreadPoolExecutor(max_workers=max(1, read_workers)) as rex, \
+            ProcessPoolExecutor(max_workers=max(1, workers)) as cex, \
+            ThreadPoolExecutor(max_workers=max(1, write_workers)) as wex:
+        _admit()
+        while read_futs or comp_futs or write_futs or ready:
+            _dispatch()
+            done, _ = wait(list(read_futs) + list(comp_futs) + list(write_futs), return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut in read_futs:
+                    i, coords = read_futs.pop(fut)
+                    try:
+                        inputs, dt = fut.result()
+                        timers["read"].add(dt)
+                        ready.append((i, coords, inputs))
+                    except Exception as e:
+                        held.pop(i, None)
+                        _cleanup(i)
+                        print(f"[WARN] read of block {i} failed: {e}")
+                elif fut in comp_futs:
+                    i, coords = comp_futs.pop(fut)
+                    held.pop(i, None)
+                    try:
+                        result, dt = fut.result()
+                        timers["compute"].add(dt)
+                        write_futs[wex.submit(_timed, write_fn, i, coords, result)] = (i, coords)
+                    except Exception as e:
+                        _cleanup(i)
+                        print(f"[WARN] block {i} failed: {e}")
+                else:
+                    i, coords = write_futs.pop(fut)
+                    try:
+                        out, dt = fut.result()
+                        timers["write"].add(dt)
+                        if on_done is not None:
+                            on_done(i, out)
+                    except Exception as e:
+                        print(f"[WARN] write of block {i} failed: {e}")
+                    _cleanup(i)
+                    if progress is not None:
+                        progress.update(1)
+            _admit()
+
+    timers["wall"] = time.perf_counter() - t_start
+    return timers
+
+
+def report_utilization(timers):
+    """One-line summary of per-stage utilization"""
+    wall = timers["wall"]
+    parts = []
+    for name in ("read", "compute", "write"):
+        t = timers[name]
+        parts.append(f"{name} {100.0 * t.utilization(wall):.0f}% ({t.slots} slots, {t.busy:.1f}s busy)")
+    print(f"[INFO] Pipeline utilization over {wall:.1f}s: " + ", ".join(parts))
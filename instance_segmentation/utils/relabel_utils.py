@@ -1,11 +1,225 @@
+import os
 import numpy as np
-from collections import defaultdict
 
 # ---------- ID pool operations ----------
-def update_id_pools(id_pools: list, a: int, b: int):
-    """Put a and b in the same pool."""
+class IdPoolUnionFind:
+    """
+    Array-backed disjoint-set over (sparse) uint32/uint64 IDs, used as the ID pool engine.
+    - IDs are compacted into [0..n) through a sorted id array; parent/rank are NumPy arrays
+    - find()/union() (single pairs): path compression + union by rank
+    - union_pairs() (bulk): vectorized hooking of roots + pointer jumping, no per-pair Python loop
+    - The representative of a pool is its smallest ID (same as build_rep_map_from_pools)
+    """
+
+    def __init__(self, ids=None, dtype=np.uint64):
+        ids = np.asarray([] if ids is None else ids, dtype=dtype).ravel()
+        self.ids, _ = _compact_ids(ids[ids != 0])
+        self.parent = np.arange(self.ids.size, dtype=np.int64)
+        self.rank = np.zeros(self.ids.size, dtype=np.uint8)
+
+    @classmethod
+    def from_pairs(cls, a, b):
+        """Build the pools from two aligned ID arrays (a[k] joined with b[k]); pairs containing 0 are ignored"""
+        a = np.asarray(a).ravel()
+        b = np.asarray(b).ravel()
+        dtype = np.uint32 if a.dtype.itemsize <= 4 and b.dtype.itemsize <= 4 else np.uint64
+        keep = (a != 0) & (b != 0)
+        n = int(np.count_nonzero(keep))
+        uf = cls(dtype=dtype)
+        uf.ids, inverse = _compact_ids(np.concatenate([a[keep], b[keep]]).astype(dtype, copy=False))
+        uf.parent = np.arange(uf.ids.size, dtype=np.int64)
+        uf.rank = np.zeros(uf.ids.size, dtype=np.uint8)
+        uf._union_indices(inverse[:n], inverse[n:])
+        return uf
+
+    @classmethod
+    def from_unions_file(cls, path):
+        """Bulk-load a unions.txt ("<a> <b>" per line) without per-line parsing"""
+        a, b = load_unions_txt(path)
+        return cls.from_pairs(a, b)
+
+    def __len__(self):
+        return int(self.ids.size)
+
+    def _index(self, values):
+        values = np.asarray(values, dtype=self.ids.dtype)
+        idx = np.searchsorted(self.ids, values)
+        idx[idx >= self.ids.size] = 0
+        if self.ids.size == 0 or not np.array_equal(self.ids[idx], values):
+            raise KeyError("IDs not registered in the union-find; create it with all IDs or use from_pairs")
+        return idx
+
+    def find(self, i: int) -> int:
+        """Root index of compact index i (with path compression)"""
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return int(root)
+
+    def union(self, i: int, j: int):
+        """Join compact indices i and j (union by rank)"""
+        ri, rj = self.find(i), self.find(j)
+        if ri == rj:
+            return
+        rank = self.rank
+        if rank[ri] < rank[rj]:
+            ri, rj = rj, ri
+        self.parent[rj] = ri
+        if rank[ri] == rank[rj]:
+            rank[ri] += 1
+
+    def union_pairs(self, a, b):
+        """Join aligned ID arrays a[k] and b[k] (all IDs must be registered); pairs containing 0 are ignored"""
+        a = np.asarray(a).ravel()
+        b = np.asarray(b).ravel()
+        keep = (a != 0) & (b != 0)
+        if not np.any(keep):
+            return
+        self._union_indices(self._index(a[keep]), self._index(b[keep]))
+
+    def _union_indices(self, ia, ib):
+        """
+        Bulk union on compact indices: each round hooks the larger root of every
+        unresolved edge onto the smaller one, then flattens the forest by pointer
+        jumping. Hooks always point to a smaller index, so no cycles can form.
+        """
+        ia = np.asarray(ia, dtype=np.int64)
+        ib = np.asarray(ib, dtype=np.int64)
+        parent = self.roots()
+        while ia.size:
+            ra = parent[ia]
+            rb = parent[ib]
+            todo = ra != rb
+            if not np.any(todo):
+                break
+            ia, ib, ra, rb = ia[todo], ib[todo], ra[todo], rb[todo]
+            lo = np.minimum(ra, rb)
+            hi = np.maximum(ra, rb)
+            parent[hi] = lo
+            self.parent = parent
+            parent = self.roots()
+        self.parent = parent
+
+    def add_pair(self, a: int, b: int):
+        """Join two IDs, registering unseen IDs first (slow path, prefer from_pairs for bulk input)"""
+        if a == 0 or b == 0:
+            return
+        new = np.setdiff1d(np.asarray([a, b], dtype=self.ids.dtype), self.ids)
+        if new.size:
+            old_ids, old_parent, old_rank = self.ids, self.parent, self.rank
+            self.ids = np.union1d(old_ids, new).astype(old_ids.dtype, copy=False)
+            remap = np.searchsorted(self.ids, old_ids)
+            self.parent = np.arange(self.ids.size, dtype=np.int64)
+            self.parent[remap] = remap[old_parent]
+            self.rank = np.zeros(self.ids.size, dtype=np.uint8)
+            self.rank[remap] = old_rank
+        ia, ib = self._index([a, b]).tolist()
+        self.union(ia, ib)
+
+    def roots(self) -> np.ndarray:
+        """Root index of every compact index (vectorized pointer jumping, also flattens the forest)"""
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+        self.parent = parent
+        return parent
+
+    def representatives(self) -> np.ndarray:
+        """Smallest ID in the pool of every registered ID (aligned with self.ids)"""
+        if self.ids.size == 0:
+            return self.ids.copy()
+        roots = self.roots()
+        rep = np.full(self.ids.size, np.iinfo(self.ids.dtype).max, dtype=self.ids.dtype)
+        np.minimum.at(rep, roots, self.ids)
+        return rep[roots]
+
+    def num_pools(self) -> int:
+        """Number of pools (disjoint sets of registered IDs)"""
+        if self.ids.size == 0:
+            return 0
+        roots = self.roots()
+        return int(np.count_nonzero(roots == np.arange(roots.size)))
+
+    def lookup_table(self, size: int = None, dtype=None) -> np.ndarray:
+        """
+        Dense representative lookup table: lut[id] = representative, lut[x] = x for unpooled IDs.
+        size defaults to max ID + 1 (use next_gid for the global volume)
+        """
+        size, dtype = self._table_layout(size, dtype)
+        lut = np.arange(size, dtype=dtype)
+        if self.ids.size:
+            lut[self.ids] = self.representatives().astype(dtype, copy=False)
+        return lut
+
+    def save_lookup_table(self, path: str, size: int = None, dtype=None, chunk: int = 1 << 24) -> str:
+        """
+        Write the dense lookup table to an .npy file without holding it in memory
+        (filled chunk by chunk through a memory map, then renamed into place).
+        Load it with load_lookup_table(path) to share it read-only across processes.
+        """
+        size, dtype = self._table_layout(size, dtype)
+        tmp = path + ".tmp.npy"
+        lut = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=(size,))
+        for s in range(0, size, chunk):
+            e = min(size, s + chunk)
+            lut[s:e] = np.arange(s, e, dtype=dtype)
+        if self.ids.size:
+            lut[self.ids] = self.representatives().astype(dtype, copy=False)
+        lut.flush()
+        del lut
+        os.replace(tmp, path)
+        return path
+
+    def _table_layout(self, size, dtype):
+        max_id = int(self.ids.max()) if self.ids.size else 0
+        size = max(int(size or 0), max_id + 1)
+        if dtype is None:
+            dtype = np.uint32 if size - 1 <= np.iinfo(np.uint32).max else np.uint64
+        return size, dtype
+
+    def rep_map(self) -> dict:
+        """Mapping {id -> representative id} for registered IDs (same content as build_rep_map_from_pools)"""
+        if self.ids.size == 0:
+            return {}
+        return dict(zip(self.ids.tolist(), self.representatives().tolist()))
+
+
+def _compact_ids(values: np.ndarray):
+    """Sorted unique values and the inverse index of each input value (sort based, like np.unique)"""
+    order = np.argsort(values)
+    sorted_vals = values[order]
+    first = np.ones(sorted_vals.size, dtype=bool)
+    first[1:] = sorted_vals[1:] != sorted_vals[:-1]
+    inverse = np.empty(values.size, dtype=np.int64)
+    inverse[order] = np.cumsum(first) - 1
+    return sorted_vals[first], inverse
+
+
+def load_unions_txt(path: str):
+    """Read unions.txt ("<a> <b>" per line) in bulk; return two aligned uint64 arrays"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, empty.copy()
+    flat = np.fromfile(path, dtype=np.uint64, sep=" ")
+    if flat.size % 2:
+        raise ValueError(f"Malformed unions file (odd number of IDs): {path}")
+    pairs = flat.reshape(-1, 2)
+    return np.ascontiguousarray(pairs[:, 0]), np.ascontiguousarray(pairs[:, 1])
+
+
+def update_id_pools(id_pools, a: int, b: int):
+    """Put a and b in the same pool (id_pools: list of sets or IdPoolUnionFind)."""
     if a == 0 or b == 0:
         return
+    if isinstance(id_pools, IdPoolUnionFind):
+        id_pools.add_pair(a, b)
+        return
     found = []
     for idx, s in enumerate(id_pools):
         if a in s or b in s:
@@ -22,8 +236,10 @@ def update_id_pools(id_pools: list, a: int, b: int):
         del id_pools[idx]
     id_pools.append(merged)
 
-def build_rep_map_from_pools(id_pools: list):
-    """Construct a mapping {id -> representative id} from the pool."""
+def build_rep_map_from_pools(id_pools):
+    """Construct a mapping {id -> representative id} from the pool (list of sets or IdPoolUnionFind)."""
+    if isinstance(id_pools, IdPoolUnionFind):
+        return id_pools.rep_map()
     rep_map = {}
     for s in id_pools:
         if not s:
@@ -33,37 +249,23 @@ def build_rep_map_from_pools(id_pools: list):
             rep_map[int(x)] = rep
     return rep_map
 
-def _build_totals_and_best(pair_counts):
-    by_local  = defaultdict(int)
-    by_global = defaultdict(int)
-    for (la, gb), c in pair_counts.items():
-        by_local[la]  += c
-        by_global[gb] += c
-
-    best_gb_for_la = {}
-    second_la = {}
-    tmp_map = defaultdict(list)
-    for (la, gb), c in pair_counts.items():
-        tmp_map[la].append((gb, c))
-    for la, lst in tmp_map.items():
-        lst.sort(key=lambda x: x[1], reverse=True)
-        best_gb_for_la[la] = lst[0][0]
-        second_la[la] = lst[1][1] if len(lst) > 1 else 0
-
-    best_la_for_gb = {}
-    second_gb = {}
-    tmp_map.clear()
-    for (la, gb), c in pair_counts.items():
-        tmp_map[gb].append((la, c))
-    for gb, lst in tmp_map.items():
-        lst.sort(key=lambda x: x[1], reverse=True)
-        best_la_for_gb[gb] = lst[0][0]
-        second_gb[gb] = lst[1][1] if len(lst) > 1 else 0
-
-    return by_local, by_global, best_gb_for_la, best_la_for_gb, second_la, second_gb
+def _pair_arrays(pair_counts: dict):
+    """Explode a {(la, gb) -> count} dict into aligned (la, gb, cnt) arrays, keeping dict order"""
+    n = len(pair_counts)
+    keys = np.fromiter((k for pair in pair_counts.keys() for k in pair), dtype=np.uint64, count=2 * n).reshape(n, 2)
+    cnt = np.fromiter(pair_counts.values(), dtype=np.int64, count=n)
+    return keys[:, 0], keys[:, 1], cnt
 
-def select_pairs(
-    pair_counts: dict,
+def _totals_per_label(labels, cnt):
+    """Sum of counts per label, broadcast back onto each pair (bincount over compacted IDs)"""
+    _, inverse = _compact_ids(labels)
+    totals = np.bincount(inverse, weights=cnt).astype(np.int64)
+    return totals[inverse], inverse
+
+def select_pairs_arrays(
+    la: np.ndarray,
+    gb: np.ndarray,
+    cnt: np.ndarray,
     min_overlap_vox: int,
     min_frac_local: float,
     min_frac_global: float,
@@ -74,79 +276,123 @@ def select_pairs(
     min_iou: float,
     debug: bool = False
 ):
-    if not pair_counts:
+    """
+    Array-native select_pairs: la/gb/cnt are aligned pair arrays (e.g. from count_label_pairs).
+    Totals, fractions, IoU and threshold filters are computed in NumPy; the result is the
+    same list of (la, gb) as select_pairs on the equivalent dict.
+    """
+    la = np.asarray(la, dtype=np.uint64)
+    gb = np.asarray(gb, dtype=np.uint64)
+    cnt = np.asarray(cnt, dtype=np.int64)
+    if cnt.size == 0:
         return []
 
-    (by_local, by_global,
-     best_gb_for_la, best_la_for_gb,
-     second_la, second_gb) = _build_totals_and_best(pair_counts)
-
-    candidates = []
-    for (la, gb), c in pair_counts.items():
-        if la == 0 or gb == 0:
-            continue
-        if c < int(min_overlap_vox):
-            continue
-
-        tot_la = by_local.get(la, 0)
-        tot_gb = by_global.get(gb, 0)
-        if tot_la == 0 or tot_gb == 0:
-            continue
-
-        frac_local  = c / float(tot_la)
-        frac_global = c / float(tot_gb)
-        
-        if tot_gb > max_voxel_size:
-            continue
-        if frac_local  < float(min_frac_local) and frac_global < float(min_frac_global):
-            continue
-        
-        # if frac_global < float(min_frac_global):
-        #     continue
-
-        # if require_reciprocal:
-        #     if not (best_gb_for_la.get(la) == gb and best_la_for_gb.get(gb) == la):
-        #         continue
-
-        # sec_la = second_la.get(la, 0)
-        # sec_gb = second_gb.get(gb, 0)
-        # if sec_la > 0 and c < sec_la * dom_ratio:
-        #     continue
-        # if sec_gb > 0 and c < sec_gb * dom_ratio:
-        #     continue
-
-        denom = (tot_la + tot_gb - c)
-        iou = c / float(denom) if denom > 0 else 0.0
+    tot_la, _ = _totals_per_label(la, cnt)
+    tot_gb, _ = _totals_per_label(gb, cnt)
 
-        candidates.append((la, gb, c, frac_local, frac_global, iou))
+    keep = (la != 0) & (gb != 0)
+    keep &= cnt >= int(min_overlap_vox)
+    keep &= (tot_la != 0) & (tot_gb != 0)
+    keep &= ~(tot_gb > max_voxel_size)
+    safe_la = np.where(tot_la == 0, 1, tot_la).astype(np.float64)
+    safe_gb = np.where(tot_gb == 0, 1, tot_gb).astype(np.float64)
+    frac_local = cnt / safe_la
+    frac_global = cnt / safe_gb
+    keep &= ~((frac_local < float(min_frac_local)) & (frac_global < float(min_frac_global)))
 
-    if not candidates:
+    idx = np.flatnonzero(keep)
+    if idx.size == 0:
         return []
+    c = cnt[idx]
+    denom = tot_la[idx] + tot_gb[idx] - c
+    iou = np.where(denom > 0, c / np.where(denom > 0, denom, 1).astype(np.float64), 0.0)
+    cand_la = la[idx].tolist()
+    cand_gb = gb[idx].tolist()
+
+    # Stable descending sort by (count, IoU): ties keep the input order
+    order = np.lexsort((-iou, -c)).tolist()
 
     if allow_union_ambiguity:
         if debug:
-            candidates.sort(key=lambda x: (x[2], x[5]), reverse=True)
-            for la, gb, c, fl, fg, iou in candidates[:10]:
-                print(f"[DEBUG] cand la={la} gb={gb} c={c} fracL={fl:.3f} fracG={fg:.3f} IoU={iou:.3f}")
-        return [(la, gb) for la, gb, *_ in candidates]
+            fl, fg = frac_local[idx], frac_global[idx]
+            for k in order[:10]:
+                print(f"[DEBUG] cand la={cand_la[k]} gb={cand_gb[k]} c={int(c[k])} "
+                      f"fracL={fl[k]:.3f} fracG={fg[k]:.3f} IoU={iou[k]:.3f}")
+            return [(cand_la[k], cand_gb[k]) for k in order]
+        return list(zip(cand_la, cand_gb))
 
-    candidates.sort(key=lambda x: (x[2], x[5]), reverse=True)
     used_la = set()
     used_gb = set()
     selected = []
-    for la, gb, c, fl, fg, iou in candidates:
-        if la in used_la and gb in used_gb:
+    for k in order:
+        a, b = cand_la[k], cand_gb[k]
+        if a in used_la and b in used_gb:
             continue
-        selected.append((la, gb))
-        used_la.add(la)
-        used_gb.add(gb)
+        selected.append((a, b))
+        used_la.add(a)
+        used_gb.add(b)
     if debug:
-        print(f"[DEBUG] selected {len(selected)} pairs (1-1), from {len(candidates)} candidates")
+        print(f"[DEBUG] selected {len(selected)} pairs (1-1), from {idx.size} candidates")
     return selected
 
+def select_pairs(
+    pair_counts: dict,
+    min_overlap_vox: int,
+    min_frac_local: float,
+    min_frac_global: float,
+    max_voxel_size: int,
+    require_reciprocal: bool,
+    allow_union_ambiguity: bool,
+    dom_ratio: float,
+    min_iou: float,
+    debug: bool = False
+):
+    if not pair_counts:
+        return []
+    la, gb, cnt = _pair_arrays(pair_counts)
+    return select_pairs_arrays(
+        la, gb, cnt,
+        min_overlap_vox=min_overlap_vox,
+        min_frac_local=min_frac_local,
+        min_frac_global=min_frac_global,
+        max_voxel_size=max_voxel_size,
+        require_reciprocal=require_reciprocal,
+        allow_union_ambiguity=allow_union_ambiguity,
+        dom_ratio=dom_ratio,
+        min_iou=min_iou,
+        debug=debug,
+    )
+
 # ---------- relabel ----------
-def relabel_array_inplace_with_map(arr: np.ndarray, mapping: dict):
-    """In-place relabeling ID"""
+def load_lookup_table(path: str) -> np.ndarray:
+    """Memory-map a lookup table written by IdPoolUnionFind.save_lookup_table (read-only, shared page cache)"""
+    return np.load(path, mmap_mode="r")
+
+def lookup_table_from_map(mapping: dict, size: int = None) -> np.ndarray:
+    """Dense lookup table from {id -> rep}: lut[id] = rep, identity elsewhere (size defaults to max key + 1)"""
+    if not mapping:
+        return np.arange(int(size or 1), dtype=np.uint32)
+    keys = np.fromiter(mapping.keys(), dtype=np.uint64, count=len(mapping))
+    vals = np.fromiter(mapping.values(), dtype=np.uint64, count=len(mapping))
+    size = max(int(size or 0), int(keys.max()) + 1)
+    dtype = np.uint32 if max(size - 1, int(vals.max())) <= np.iinfo(np.uint32).max else np.uint64
+    lut = np.arange(size, dtype=dtype)
+    lut[keys] = vals.astype(dtype, copy=False)
+    return lut
+
+def relabel_array_inplace_with_map(arr: np.ndarray, mapping):
+    """In-place relabeling ID (mapping: dict {id -> rep} or dense lookup table, e.g. a memory-mapped .npy)"""
+    if isinstance(mapping, np.ndarray):
+        if mapping.size == 0 or arr.size == 0:
+            return
+        if int(arr.max()) < mapping.size:
+            # Single gather; take() buffers `out`, so aliasing arr is safe
+            np.take(mapping, arr, out=arr)
+        else:
+            # IDs beyond the table are left unchanged
+            inside = arr < mapping.size
+            arr[inside] = mapping[arr[inside]]
+        return
     ids = np.unique(arr)
     ids = ids[ids != 0]
     if ids.size == 0 or not mapping:
@@ -191,20 +437,34 @@ def relabel_array_inplace_with_map(arr: np.ndarray, mapping: dict):
         flat[flat_idx[match]] = vals_sorted[idx[match]]
 
 # ---------- overlap statistics ----------
-def accumulate_local_global_pairs(seg_local_zyx: np.ndarray,
-                                  seg_global_overlap_zyx: np.ndarray,
-                                  pair_counts: dict):
-    """Count the frequency of paired IDs with local and global overlap"""
+def count_label_pairs(seg_local_zyx: np.ndarray, seg_global_overlap_zyx: np.ndarray):
+    """
+    Count co-occurring non-zero ID pairs of two aligned arrays.
+    Return: (la, gb, cnt) arrays sorted by (la, gb)
+    """
     a = seg_local_zyx
     b = seg_global_overlap_zyx
     m = (a != 0) & (b != 0)
     if not np.any(m):
-        return
+        empty = np.zeros(0, dtype=np.uint32)
+        return empty, empty.copy(), np.zeros(0, dtype=np.int64)
     a1 = a[m].astype(np.uint32, copy=False)
     b1 = b[m].astype(np.uint32, copy=False)
-    keys = (a1.astype(np.uint64) << 32) | b1.astype(np.uint64)
-    uniq, cnt = np.unique(keys, return_counts=True)
-    la = (uniq >> 32).astype(np.uint32)
+    keys = (a1.astype(np.uint64) << np.uint64(32)) | b1.astype(np.uint64)
+    keys.sort()
+    first = np.ones(keys.size, dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    uniq = keys[starts]
+    cnt = np.diff(np.append(starts, keys.size)).astype(np.int64)
+    la = (uniq >> np.uint64(32)).astype(np.uint32)
     gb = (uniq & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    return la, gb, cnt
+
+def accumulate_local_global_pairs(seg_local_zyx: np.ndarray,
+                                  seg_global_overlap_zyx: np.ndarray,
+                                  pair_counts: dict):
+    """Count the frequency of paired IDs with local and global overlap"""
+    la, gb, cnt = count_label_pairs(seg_local_zyx, seg_global_overlap_zyx)
     for u_la, u_gb, c in zip(la.tolist(), gb.tolist(), cnt.tolist()):
         pair_counts[(u_la, u_gb)] = pair_counts.get((u_la, u_gb), 0) + int(c)
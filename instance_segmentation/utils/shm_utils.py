@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory block buffers: the main process places block arrays in
+multiprocessing.shared_memory segments and passes only small references to
+worker processes, which attach zero-copy instead of unpickling the data.
+"""
+import threading
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Picklable handle of an array living in a shared-memory segment
+SharedArrayRef = namedtuple("SharedArrayRef", ["name", "shape", "dtype"])
+
+
+def attach_shared(ref: SharedArrayRef):
+    """
+    Attach to a shared array in another process (zero-copy).
+    Returns: (ndarray view, SharedMemory handle); call handle.close() when done, never unlink().
+    """
+    shm = shared_memory.SharedMemory(name=ref.name)
+    arr = np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=shm.buf)
+    return arr, shm
+
+
+class SharedBlockPool:
+    """
+    Pool of reusable shared-memory segments owned by the main process.
+    alloc() hands out a segment at least as large as requested (reusing released ones,
+    smallest fit first); release() returns it to the pool; close() unlinks everything.
+    Thread-safe, so reader and writer threads can share one pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segments = {}     # name -> SharedMemory
+        self._free = []         # names of released segments
+        self._owned = {}        # owner key -> [names]
+
+    def alloc(self, shape, dtype, owner=None):
+        """Return (SharedArrayRef, ndarray view) of a segment for an array of shape/dtype"""
+        dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+        with self._lock:
+            fits = [n for n in self._free if self._segments[n].size >= nbytes]
+            if fits:
+                name = min(fits, key=lambda n: self._segments[n].size)
+                self._free.remove(name)
+                shm = self._segments[name]
+            else:
+                shm = shared_memory.SharedMemory(create=True, size=nbytes)
+                name = shm.name
+                self._segments[name] = shm
+            if owner is not None:
+                self._owned.setdefault(owner, []).append(name)
+        ref = SharedArrayRef(name, tuple(int(s) for s in shape), dtype.str)
+        return ref, np.ndarray(ref.shape, dtype=dtype, buffer=shm.buf)
+
+    def put(self, arr, owner=None):
+        """Copy an array into a pooled segment; return its SharedArrayRef"""
+        ref, view = self.alloc(arr.shape, arr.dtype, owner=owner)
+        np.copyto(view, arr)
+        return ref
+
+    def view(self, ref: SharedArrayRef):
+        """ndarray view of a segment of this pool (main process)"""
+        shm = self._segments[ref.name]
+        return np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=shm.buf)
+
+    def release(self, ref_or_name):
+        name = ref_or_name.name if isinstance(ref_or_name, SharedArrayRef) else ref_or_name
+        with self._lock:
+            if name in self._segments and name not in self._free:
+                self._free.append(name)
+
+    def release_owner(self, owner):
+        """Release every segment allocated for owner (e.g. a block index)"""
+        with self._lock:
+            names = self._owned.pop(owner, [])
+        for name in names:
+            self.release(name)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(shm.size for shm in self._segments.values())
+
+    def close(self):
+        with self._lock:
+            for shm in self._segments.values():
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+                try:
+                    shm.close()
+                except BufferError:
+                    # A view is still alive; the mapping goes away with it
+                    pass
+            self._segments.clear()
+            self._free.clear()
+            self._owned.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import socket
+from contextlib import contextmanager
+
+import numpy as np
+
+# ---------- Per-task telemetry ----------
+# One JSON line per finished block/pair task, appended to <metadata_dir>/telemetry.jsonl:
+#   stage, task, worker, start, end, wall_s, phases {name: seconds},
+#   and optional bytes_read, bytes_written, peak_rss_mb, n_supervoxels, n_edges, voxels
+# Each record is a single O_APPEND write, so concurrent writers (HPC shards) do not interleave lines.
+TELEMETRY_FILE = "telemetry.jsonl"
+
+
+def telemetry_enabled(cfg) -> bool:
+    """telemetry.enable of the global config (default on)"""
+    return bool((cfg.get("telemetry", {}) or {}).get("enable", True))
+
+
+def telemetry_path(metadata_dir: str) -> str:
+    """Return the telemetry JSONL path of a metadata folder"""
+    return os.path.join(metadata_dir, TELEMETRY_FILE)
+
+
+def worker_id() -> str:
+    """host:pid of the calling process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@contextmanager
+def timed(phases: dict, name: str):
+    """Add the wall time of the with-block to phases[name] (seconds)"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - t0
+
+
+def task_record(stage: str, task, start: float, phases: dict, worker: str = None, **fields) -> dict:
+    """
+    Build a telemetry record; start is the task's time.time() start, fields with None values are dropped.
+    task: block index or (i, j) block pair
+    """
+    end = time.time()
+    record = {
+        "stage": stage,
+        "task": list(task) if isinstance(task, (tuple, list)) else task,
+        "worker": worker or worker_id(),
+        "start": round(start, 3),
+        "end": round(end, 3),
+        "wall_s": round(end - start, 4),
+        "phases": {k: round(float(v), 4) for k, v in phases.items()},
+    }
+    record.update({k: v for k, v in fields.items() if v is not None})
+    return record
+
+
+def append_telemetry(metadata_dir: str, record: dict):
+    """Append one record to the telemetry log"""
+    os.makedirs(metadata_dir, exist_ok=True)
+    line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+    fd = os.open(telemetry_path(metadata_dir), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def load_telemetry(metadata_dir: str, stage: str = None) -> list:
+    """Read all telemetry records (of one stage); torn or malformed lines are skipped"""
+    path = telemetry_path(metadata_dir)
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if stage is None or rec.get("stage") == stage:
+                records.append(rec)
+    return records
+
+
+def summarize_telemetry(records: list, total: int = None, straggler_factor: float = 2.0,
+                        max_stragglers: int = 5) -> dict:
+    """
+    Aggregate the records of one stage: throughput, per-phase means, wall-time percentiles,
+    stragglers (wall time above straggler_factor x median) and ETA (when the total task count is known).
+    Re-run tasks count once (latest record).
+    """
+    latest = {}
+    for rec in records:
+        latest[json.dumps(rec["task"])] = rec
+    records = sorted(latest.values(), key=lambda r: r["end"])
+    if not records:
+        return {"done": 0, "total": total}
+    wall = np.asarray([r["wall_s"] for r in records], dtype=np.float64)
+    span = max(r["end"] for r in records) - min(r["start"] for r in records)
+    rate = len(records) / span if span > 0 else float("nan")
+    median = float(np.median(wall))
+
+    phases = {}
+    for r in records:
+        for k, v in r.get("phases", {}).items():
+            phases.setdefault(k, []).append(v)
+    stragglers = [r for r in records if median > 0 and r["wall_s"] > straggler_factor * median]
+    stragglers.sort(key=lambda r: -r["wall_s"])
+
+    summary = {
+        "done": len(records),
+        "total": total,
+        "span_s": span,
+        "tasks_per_s": rate,
+        "wall_p50_s": median,
+        "wall_p95_s": float(np.percentile(wall, 95)),
+        "wall_max_s": float(wall.max()),
+        "phase_mean_s": {k: float(np.mean(v)) for k, v in phases.items()},
+        "bytes_read": int(sum(r.get("bytes_read", 0) for r in records)),
+        "bytes_written": int(sum(r.get("bytes_written", 0) for r in records)),
+        "peak_rss_mb_max": max((r.get("peak_rss_mb", 0) for r in records), default=0),
+        "workers": len({r.get("worker") for r in records}),
+        "stragglers": [{"task": r["task"], "wall_s": r["wall_s"], "worker": r.get("worker")}
+                       for r in stragglers[:max_stragglers]],
+        "n_stragglers": len(stragglers),
+    }
+    if total is not None and rate == rate and rate > 0:
+        summary["eta_s"] = max(0, int(total) - len(records)) / rate
+    return summary
+
+
+def print_telemetry_status(metadata_dir: str, totals: dict = None, straggler_factor: float = 2.0):
+    """Print the summary of every stage recorded in a metadata folder; totals: {stage: task count}"""
+    records = load_telemetry(metadata_dir)
+    if not records:
+        print(f"[INFO] No telemetry at {telemetry_path(metadata_dir)}")
+        return
+    totals = totals or {}
+    for stage in sorted({r["stage"] for r in records}):
+        s = summarize_telemetry([r for r in records if r["stage"] == stage],
+                                total=totals.get(stage), straggler_factor=straggler_factor)
+        total = f"/{s['total']}" if s["total"] is not None else ""
+        print(f"[{stage}] {s['done']}{total} tasks in {s['span_s']:.0f}s on {s['workers']} workers, "
+              f"{s['tasks_per_s'] * 3600:.1f} tasks/h, "
+              f"read {s['bytes_read'] / 1024 ** 3:.2f} GB, written {s['bytes_written'] / 1024 ** 3:.2f} GB, "
+              f"peak RSS {s['peak_rss_mb_max']:.0f} MB")
+        print(f"    wall p50 {s['wall_p50_s']:.1f}s, p95 {s['wall_p95_s']:.1f}s, max {s['wall_max_s']:.1f}s; "
+              + ", ".join(f"{k} {v:.2f}s" for k, v in s["phase_mean_s"].items()))
+        if "eta_s" in s:
+            print(f"    ETA {s['eta_s'] / 60:.1f} min")
+        if s["n_stragglers"]:
+            print(f"    {s['n_stragglers']} stragglers (> {straggler_factor:g}x median): "
+                  + ", ".join(f"{t['task']} {t['wall_s']:.1f}s @ {t['worker']}" for t in s["stragglers"]))
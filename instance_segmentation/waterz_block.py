@@ -1,9 +1,16 @@
+import time
 import numpy as np
-from scipy.ndimage import distance_transform_edt, watershed_ift
+from scipy.ndimage import distance_transform_edt, watershed_ift, maximum_filter, label as nd_label
 from skimage.feature import peak_local_max
 from skimage.segmentation import watershed
 from waterz import agglomerate
+import waterz
 import mahotas
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+try:
+    import edt as _edt  # multi-threaded, anisotropic EDT (optional)
+except ImportError:
+    _edt = None
 
 # ---------- Foundation ----------
 def boundary_from_aff(aff):
@@ -15,41 +22,110 @@ def boundary_from_aff(aff):
     B = 1.0 - aff.mean(axis=0)  # (z,y,x)
     return np.ascontiguousarray(B.astype(np.float32, copy=False))
 
-def compact_labels_uint32(labels):
+def boundary_from_aff_u8(aff):
+    """
+    Boundary map as uint8 from uint8 affinities (c,z,y,x) in 0..255:
+    B = 255 - round(mean(aff)), i.e. 255 * (1 - mean) without float copies of the block
+    """
+    acc = aff[0].astype(np.uint16)
+    for c in range(1, aff.shape[0]):
+        acc += aff[c]
+    n = aff.shape[0]
+    acc += n // 2
+    acc //= n
+    B = np.empty(acc.shape, dtype=np.uint8)
+    np.subtract(255, acc, out=B, casting="unsafe")
+    return B
+
+def affinities_float32(aff, scale=None):
+    """
+    Contiguous float32 affinities in [0, 1] for waterz, made with a single allocation
+    (scale: 1/255 for 8-bit input; None -> 1/255 if aff.max() > 1)
+    """
+    if scale is None:
+        scale = 1.0 / 255.0 if aff.max() > 1.0 else 1.0
+    if aff.dtype == np.float32 and scale == 1.0 and aff.flags["C_CONTIGUOUS"]:
+        return aff
+    out = np.empty(aff.shape, dtype=np.float32)
+    np.copyto(out, aff, casting="unsafe")
+    if scale != 1.0:
+        out *= np.float32(scale)
+    return out
+
+def compact_labels_uint32(labels, dtype=np.uint32):
     """
     Compress label IDs into a continuous range [0..N]
+    dtype: output dtype (np.uint64 yields waterz fragments directly, without another copy)
     """
     lab = np.asarray(labels)
     ids = np.unique(lab)
     if ids.size == 0 or (ids.size == 1 and ids[0] == 0):
-        return lab.astype(np.uint32, copy=False), np.arange(1, dtype=np.uint32)
+        return lab.astype(dtype, copy=False), np.arange(1, dtype=dtype)
     if ids[0] != 0:
         ids = np.insert(ids, 0, 0)
-    lut = np.zeros(int(ids.max()) + 1, dtype=np.uint32)
-    lut[ids] = np.arange(ids.size, dtype=np.uint32)
-    comp = lut[lab].astype(np.uint32, copy=False)
+    lut = np.zeros(int(ids.max()) + 1, dtype=dtype)
+    lut[ids] = np.arange(ids.size, dtype=dtype)
+    comp = lut[lab]
     return np.ascontiguousarray(comp), lut
 
-def seeds_3d_from_B(B, interior_thr=0.4, min_distance=15):
+def seeds_3d_from_B(B, interior_thr=0.4, min_distance=15, method="peak_local_max", sampling=None):
     """
     Generate seed points from boundaries (watershed markers)
+    B: float boundary map in [0, 1], or uint8 in 0..255 (interior_thr stays in [0, 1])
+    method: "peak_local_max" (skimage peaks with min_distance suppression) or "maxfilter"
+        (float32 distance_map, voxels equal to the maximum of their window, one seed per
+        connected plateau; much faster on large blocks, but peaks closer than min_distance
+        are only suppressed when one dominates the other's window)
+    sampling: voxel spacing (z, y, x) for an anisotropy-aware EDT; the max-filter window keeps the
+        same physical size, min_distance counting voxels along the finest axis (None: isotropic)
     """
-    interior = 1.0 - B
+    if B.dtype == np.uint8:
+        interior = 255 - B
+        interior_thr = interior_thr * 255.0
+    else:
+        interior = 1.0 - B
     mask = interior > interior_thr
     if not np.any(mask):
         thr = float(np.percentile(interior, 70.0))
         mask = interior > thr
-    D = distance_transform_edt(mask)
-    coords = peak_local_max(D, min_distance=min_distance, labels=mask, exclude_border=False)
-    markers = np.zeros(B.shape, np.int32)
-    for i, (z, y, x) in enumerate(coords, 1):
-        markers[z, y, x] = i
+    if method == "maxfilter":
+        D = distance_map(mask, sampling)
+        markers = _maxfilter_seeds(D, mask, min_distance, sampling)
+    elif method == "peak_local_max":
+        D = distance_transform_edt(mask, sampling=sampling)
+        coords = peak_local_max(D, min_distance=min_distance, labels=mask, exclude_border=False)
+        markers = np.zeros(B.shape, np.int32)
+        markers[tuple(coords.T)] = np.arange(1, len(coords) + 1, dtype=np.int32)
+    else:
+        raise ValueError(f"Unknown seed method: {method}")
     if markers.max() == 0 and np.any(mask):
         zmax = int(np.argmax(D.reshape(D.shape[0], -1).max(axis=1)))
         zy, zx = np.unravel_index(int(D[zmax].argmax()), D[zmax].shape)
         markers[zmax, zy, zx] = 1
     return np.ascontiguousarray(markers), mask
 
+def distance_map(mask, sampling=None):
+    """
+    float32 Euclidean distance of each foreground voxel to the background, voxel spacing
+    sampling (z, y, x); uses the `edt` package when installed, scipy otherwise
+    """
+    if _edt is not None:
+        anisotropy = tuple(float(s) for s in sampling) if sampling is not None else (1.0,) * mask.ndim
+        return _edt.edt(np.ascontiguousarray(mask), anisotropy=anisotropy, black_border=False, parallel=1)
+    return distance_transform_edt(mask, sampling=sampling).astype(np.float32)
+
+def _maxfilter_seeds(D, mask, min_distance, sampling=None):
+    """Local maxima of D over a (2r+1)-wide window per axis, labelled one seed per connected plateau"""
+    radius = [int(min_distance)] * D.ndim
+    if sampling is not None:
+        finest = float(min(sampling))
+        radius = [int(round(min_distance * finest / float(s))) for s in sampling]
+    size = [2 * r + 1 for r in radius]
+    peaks = D == maximum_filter(D, size=size, mode="nearest")
+    peaks &= mask
+    markers, _ = nd_label(peaks, structure=np.ones((3,) * D.ndim, dtype=bool), output=np.int32)
+    return markers
+
 def getScoreFunc(scoreF="aff50_his256"):
     """
     Return the waterz scoring function (simplified version)
@@ -93,22 +169,124 @@ def get_seeds_2d(boundary, method='grid', next_id = 1,
         seeds[seeds==next_id] = 0
     return seeds, num_seeds
 
-def watershed_2d(affs, seed_method, use_mahotas_watershed = True):
-    affs_xy = 1.0 - 0.5*(affs[1] + affs[2])
-    depth  = affs_xy.shape[0]
-    fragments = np.zeros_like(affs[0]).astype(np.uint64)
-    next_id = 1
-    for z in range(depth):
-        seeds, num_seeds = get_seeds_2d(affs_xy[z], next_id=next_id, method=seed_method)
-        if use_mahotas_watershed:
-            fragments[z] = mahotas.cwatershed(affs_xy[z], seeds)
-        else:
-            fragments[z] = watershed_ift((255.0*affs_xy[z]).astype(np.uint8), seeds)
-        next_id += num_seeds
+def _watershed_slice(a1, a2, seed_method, use_mahotas_watershed=True, scale=1.0):
+    """2D watershed of one z-slice with slice-local ids (next_id = 1); return (fragments, num_seeds)"""
+    if scale != 1.0:
+        a1 = a1.astype(np.float32) * np.float32(scale)
+        a2 = a2.astype(np.float32) * np.float32(scale)
+    affs_xy = 1.0 - 0.5*(a1 + a2)
+    seeds, num_seeds = get_seeds_2d(affs_xy, next_id=1, method=seed_method)
+    if use_mahotas_watershed:
+        return mahotas.cwatershed(affs_xy, seeds), num_seeds
+    return watershed_ift((255.0*affs_xy).astype(np.uint8), seeds), num_seeds
+
+def watershed_2d(affs, seed_method, use_mahotas_watershed = True, scale = 1.0, workers = 1, executor = "thread"):
+    """
+    Per-slice 2D watershed on the xy boundary map 1 - (affs[1] + affs[2]) / 2
+    scale: factor mapping affs to [0, 1] (1/255 for uint8 affinities); the boundary
+    map is computed slice by slice, so no float copy of the whole block is made
+    workers: slices segmented concurrently; each slice is labelled from 1 and shifted afterwards
+        by the prefix sum of the seed counts of the slices before it (same ids as the serial loop)
+    executor: "thread" (mahotas releases the GIL in cwatershed/regmax/label) or "process"
+    """
+    depth  = affs.shape[1]
+    fragments = np.zeros(affs.shape[1:], dtype=np.uint64)
+    counts = np.zeros(depth, dtype=np.int64)
+    args = (seed_method, use_mahotas_watershed, scale)
+    if workers <= 1 or depth < 2:
+        for z in range(depth):
+            fragments[z], counts[z] = _watershed_slice(affs[1][z], affs[2][z], *args)
+    elif executor == "process":
+        with ProcessPoolExecutor(max_workers=min(workers, depth)) as ex:
+            futs = {ex.submit(_watershed_slice, affs[1][z], affs[2][z], *args): z for z in range(depth)}
+            for fut in as_completed(futs):
+                z = futs.pop(fut)
+                fragments[z], counts[z] = fut.result()
+    else:
+        def _run(z):
+            fragments[z], counts[z] = _watershed_slice(affs[1][z], affs[2][z], *args)
+        with ThreadPoolExecutor(max_workers=min(workers, depth)) as ex:
+            list(ex.map(_run, range(depth)))
 
+    # Slice z starts after the ids of slices < z
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.uint64)
+    for z in range(1, depth):
+        if offsets[z]:
+            np.add(fragments[z], offsets[z], out=fragments[z], where=fragments[z] > 0)
     return fragments
 
 
+def prebuild_waterz(merge_functions, discretize_queue=256, cache_dir=None):
+    """
+    Compile the waterz agglomeration modules once before dispatching blocks
+    merge_functions: str or list of str, e.g. 'aff50_his256'
+    Return: {merge_function -> compiled module name}
+    """
+    if isinstance(merge_functions, str):
+        merge_functions = [merge_functions]
+    built = {}
+    for mf in dict.fromkeys(merge_functions):
+        built[mf] = waterz.build(getScoreFunc(mf), discretize_queue=discretize_queue, cache_dir=cache_dir)
+    return built
+
+# ---------- Merge history ----------
+# One row per waterz merge: region b merged into a (c == a, the surviving id) at score
+MERGE_HISTORY_DTYPE = np.dtype([("a", "<u8"), ("b", "<u8"), ("c", "<u8"), ("score", "<f4")])
+
+def merge_history_array(merge_history):
+    """waterz merge history (list of {'a','b','c','score'} dicts) -> MERGE_HISTORY_DTYPE array"""
+    out = np.empty(len(merge_history), dtype=MERGE_HISTORY_DTYPE)
+    for name in MERGE_HISTORY_DTYPE.names:
+        out[name] = [m[name] for m in merge_history]
+    return out
+
+def replay_merge_history(fragments, merges, threshold):
+    """
+    Segmentation at threshold from the initial fragments and the merge history of one block,
+    without affinities: union-find over the merges waterz performs below threshold
+    (it stops at the first merge scoring >= threshold), resolved by pointer jumping.
+    Labels match a direct agglomerate() run at that threshold (exactly with discretize_queue=0;
+    with a binned queue, up to the merges of the bin containing the threshold).
+    fragments: (z,y,x) uint labels; merges: MERGE_HISTORY_DTYPE array in merge order
+    Returns: uint32 segmentation
+    """
+    scores = merges["score"]
+    above = scores >= np.float32(threshold)
+    n = int(np.argmax(above)) if above.any() else len(merges)
+    a = merges["a"][:n]
+    b = merges["b"][:n]
+    size = int(max(fragments.max(initial=0), a.max(initial=0), b.max(initial=0))) + 1
+    parent = np.arange(size, dtype=np.uint64)
+    parent[b] = a           # each region is merged away at most once
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            break
+        parent = grand
+    return np.take(parent.astype(np.uint32), fragments)
+
+# ---------- Memory ----------
+def reset_peak_rss():
+    """Reset the peak RSS high-water mark of this process (Linux >= 4.0); return False if unsupported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_bytes():
+    """Peak RSS of this process (VmHWM; falls back to ru_maxrss, which cannot be reset)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+
 # ---------- Main ----------
 def run_waterz_block(
     aff_block_czyx,
@@ -120,44 +298,176 @@ def run_waterz_block(
     min_distance=3,
     sv_2d='maxima_distance',
     merge_function=None,
+    discretize_queue=256,
+    waterz_cache_dir=None,
+    memory_lean=False,
+    stats=None,
+    on_threshold=None,
+    history=None,
+    history_threshold=None,
+    seed_method="peak_local_max",
+    seed_sampling=None,
+    sv_2d_workers=1,
+    sv_2d_executor="thread",
 ):
     """
     Perform waterz partitioning within a block
     aff_block_czyx: (c,z,y,x)
+    waterz_cache_dir: directory of compiled waterz modules (None -> $WATERZ_CACHE_DIR or ~/.cython/inline)
+    memory_lean: keep uint8 affinities as uint8 through boundary map, seeds and watershed;
+        the float32 copy waterz needs is made once, right before agglomeration
+    stats: optional dict, filled with "peak_rss_mb" (process peak RSS during this block), the wall
+        times "time_supervoxel", "time_agglomerate" (region graph + merging) and "time_on_threshold"
+        (callbacks), and "n_supervoxels" / "n_edges" of the initial region graph
+    on_threshold: optional callback(threshold, seg_uint32) called for every threshold (ascending) as
+        soon as the single agglomeration pass reaches it; seg is only valid during the call
+    history: optional dict, filled with "fragments" (uint32 zyx, before agglomeration), "merges"
+        (MERGE_HISTORY_DTYPE, in merge order) and "max_threshold", for replay_merge_history
+    history_threshold: keep agglomerating up to this threshold (without output) so the history
+        also covers re-thresholding above seg_thresholds
+    seed_method, seed_sampling: 3D seeding backend and EDT voxel spacing (z, y, x), see seeds_3d_from_B
+    sv_2d_workers, sv_2d_executor: slice-parallel 2D supervoxels, see watershed_2d
+    sv_type: "3d" / "2d" (Python watershed, fragments passed to waterz) or "native" (waterz's
+        built-in C++ affinity watershed, thresholded by aff_thresholds, with mask support)
+    Returns the segmentation of the lowest threshold
     """
-    aff = aff_block_czyx.astype(np.float32)
-    if aff.max() > 1.0:
-        aff /= 255.0
-    aff = np.ascontiguousarray(aff.astype(np.float32))
-    # Generate initial watershed
-    if sv_type == "3d":
-        B = boundary_from_aff(aff)
-        markers, _ = seeds_3d_from_B(B, interior_thr=interior_thr, min_distance=min_distance)
-        supervox = watershed(B, markers=markers, mask=mask).astype(np.int32, copy=False)
-    elif sv_type == "2d":
-        supervox = watershed_2d(aff, sv_2d) # sv_2d: grid, minima and maxima_distance
+    thresholds = sorted(seg_thresholds)
+    merge_until = list(thresholds)
+    if history is not None and history_threshold is not None and history_threshold > thresholds[-1]:
+        merge_until.append(float(history_threshold))
+    if stats is not None:
+        reset_peak_rss()
+    shape_zyx = aff_block_czyx.shape[1:]
+    native = sv_type == "native"
+    t_start = time.perf_counter()
+    if native:
+        # Fragments come from waterz's C++ affinity watershed inside agglomerate (mask honoured there)
+        aff = affinities_float32(aff_block_czyx)
+        supervox = None
+        if history is not None:
+            # Nothing merges below 0: the first level yields the initial fragments
+            merge_until.insert(0, 0.0)
+    elif memory_lean:
+        supervox = _supervoxels_lean(aff_block_czyx, mask, sv_type, interior_thr, min_distance, sv_2d,
+                                     seed_method, seed_sampling, sv_2d_workers, sv_2d_executor)
     else:
-        raise RuntimeError("Supervoxle should be 3d or 2d.")
-    if supervox.max() == 0:
+        aff = aff_block_czyx.astype(np.float32)
+        if aff.max() > 1.0:
+            aff /= 255.0
+        aff = np.ascontiguousarray(aff.astype(np.float32))
+        supervox = _supervoxels(aff, mask, sv_type, interior_thr, min_distance, sv_2d,
+                                seed_method, seed_sampling, sv_2d_workers, sv_2d_executor)
+    if supervox is not None and supervox.max() == 0:
         print("Watershed produced no segments.")
-        return np.zeros_like(B, dtype=np.uint32)
+        seg = np.zeros(shape_zyx, dtype=np.uint32)
+        if on_threshold is not None:
+            for thr in thresholds:
+                on_threshold(thr, seg)
+        if history is not None:
+            history.update(fragments=seg, merges=np.zeros(0, dtype=MERGE_HISTORY_DTYPE),
+                           max_threshold=merge_until[-1])
+        if stats is not None:
+            stats.update(time_supervoxel=time.perf_counter() - t_start, time_agglomerate=0.0,
+                         time_on_threshold=0.0, n_supervoxels=0, n_edges=0)
+            stats["peak_rss_mb"] = peak_rss_bytes() / 1024.0 ** 2
+        return seg
         # raise RuntimeError("Watershed produced no segments.")
-    supervox, _ = compact_labels_uint32(supervox)
-    supervox = np.ascontiguousarray(supervox.astype(np.uint64, copy=False))
+    if native:
+        pass
+    elif memory_lean:
+        # Compact straight to uint64 fragments, then make the only float32 copy of the affinities
+        supervox, _ = compact_labels_uint32(supervox, dtype=np.uint64)
+        aff = affinities_float32(aff_block_czyx)
+    else:
+        supervox, _ = compact_labels_uint32(supervox)
+        supervox = np.ascontiguousarray(supervox.astype(np.uint64, copy=False))
+    if history is not None:
+        # agglomerate relabels the fragments buffer in place: keep the initial fragments
+        if not native:
+            history["fragments"] = supervox.astype(np.uint32)
+        merges = []
     # Run waterz aggregation
-    outs = []
-    for out in agglomerate(
+    t_agglomerate = time.perf_counter()
+    t_callback = 0.0
+    waterz_stats = {} if stats is not None else None
+    seg = None
+    for level, (thr, out) in enumerate(zip(merge_until, agglomerate(
         aff,
-        seg_thresholds,
+        list(merge_until),
         aff_threshold_low=aff_thresholds[0],
         aff_threshold_high=aff_thresholds[1],
         fragments=supervox,
+        return_merge_history=history is not None,
         scoring_function=getScoreFunc(merge_function),
-        discretize_queue=256,
-        force_rebuild=True
-    ):
-        out = np.ascontiguousarray(out)
-        outs.append(out.copy())
-
-    seg = outs[0] if isinstance(outs, list) else next(outs)
-    return seg.astype(np.uint32, copy=False)
+        discretize_queue=discretize_queue,
+        cache_dir=waterz_cache_dir,
+        mask=mask if native else None,
+        stats=waterz_stats,
+    ))):
+        if history is not None:
+            out, step = out
+            merges.append(merge_history_array(step))
+            if native and level == 0:
+                history["fragments"] = out.astype(np.uint32)
+                continue
+        if thr > thresholds[-1]:
+            continue
+        # The generator reuses the fragments buffer: keep the lowest threshold only,
+        # hand every threshold to the callback while the buffer holds it
+        seg_t = out.astype(np.uint32)
+        if seg is None:
+            seg = seg_t
+        if on_threshold is not None:
+            t_cb = time.perf_counter()
+            on_threshold(thr, seg_t)
+            t_callback += time.perf_counter() - t_cb
+        del seg_t
+
+    del aff, supervox
+    if history is not None:
+        history["merges"] = np.concatenate(merges) if merges else np.zeros(0, dtype=MERGE_HISTORY_DTYPE)
+        history["max_threshold"] = merge_until[-1]
+    if stats is not None:
+        stats.update(
+            time_supervoxel=t_agglomerate - t_start,
+            time_agglomerate=time.perf_counter() - t_agglomerate - t_callback,
+            time_on_threshold=t_callback,
+            n_supervoxels=max(0, int(waterz_stats.get("num_nodes", 1)) - 1),
+            n_edges=int(waterz_stats.get("num_edges", 0)),
+        )
+        stats["peak_rss_mb"] = peak_rss_bytes() / 1024.0 ** 2
+    return seg
+
+
+def _supervoxels(aff, mask, sv_type, interior_thr, min_distance, sv_2d, seed_method="peak_local_max",
+                 seed_sampling=None, sv_2d_workers=1, sv_2d_executor="thread"):
+    """Initial watershed on float32 affinities in [0, 1]"""
+    if sv_type == "3d":
+        B = boundary_from_aff(aff)
+        markers, _ = seeds_3d_from_B(B, interior_thr=interior_thr, min_distance=min_distance,
+                                     method=seed_method, sampling=seed_sampling)
+        return watershed(B, markers=markers, mask=mask).astype(np.int32, copy=False)
+    elif sv_type == "2d":
+        # sv_2d: grid, minima and maxima_distance
+        return watershed_2d(aff, sv_2d, workers=sv_2d_workers, executor=sv_2d_executor)
+    raise RuntimeError("Supervoxle should be 3d, 2d or native.")
+
+
+def _supervoxels_lean(aff, mask, sv_type, interior_thr, min_distance, sv_2d, seed_method="peak_local_max",
+                      seed_sampling=None, sv_2d_workers=1, sv_2d_executor="thread"):
+    """Initial watershed without float copies of the block (uint8 boundary map for 8-bit input)"""
+    scale = 1.0 / 255.0 if aff.max() > 1.0 else 1.0
+    is_u8 = aff.dtype == np.uint8 and scale != 1.0
+    if sv_type == "3d":
+        if is_u8:
+            B = boundary_from_aff_u8(aff)
+        else:
+            B = boundary_from_aff(affinities_float32(aff, scale))
+        markers, _ = seeds_3d_from_B(B, interior_thr=interior_thr, min_distance=min_distance,
+                                     method=seed_method, sampling=seed_sampling)
+        supervox = watershed(B, markers=markers, mask=mask)
+        del B, markers
+        return supervox
+    elif sv_type == "2d":
+        return watershed_2d(aff, sv_2d, scale=scale, workers=sv_2d_workers, executor=sv_2d_executor)
+    raise RuntimeError("Supervoxle should be 3d, 2d or native.")
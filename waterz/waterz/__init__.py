@@ -4,15 +4,31 @@ from .evaluate import evaluate_total_volume, initialize_stats, update_statistics
 
 __version__ = '0.8'
 
+# compiled agglomeration modules already imported by this process, by module name
+__modules = {}
+
+def __default_cache_dir():
+    import os
+    return os.environ.get('WATERZ_CACHE_DIR', os.path.expanduser('~/.cython/inline'))
+
+def __is_built(lib_dir, module_name):
+    import os
+    from importlib.machinery import EXTENSION_SUFFIXES
+    return any(
+        os.path.exists(os.path.join(lib_dir, module_name + suffix))
+        for suffix in EXTENSION_SUFFIXES)
+
 def __compile(scoring_function='OneMinus<MeanAffinity<RegionGraphType, ScoreValue>>',
               discretize_queue=0,
-              force_rebuild=False):
+              force_rebuild=False,
+              cache_dir=None):
     import sys
     import os
     import shutil
     import glob
     import numpy
     import fcntl
+    import tempfile
 
     try:
         import hashlib
@@ -41,7 +57,15 @@ def __compile(scoring_function='OneMinus<MeanAffinity<RegionGraphType, ScoreValu
 
     key = scoring_function, discretize_queue, source_files_hashes, sys.version_info, sys.executable, Cython.__version__
     module_name = 'waterz_' + hashlib.md5(str(key).encode('utf-8')).hexdigest()
-    lib_dir=os.path.expanduser('~/.cython/inline')
+    lib_dir = os.path.abspath(cache_dir or __default_cache_dir())
+
+    if lib_dir not in sys.path:
+        sys.path.append(lib_dir)
+
+    # fast path: an already built module is reused without taking the lock, so
+    # concurrent workers do not serialize on it once the cache is warm
+    if not force_rebuild and __is_built(lib_dir, module_name):
+        return module_name
 
     # since this could be called concurrently, there is no good way to check
     # whether the directory already exists
@@ -56,11 +80,10 @@ def __compile(scoring_function='OneMinus<MeanAffinity<RegionGraphType, ScoreValu
 
         try:
 
-            if lib_dir not in sys.path:
-                sys.path.append(lib_dir)
-            if force_rebuild:
+            if force_rebuild or not __is_built(lib_dir, module_name):
                 raise ImportError
             else:
+                # another process finished the build while we were waiting
                 print("Re-using already compiled waterz version")
                 return module_name
 
@@ -124,9 +147,18 @@ def __compile(scoring_function='OneMinus<MeanAffinity<RegionGraphType, ScoreValu
             build_extension = build_ext(Distribution())
             build_extension.finalize_options()
             build_extension.extensions = cythonize([extension], quiet=True, nthreads=2)
-            build_extension.build_temp = lib_dir
-            build_extension.build_lib  = lib_dir
-            build_extension.run()
+            # link into a private directory and move the finished module into
+            # lib_dir, so that the lock-free fast path above never sees (and
+            # imports) a partially written extension
+            build_lib = tempfile.mkdtemp(prefix=module_name + '.', dir=lib_dir)
+            try:
+                build_extension.build_temp = lib_dir
+                build_extension.build_lib  = build_lib
+                build_extension.run()
+                built = build_extension.get_ext_fullpath(module_name)
+                os.replace(built, os.path.join(lib_dir, os.path.basename(built)))
+            finally:
+                shutil.rmtree(build_lib, ignore_errors=True)
             return module_name
 
 
@@ -141,7 +173,10 @@ def agglomerate(
         return_region_graph = False,
         scoring_function='OneMinus<MeanAffinity<RegionGraphType, ScoreValue>>',
         discretize_queue=0,
-        force_rebuild=False):
+        force_rebuild=False,
+        cache_dir=None,
+        mask=None,
+        stats=None):
     '''
     Compute segmentations from an affinity graph for several thresholds.
 
@@ -202,6 +237,22 @@ def agglomerate(
 
             Force the rebuild of the module. Only needed for development.
 
+        cache_dir: string (optional)
+
+            Directory holding the compiled agglomeration modules. Defaults to
+            $WATERZ_CACHE_DIR, or ~/.cython/inline if that is not set. Point
+            it at a shared file system to reuse builds across nodes.
+
+        mask: numpy array, 3 dimensional (optional)
+
+            Only used by the built-in watershed (fragments=None): voxels where
+            the mask is zero become background (id 0) and are not flooded.
+
+        stats: dict (optional)
+
+            Filled with 'num_nodes' and 'num_edges' of the initial region graph
+            once the generator starts.
+
     Returns
     -------
 
@@ -246,8 +297,8 @@ def agglomerate(
         for segmentation, metrics, merge_history in agglomerate(affs, range(100,10000,100), gt, return_merge_history = True):
             # ...
     '''
-    module_name = __compile(scoring_function, discretize_queue, force_rebuild)
-    return __import__(module_name).agglomerate(
+    module = __load(scoring_function, discretize_queue, force_rebuild, cache_dir)
+    return module.agglomerate(
         affs, 
         thresholds, 
         gt, 
@@ -255,7 +306,29 @@ def agglomerate(
         aff_threshold_low, 
         aff_threshold_high, 
         return_merge_history,
-        return_region_graph)
+        return_region_graph,
+        mask,
+        stats)
+
+
+def __load(scoring_function, discretize_queue, force_rebuild, cache_dir):
+    import importlib
+    module_name = __compile(scoring_function, discretize_queue, force_rebuild, cache_dir)
+    if force_rebuild or module_name not in __modules:
+        __modules[module_name] = importlib.import_module(module_name)
+    return __modules[module_name]
+
+def build(
+        scoring_function='OneMinus<MeanAffinity<RegionGraphType, ScoreValue>>',
+        discretize_queue=0,
+        force_rebuild=False,
+        cache_dir=None):
+    '''
+    Compile (if needed) the agglomeration module for the given scoring function
+    and queue, without running an agglomeration. Use this to warm up the module
+    cache before dispatching many workers. Returns the module name.
+    '''
+    return __compile(scoring_function, discretize_queue, force_rebuild, cache_dir)
 
 
 from .seg_watershed import watershed
@@ -1,5 +1,5 @@
 from libcpp.vector cimport vector
-from libc.stdint cimport uint64_t, uint32_t
+from libc.stdint cimport uint64_t, uint32_t, uint8_t
 from libcpp cimport bool
 import numpy as np
 cimport numpy as np
@@ -12,7 +12,9 @@ def agglomerate(
     aff_threshold_low  = 0.0001, 
     aff_threshold_high = 0.9999, 
     return_merge_history = False,
-    return_region_graph=False):
+    return_region_graph=False,
+    mask = None,
+    stats = None):
 
     # the C++ part assumes contiguous memory, make sure we have it (and do 
     # nothing, if we do)
@@ -22,6 +24,9 @@ def agglomerate(
     if gt is not None and not gt.flags['C_CONTIGUOUS']:
         print("Creating memory-contiguous ground-truth arrray (avoid this by passing C_CONTIGUOUS arrays)")
         gt = np.ascontiguousarray(gt)
+    if mask is not None:
+        # uint8 view/copy of the mask, used by the initial watershed only
+        mask = np.ascontiguousarray(mask, dtype=np.uint8)
     if fragments is not None and not fragments.flags['C_CONTIGUOUS']:
         print("Creating memory-contiguous fragments arrray (avoid this by passing C_CONTIGUOUS arrays)")
         fragments = np.ascontiguousarray(fragments)
@@ -36,7 +41,11 @@ def agglomerate(
         segmentation = fragments
         find_fragments = False
 
-    cdef WaterzState state = __initialize(affs, segmentation, gt, aff_threshold_low, aff_threshold_high, find_fragments)
+    cdef WaterzState state = __initialize(affs, segmentation, gt, aff_threshold_low, aff_threshold_high, find_fragments, mask)
+    if stats is not None:
+        # initial region graph size (node 0 is the background)
+        stats['num_nodes'] = state.num_nodes
+        stats['num_edges'] = state.num_edges
 
     thresholds.sort()
     for threshold in thresholds:
@@ -65,16 +74,20 @@ def __initialize(
         np.ndarray[uint32_t, ndim=3]     gt = None,
         aff_threshold_low  = 0.0001,
         aff_threshold_high = 0.9999,
-        find_fragments = True):
+        find_fragments = True,
+        np.ndarray[uint8_t, ndim=3]      mask = None):
 
     cdef float*    aff_data
     cdef uint64_t* segmentation_data
     cdef uint32_t* gt_data = NULL
+    cdef uint8_t*  mask_data = NULL
 
     aff_data = &affs[0,0,0,0]
     segmentation_data = &segmentation[0,0,0]
     if gt is not None:
         gt_data = &gt[0,0,0]
+    if mask is not None:
+        mask_data = &mask[0,0,0]
 
     return initialize(
         affs.shape[1], affs.shape[2], affs.shape[3],
@@ -83,7 +96,8 @@ def __initialize(
         gt_data,
         aff_threshold_low,
         aff_threshold_high,
-        find_fragments)
+        find_fragments,
+        mask_data)
 
 cdef extern from "frontend_agglomerate.h":
 
@@ -107,6 +121,8 @@ cdef extern from "frontend_agglomerate.h":
     struct WaterzState:
         int     context
         Metrics metrics
+        size_t  num_nodes
+        size_t  num_edges
 
     WaterzState initialize(
             size_t          width,
@@ -117,7 +133,8 @@ cdef extern from "frontend_agglomerate.h":
             const uint32_t* groundtruth_data,
             float           affThresholdLow,
             float           affThresholdHigh,
-            bool            findFragments);
+            bool            findFragments,
+            const uint8_t*  mask_data);
 
     vector[Merge] mergeUntil(
             WaterzState& state,
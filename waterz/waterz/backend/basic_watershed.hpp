@@ -19,6 +19,9 @@
  * @param counts [out]
  *              A reference to a counts_t data structure that will be used to 
  *              store the sizes of the found regions.
+ * @param mask [in]
+ *              Optional (depth,height,width) array, non-zero inside. Voxels 
+ *              outside are background (id 0) and no edge leads into them.
  */
 template<typename AG, typename V>
 inline
@@ -28,7 +31,8 @@ watershed(
         typename AG::element low,
         typename AG::element high,
         V& seg,
-        counts_t<std::size_t>& counts)
+        counts_t<std::size_t>& counts,
+        const uint8_t* mask = nullptr)
 {
     typedef typename AG::element F;
     typedef typename V::element  ID;
@@ -50,18 +54,23 @@ watershed(
 
     ID* seg_raw = seg.data();
 
+    auto inside = [mask](std::ptrdiff_t i) { return mask == nullptr || mask[i] != 0; };
+
     for ( std::ptrdiff_t z = 0; z < zdim; ++z )
         for ( std::ptrdiff_t y = 0; y < ydim; ++y )
             for ( std::ptrdiff_t x = 0; x < xdim; ++x )
             {
                 ID& id = seg[z][y][x] = 0;
 
-                F negz = (z>0) ? aff[0][z][y][x] : low;
-                F negy = (y>0) ? aff[1][z][y][x] : low;
-                F negx = (x>0) ? aff[2][z][y][x] : low;
-                F posz = (z<(zdim-1)) ? aff[0][z+1][y][x] : low;
-                F posy = (y<(ydim-1)) ? aff[1][z][y+1][x] : low;
-                F posx = (x<(xdim-1)) ? aff[2][z][y][x+1] : low;
+                std::ptrdiff_t idx = (z*ydim + y)*xdim + x;
+                if ( !inside(idx) ) continue;
+
+                F negz = (z>0 && inside(idx-ydim*xdim)) ? aff[0][z][y][x] : low;
+                F negy = (y>0 && inside(idx-xdim)) ? aff[1][z][y][x] : low;
+                F negx = (x>0 && inside(idx-1)) ? aff[2][z][y][x] : low;
+                F posz = (z<(zdim-1) && inside(idx+ydim*xdim)) ? aff[0][z+1][y][x] : low;
+                F posy = (y<(ydim-1) && inside(idx+xdim)) ? aff[1][z][y+1][x] : low;
+                F posx = (x<(xdim-1) && inside(idx+1)) ? aff[2][z][y][x+1] : low;
 
                 F m = std::max({negx,negy,negz,posx,posy,posz});
 
@@ -23,7 +23,8 @@ initialize(
 		const GtID*     ground_truth_data,
 		AffValue        affThresholdLow,
 		AffValue        affThresholdHigh,
-		bool            findFragments) {
+		bool            findFragments,
+		const uint8_t*  mask_data) {
 
 	std::size_t num_voxels = width*height*depth;
 
@@ -47,7 +48,7 @@ initialize(
 
 		std::cout << "performing initial watershed segmentation..." << std::endl;
 
-		watershed(affinities, affThresholdLow, affThresholdHigh, *segmentation, sizes);
+		watershed(affinities, affThresholdLow, affThresholdHigh, *segmentation, sizes, mask_data);
 
 	} else {
 
@@ -97,6 +98,8 @@ initialize(
 
 	WaterzState initial_state;
 	initial_state.context = context->id;
+	initial_state.num_nodes = numNodes;
+	initial_state.num_edges = regionGraph->numEdges();
 
 	if (ground_truth_data != NULL) {
 
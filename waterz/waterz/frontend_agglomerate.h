@@ -59,6 +59,8 @@ struct WaterzState {
 
 	int     context;
 	Metrics metrics;
+	std::size_t num_nodes;
+	std::size_t num_edges;
 };
 
 class WaterzContext {
@@ -151,7 +153,8 @@ WaterzState initialize(
 		const GtID*     groundtruth_data = NULL,
 		AffValue        affThresholdLow  = 0.0001,
 		AffValue        affThresholdHigh = 0.9999,
-		bool            findFragments = true);
+		bool            findFragments = true,
+		const uint8_t*  mask_data = NULL);
 
 std::vector<Merge> mergeUntil(
 		WaterzState& state,
@@ -53,7 +53,7 @@ def waterz(
             fragments=fragments,
             scoring_function=getScoreFunc(merge_function),
             discretize_queue=discretize_queue,
-            force_rebuild=True)):
+            force_rebuild=False)):
 
         threshold = thresholds[i]
         output_basename = output_prefix+merge_function+'_%.2f'%threshold